@@ -2,7 +2,12 @@ import json  # Стандартный модуль для работы с JSON:
 import logging  # Модуль для логирования событий работы агента
 import wave  # Для упаковки записанных звуковых фреймов в WAV-файл
 import io  # Для работы с байтовыми потоками (BytesIO)
+import struct  # Заголовок компактного формата VPCM
 import requests  # HTTP-клиент для отправки запросов на сервер распознавания
+from requests.adapters import HTTPAdapter  # Пул keep-alive соединений с сервером
+import random  # Случайный разброс задержек между повторами
+import threading  # Фоновая отправка очереди и озвучка
+import uuid  # Ключ идемпотентности для каждой фразы
 import os  # Работа с путями и переменными окружения
 import sys  # Для завершения процесса через sys.exit()
 import pathlib  # Удобный класс для работы с файловыми путями
@@ -35,6 +40,16 @@ SERVER_URL        = CONFIG["SERVER_URL"].rstrip("/")   # URL сервера ра
 SILENCE_MS        = CONFIG["SILENCE_MS"]         # Время тишины (ms) для окончания записи
 SILENCE_THRESHOLD = CONFIG["SILENCE_THRESHOLD"]  # Порог RMS для определения речи/тишины
 MAX_RECORD_SEC    = CONFIG["MAX_RECORD_SEC"]     # Максимальная длительность записи (секунд)
+TRIM_PAD_MS       = CONFIG.get("TRIM_PAD_MS", 200)       # Запас тишины до и после речи при обрезке (ms)
+UPLOAD_FORMAT     = CONFIG.get("UPLOAD_FORMAT", "wav").lower()  # Формат отправки: wav, pcm (VPCM) или flac
+TERMINAL_ID       = CONFIG.get("TERMINAL_ID")             # Идентификатор ТСД для сервера (X-Terminal-Id)
+REQUEST_TIMEOUT   = CONFIG.get("REQUEST_TIMEOUT_SEC", 30) # Таймаут одного запроса к серверу (секунд)
+RETRY_ATTEMPTS    = CONFIG.get("RETRY_ATTEMPTS", 3)       # Попыток за один заход к фразе (между заходами — проверка возраста)
+RETRY_BASE_MS     = CONFIG.get("RETRY_BASE_MS", 500)      # Первая задержка между попытками (ms), далее удваивается
+RETRY_CAP_SEC     = CONFIG.get("RETRY_CAP_SEC", 30)       # Максимальная задержка между попытками (секунд)
+OUTBOX_DIR        = BASE_DIR / CONFIG.get("OUTBOX_DIR", "outbox")  # Очередь неотправленных фраз на диске
+OUTBOX_MAX        = CONFIG.get("OUTBOX_MAX", 50)          # Сколько фраз хранить без связи (старые вытесняются)
+OUTBOX_MAX_AGE_SEC = CONFIG.get("OUTBOX_MAX_AGE_SEC", 600)  # Старше — не отправляются (не больше idempotency_ttl сервера)
 
 # Обработка завершения через Ctrl+C или kill
 def _on_shutdown(signum, frame):
@@ -103,7 +118,7 @@ def detect_hotword():
 
 # Функция записи звука и отправки на сервер распознавания
 def record_and_send(stream):
-    """Записываем в буфер до тишины или MAX_RECORD_SEC, отправляем WAV на сервер."""
+    """Записываем в буфер до тишины или MAX_RECORD_SEC, ставим речь в очередь отправки на сервер."""
     frames = []          # список байтов аудиофреймов
     silent_chunks = 0    # счётчик подряд идущих тихих фреймов
     chunk_ms       = 100 # длительность одного фрейма в ms
@@ -113,6 +128,7 @@ def record_and_send(stream):
     speak_async("Принято")  # озвучиваем момент начала записи
     logging.info("🎙️  Начало записи голосовой команды")
 
+    first_speech = last_speech = None  # первый и последний громкий фрейм
     for i in range(max_chunks):
         raw_block, overflow = stream.read(RATE // 10)
         chunk = bytes(raw_block)
@@ -122,8 +138,10 @@ def record_and_send(stream):
         if level >= SILENCE_THRESHOLD:
             if not speech_started:
                 logging.info(f"🗣  Обнаружена речь на фрейме {i}")
+                first_speech = i
             speech_started = True
             silent_chunks = 0
+            last_speech = i
         else:
             if speech_started:
                 silent_chunks += 1
@@ -137,6 +155,40 @@ def record_and_send(stream):
 
     duration_sec = len(frames) * chunk_ms / 1000
     logging.info(f"✅ Запись завершена: фреймов={len(frames)}, длительность≈{duration_sec:.2f} s")
+    if first_speech is None:
+        # одна тишина — серверу нечего распознавать
+        logging.info("Речь не обнаружена — не отправляем")
+        return
+
+    # Обрезаем тишину до и после речи, оставляя TRIM_PAD_MS запаса с каждой стороны
+    pad = -(-TRIM_PAD_MS // chunk_ms)  # округление вверх до целых фреймов
+    frames = frames[max(0, first_speech - pad):last_speech + 1 + pad]
+    filename, payload, _ = encode_upload(b"".join(frames))
+    logging.info(f"✂️  Отправляем {len(frames) * chunk_ms / 1000:.2f} s речи: {filename}, {len(payload)} байт")
+
+    # Сначала на диск, потом в сеть: без связи фраза дождется сервера в очереди
+    outbox.put(filename, payload)
+
+# Упаковка записанного PCM в выбранный формат отправки
+def encode_upload(pcm: bytes) -> tuple:
+    """
+    Возвращает (имя файла, байты, MIME) для UPLOAD_FORMAT:
+    wav — как раньше; pcm — PCM с 12-байтным заголовком VPCM (частота, каналы, разрядность);
+    flac — сжатие без потерь, примерно вдвое меньше (нужен пакет soundfile, иначе WAV).
+    """
+    if UPLOAD_FORMAT == "flac":
+        try:
+            import numpy as np
+            import soundfile
+            samples = np.frombuffer(pcm, dtype=np.int16).reshape(-1, CHANNELS)
+            flac_bytes = io.BytesIO()
+            soundfile.write(flac_bytes, samples, RATE, format="FLAC", subtype="PCM_16")
+            return "command.flac", flac_bytes.getvalue(), "audio/flac"
+        except ImportError:
+            logging.warning("soundfile не установлен — отправляем WAV")
+    elif UPLOAD_FORMAT == "pcm":
+        header = struct.pack("<4sIHH", b"VPCM", RATE, CHANNELS, BITS)
+        return "command.vpcm", header + pcm, "application/octet-stream"
 
     # Упаковываем в WAV через BytesIO
     wav_bytes = io.BytesIO()
@@ -144,18 +196,141 @@ def record_and_send(stream):
         wf.setnchannels(CHANNELS)
         wf.setsampwidth(BITS // 8)
         wf.setframerate(RATE)
-        wf.writeframes(b"".join(frames))
-        wav_bytes.seek(0)  # возвращаем указатель в начало
+        wf.writeframes(pcm)
+    return "command.wav", wav_bytes.getvalue(), "audio/wav"
 
-    files = {"file": ("command.wav", wav_bytes, "audio/wav")}
-    try:
-        # Отправляем на FastAPI /recognize
-        resp = requests.post(f"{SERVER_URL}/recognize", files=files, timeout=30)
-        resp.raise_for_status()
-        logging.info("Server response: %s", resp.text)
-        speak_async("Готово")  # озвучиваем завершение обработки
-    except Exception as e:
-        logging.exception("Failed to send audio: %s", e)
+# Постоянное HTTP-соединение с сервером: без TCP-рукопожатия на каждую команду
+def make_session() -> requests.Session:
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=0))
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=0))
+    if TERMINAL_ID:
+        session.headers["X-Terminal-Id"] = TERMINAL_ID
+    return session
+
+_MIME = {".wav": "audio/wav", ".flac": "audio/flac", ".vpcm": "application/octet-stream"}
+
+# Очередь отправки на диске: запись переживает обрыв Wi-Fi и перезапуск агента
+class Outbox:
+    """
+    Каждая фраза — файл <номер>_<ключ идемпотентности>.<формат> в OUTBOX_DIR.
+    Фоновый поток отправляет их строго по порядку: пока не ушла первая,
+    следующие ждут. Ошибки сети, таймауты, 429 и 5xx повторяются с растущей
+    задержкой и случайным разбросом; ключ Idempotency-Key не меняется, так что
+    повтор уже обработанной сервером фразы не дойдет до 1С дважды.
+    """
+
+    def __init__(self, directory: pathlib.Path):
+        self.dir = directory
+        self.dir.mkdir(parents=True, exist_ok=True)
+        for tmp in self.dir.glob("*.tmp"):
+            tmp.unlink(missing_ok=True)  # недописанные при падении
+        self.session = make_session()
+        self._wake = threading.Event()
+        self._offline = False  # чтобы сообщать о потере связи один раз
+        self._failures = 0     # неудачных попыток подряд: задержка растет до RETRY_CAP_SEC, сброс — после ответа сервера
+        existing = self._items()
+        self._seq = int(existing[-1].name.split("_", 1)[0]) if existing else 0
+        if existing:
+            logging.info("В очереди с прошлого запуска: %d фраз", len(existing))
+        threading.Thread(target=self._run, name="outbox", daemon=True).start()
+
+    def _items(self) -> list:
+        return sorted(p for p in self.dir.iterdir() if p.suffix in _MIME)
+
+    def put(self, filename: str, payload: bytes) -> None:
+        """Сохраняет фразу (атомарно: временный файл и rename) и будит отправку."""
+        self._seq += 1
+        path = self.dir / f"{self._seq:012d}_{uuid.uuid4().hex}{pathlib.Path(filename).suffix}"
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(payload)
+        os.replace(tmp, path)
+        items = self._items()
+        for old in items[:max(0, len(items) - OUTBOX_MAX)]:
+            logging.warning("Очередь переполнена — удаляем самую старую фразу %s", old.name)
+            old.unlink(missing_ok=True)
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            try:
+                self._step()
+            except FileNotFoundError:
+                # фразу вытеснил put() из основного потока, пока мы ее читали, — берем следующую
+                continue
+            except Exception:
+                # поток не должен умирать: без него очередь перестанет уходить до перезапуска агента
+                logging.exception("Ошибка в потоке отправки очереди")
+                time.sleep(1)
+
+    def _step(self):
+        items = self._items()
+        if not items:
+            self._wake.wait()
+            self._wake.clear()
+            return
+        path = items[0]
+        age = time.time() - path.stat().st_mtime
+        if age > OUTBOX_MAX_AGE_SEC:
+            logging.warning("Фраза %s пролежала %.0f s без связи — не отправляем", path.name, age)
+            path.unlink(missing_ok=True)
+            return
+        if self._send(path):
+            # если удалить не удалось (файл занят в Windows), повтор уйдет с тем же ключом идемпотентности
+            path.unlink(missing_ok=True)
+
+    def _send(self, path: pathlib.Path) -> bool:
+        """
+        Отправляет одну фразу, повторяя временные ошибки. True — фразу можно
+        удалить (принята или отвергнута сервером), False — оставить и попробовать позже.
+        """
+        key = path.stem.split("_", 1)[1]
+        payload = path.read_bytes()
+        for _ in range(RETRY_ATTEMPTS):
+            retry_after = None
+            try:
+                resp = self.session.post(
+                    f"{SERVER_URL}/recognize",
+                    files={"file": (f"command{path.suffix}", payload, _MIME[path.suffix])},
+                    headers={"Idempotency-Key": key},
+                    timeout=REQUEST_TIMEOUT,
+                )
+            except requests.RequestException as e:
+                error = str(e)
+            else:
+                if resp.ok:
+                    self._failures = 0
+                    logging.info("Server response: %s", resp.text)
+                    if self._offline:
+                        logging.info("Связь с сервером восстановлена")
+                        self._offline = False
+                    speak_async("Готово")  # озвучиваем завершение обработки
+                    return True
+                if resp.status_code not in (408, 429) and resp.status_code < 500:
+                    # запрос отвергнут (не разобран звук, неверный контекст) — повтор не поможет
+                    self._failures = 0  # сервер доступен
+                    logging.error("Сервер отклонил фразу %s: %s %s", path.name, resp.status_code, resp.text)
+                    speak_async("Повторите")
+                    return True
+                error = f"HTTP {resp.status_code}"
+                retry_after = resp.headers.get("Retry-After")
+            self._failures += 1
+            delay = backoff(self._failures)
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            logging.warning("Отправка %s не удалась (%s), неудач подряд %d — повтор через %.1f s",
+                            path.name, error, self._failures, delay)
+            if not self._offline:
+                self._offline = True
+                speak_async("Нет связи, команда сохранена")
+            time.sleep(delay)
+        # заход исчерпан; счетчик неудач сохраняется, так что следующие задержки только растут
+        return False
+
+# Задержка перед повтором: экспоненциальный рост и разброс, чтобы ТСД не ломились разом
+def backoff(failures: int) -> float:
+    delay = min(RETRY_CAP_SEC, RETRY_BASE_MS / 1000 * 2 ** min(failures - 1, 30))
+    return delay / 2 + random.uniform(0, delay / 2)
 
 # Функция для озвучки любых текстовых сообщений асинхронно
 def speak_async(text):
@@ -168,6 +343,7 @@ def speak_async(text):
 
 # Точка входа: запускаем детекцию горячего слова
 if __name__ == "__main__":
+    outbox = Outbox(OUTBOX_DIR)  # досылает оставшееся с прошлого запуска
     try:
         detect_hotword()
         speak_async("Голосовой агент запущен")
@@ -0,0 +1,278 @@
+# voice_server/audio_io.py
+"""
+Прием аудио без временных файлов.
+
+Загрузка декодируется прямо в память в PCM s16le 16 kHz моно (AudioBuffer),
+и этот же буфер передается и в Vosk, и в WhisperX.
+WAV, «сырой» PCM (без заголовка или с 12-байтным заголовком VPCM от агента)
+и FLAC (если установлен soundfile) разбираются в процессе, остальные форматы —
+через пул заранее запущенных процессов ffmpeg, читающих stdin/stdout.
+Исключение — контейнеры MP4/M4A/MOV: индекс (moov) у них бывает в конце файла,
+а из канала ffmpeg назад перейти не может, поэтому они идут через временный файл.
+"""
+from __future__ import annotations
+import io
+import logging
+import os
+import pathlib
+import queue
+import struct
+import subprocess
+import tempfile
+import threading
+import wave
+
+import numpy as np
+
+try:
+    import soundfile  # FLAC без ffmpeg; необязателен
+except ImportError:  # pragma: no cover - зависит от окружения
+    soundfile = None
+
+logger = logging.getLogger(__name__)
+
+TARGET_RATE = 16000             # частота, которую ожидают WhisperX и grammar-модель Vosk
+RAW_SUFFIXES = {".pcm", ".raw"}  # PCM s16le 16 kHz моно без заголовка
+# PCM с заголовком от агента: "VPCM", частота (uint32), каналы (uint16), разрядность (uint16), little-endian
+PCM_HEADER = struct.Struct("<4sIHH")
+PCM_MAGIC = b"VPCM"
+
+
+class AudioDecodeError(Exception):
+    """Загрузку не удалось разобрать или сконвертировать."""
+
+
+class AudioBuffer:
+    """PCM s16le моно в памяти и его float32-представление для WhisperX."""
+
+    __slots__ = ("pcm", "rate", "_float32", "__weakref__")
+
+    def __init__(self, pcm: bytes, rate: int = TARGET_RATE) -> None:
+        self.pcm = pcm
+        self.rate = rate
+        self._float32: np.ndarray | None = None
+
+    @property
+    def duration(self) -> float:
+        """Длительность в секундах."""
+        return len(self.pcm) / 2 / self.rate
+
+    @property
+    def float32(self) -> np.ndarray:
+        """Отсчеты в диапазоне [-1, 1] — формат, который WhisperX принимает вместо пути к файлу."""
+        if self._float32 is None:
+            self._float32 = np.frombuffer(self.pcm, dtype=np.int16).astype(np.float32) / 32768.0
+        return self._float32
+
+    def snr_db(self, frame_ms: int = 20) -> float:
+        """
+        Грубая оценка SNR: отношение энергии громких кадров (90-й перцентиль)
+        к энергии фона (10-й перцентиль), дБ.
+        """
+        frame = self.rate * frame_ms // 1000
+        n = len(self.pcm) // 2 // frame
+        if n < 2:
+            return 0.0
+        samples = np.frombuffer(self.pcm, dtype=np.int16)[: n * frame].astype(np.float32)
+        energy = (samples.reshape(n, frame) ** 2).mean(axis=1) + 1.0
+        noise, speech = np.percentile(energy, [10, 90])
+        return float(10 * np.log10(speech / noise))
+
+    def chunks(self, size: int = 8000):
+        """Порции PCM для KaldiRecognizer.AcceptWaveform (по умолчанию 4000 отсчетов)."""
+        for i in range(0, len(self.pcm), size):
+            yield self.pcm[i:i + size]
+
+
+# ---------- пул ffmpeg ----------
+class FfmpegPool:
+    """
+    Держит наготове несколько запущенных ffmpeg, ожидающих данные в stdin.
+    Запрос забирает готовый процесс, а замена запускается в фоне —
+    стоимость fork/exec уходит с критического пути запроса.
+    """
+
+    _CMD = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-i", "pipe:0",              # вход из stdin
+        "-f", "s16le",               # «сырой» PCM 16-bit на выходе
+        "-ar", str(TARGET_RATE),     # частота дискретизации 16 kHz
+        "-ac", "1",                  # моно канал
+        "pipe:1",
+    ]
+
+    def __init__(self, size: int = 2, timeout: float = 30.0) -> None:
+        self.size = size
+        self.timeout = timeout
+        self._idle: queue.Queue[subprocess.Popen] = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def _spawn(self) -> subprocess.Popen:
+        return subprocess.Popen(
+            self._CMD, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+
+    def _refill(self) -> None:
+        try:
+            self._idle.put(self._spawn())
+        except OSError as e:
+            logger.error("ffmpeg pool: cannot spawn ffmpeg: %s", e)
+
+    def _take(self) -> subprocess.Popen:
+        with self._lock:
+            if not self._started:
+                self._started = True
+                for _ in range(self.size):
+                    self._refill()
+        try:
+            proc = self._idle.get_nowait()
+        except queue.Empty:
+            proc = self._spawn()
+        # запускаем замену в фоне, чтобы следующий запрос тоже получил готовый процесс
+        threading.Thread(target=self._refill, daemon=True).start()
+        return proc
+
+    def decode(self, data: bytes) -> bytes:
+        """Конвертирует произвольный аудиоформат в PCM s16le 16 kHz моно."""
+        try:
+            proc = self._take()
+        except OSError as e:
+            raise AudioDecodeError(f"FFmpeg unavailable: {e}") from e
+        return self._communicate(proc, data)
+
+    def decode_file(self, data: bytes, suffix: str = "") -> bytes:
+        """
+        То же через временный файл — для контейнеров, которые ffmpeg читает с переходами
+        по файлу (MP4 с moov в конце). Процесс запускается отдельно: в пуле вход — stdin.
+        """
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            cmd = [path if arg == "pipe:0" else arg for arg in self._CMD]
+            try:
+                proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            except OSError as e:
+                raise AudioDecodeError(f"FFmpeg unavailable: {e}") from e
+            return self._communicate(proc, None)
+        finally:
+            os.remove(path)
+
+    def _communicate(self, proc: subprocess.Popen, data: bytes | None) -> bytes:
+        try:
+            out, err = proc.communicate(data, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise AudioDecodeError("FFmpeg timeout")
+        if proc.returncode != 0:
+            stderr = err.decode(errors="ignore")
+            logger.error("ffmpeg stderr: %s", stderr)
+            raise AudioDecodeError(f"FFmpeg error: {stderr}")
+        return out
+
+    def close(self) -> None:
+        while True:
+            try:
+                proc = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            proc.kill()
+            proc.wait()
+
+
+ffmpeg_pool = FfmpegPool()
+
+
+# ---------- разбор форматов ----------
+def _resample(samples: np.ndarray, src_rate: int, dst_rate: int) -> np.ndarray:
+    """Ресэмплинг float-отсчетов: ФНЧ (оконный sinc) против алиасинга и линейная интерполяция."""
+    if src_rate == dst_rate:
+        return samples
+    if dst_rate < src_rate:
+        cutoff = dst_rate / src_rate / 2          # нормированная частота среза
+        taps = np.arange(-32, 33)
+        kernel = 2 * cutoff * np.sinc(2 * cutoff * taps) * np.hamming(len(taps))
+        samples = np.convolve(samples, kernel / kernel.sum(), mode="same")
+    n_out = int(len(samples) * dst_rate / src_rate)
+    positions = np.arange(n_out) * (src_rate / dst_rate)
+    return np.interp(positions, np.arange(len(samples)), samples)
+
+
+def _to_buffer(frames: bytes, channels: int, rate: int) -> AudioBuffer:
+    """PCM s16le с любым числом каналов и частотой → моно 16 kHz."""
+    frames = frames[: len(frames) // (2 * channels) * 2 * channels]  # только целые кадры
+    if channels == 1 and rate == TARGET_RATE:
+        return AudioBuffer(frames)
+    # сводим каналы в моно средним значением и приводим частоту к 16 kHz
+    samples = np.frombuffer(frames, dtype=np.int16).reshape(-1, channels).mean(axis=1)
+    samples = _resample(samples, rate, TARGET_RATE)
+    return AudioBuffer(np.clip(samples, -32768, 32767).astype(np.int16).tobytes())
+
+
+def _decode_wav(data: bytes) -> AudioBuffer | None:
+    """WAV 16-bit разбираем сами (моно и ресэмплинг — numpy); None — нужен ffmpeg."""
+    with wave.open(io.BytesIO(data), "rb") as wf:
+        channels, width, rate = wf.getnchannels(), wf.getsampwidth(), wf.getframerate()
+        frames = wf.readframes(wf.getnframes())
+    if width != 2:
+        return None
+    return _to_buffer(frames, channels, rate)
+
+
+def _decode_vpcm(data: bytes) -> AudioBuffer:
+    """PCM с заголовком VPCM: 12 байт вместо 44 у WAV, частота и каналы — любые."""
+    if len(data) < PCM_HEADER.size:
+        raise AudioDecodeError("Bad VPCM: truncated header")
+    _, rate, channels, bits = PCM_HEADER.unpack_from(data)
+    if bits != 16 or not channels or not 8000 <= rate <= 192000:
+        raise AudioDecodeError(f"Bad VPCM: {rate} Hz, {channels} ch, {bits} bit (need 16-bit)")
+    return _to_buffer(data[PCM_HEADER.size:], channels, rate)
+
+
+def _decode_flac(data: bytes) -> AudioBuffer:
+    samples, rate = soundfile.read(io.BytesIO(data), dtype="int16", always_2d=True)
+    return _to_buffer(samples.tobytes(), samples.shape[1], rate)
+
+
+def _needs_seek(data: bytes) -> bool:
+    """ISO BMFF (MP4, M4A, MOV, 3GP): первый бокс — ftyp."""
+    return data[4:8] == b"ftyp"
+
+
+def decode_bytes(data: bytes, filename: str | None = None) -> AudioBuffer:
+    """
+    Декодирует загрузку в AudioBuffer без записи на диск.
+    :param data: содержимое загруженного файла
+    :param filename: имя файла от клиента (по расширению выбирается декодер)
+    """
+    if data[:4] == PCM_MAGIC:
+        return _decode_vpcm(data)
+    suffix = pathlib.Path(filename or "audio").suffix.lower()
+    if suffix in RAW_SUFFIXES:
+        return AudioBuffer(data[: len(data) // 2 * 2])
+    if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+        try:
+            buf = _decode_wav(data)
+        except (wave.Error, EOFError) as e:
+            # wave не знает WAVE_FORMAT_EXTENSIBLE, float и сжатые кодеки — их разберет ffmpeg,
+            # а 400 будет, только если не справится и он
+            logger.debug("wave cannot read upload (%s), falling back to ffmpeg", e)
+            buf = None
+        if buf is not None:
+            return buf
+    if data[:4] == b"fLaC" and soundfile is not None:
+        try:
+            return _decode_flac(data)
+        except (RuntimeError, ValueError) as e:  # LibsndfileError наследует RuntimeError
+            raise AudioDecodeError(f"Bad FLAC: {e}") from e
+    if _needs_seek(data):
+        return AudioBuffer(ffmpeg_pool.decode_file(data, suffix))
+    return AudioBuffer(ffmpeg_pool.decode(data))
+
+
+def read_file(path: pathlib.Path | str) -> AudioBuffer:
+    """Загружает аудиофайл с диска (тестовые данные, бенчмарки)."""
+    path = pathlib.Path(path)
+    return decode_bytes(path.read_bytes(), path.name)
@@ -0,0 +1,363 @@
+# voice_server/audio_store.py
+"""
+Хранилище аудио в tmp_dir с ограничением по диску и возрасту.
+
+Распознавание идет в памяти (audio_io), так что на диск попадает только
+выборка: доля всех фраз (audio_store_sample) и отдельно — доля «трудных»
+(фолбэк на WhisperX, «повторите», Unknown; audio_store_sample_hard). Фраза
+сохраняется WAV 16 kHz моно (~32 КБ/с) в archive/ГГГГММДД/, а ее текст,
+интент, движок и уверенность — в индекс SQLite archive/index.db.
+Запись на диск делает фоновый поток: offer() на пути запроса — только
+жребий и put в ограниченную очередь.
+
+Тот же поток — уборщик: раз в audio_store_janitor_interval удаляет записи
+старше audio_store_max_age_days, затем самые старые сверх audio_store_max_mb,
+файлы без записи в индексе и оставшиеся от прежних версий каталоги voice_*.
+
+Выборку можно выгрузить в манифест бенчмарка (JSON Lines, пути относительно
+манифеста) и прогнать офлайн или использовать для настройки грамматик:
+    python -m voice_server.audio_store export archive.jsonl --hard
+    python -m voice_server.benchmark --manifest archive.jsonl
+Интент в манифесте — ответ сервера, а не проверенная разметка.
+"""
+from __future__ import annotations
+import argparse
+import json
+import logging
+import os
+import pathlib
+import queue
+import random
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+import wave
+from typing import Optional
+
+from .audio_io import AudioBuffer
+from .config import settings
+from .policy import DECISION_VOSK
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = "archive"
+INDEX_NAME = "index.db"
+_LEGACY_PREFIX = "voice_"   # каталоги save_tmp прежних версий: по одному на запрос, не удалялись
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS utterances (
+    id         TEXT PRIMARY KEY,
+    created    REAL    NOT NULL,
+    path       TEXT    NOT NULL,
+    bytes      INTEGER NOT NULL,
+    duration   REAL    NOT NULL,
+    terminal   TEXT,
+    context    TEXT,
+    engine     TEXT,
+    decision   TEXT,
+    confidence REAL,
+    text       TEXT,
+    vosk_text  TEXT,
+    intent     TEXT,
+    fields     TEXT,
+    hard       INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS utterances_created ON utterances (created);
+"""
+
+
+def is_hard(result: dict) -> bool:
+    """Фраза, на которой Vosk не справился сам: фолбэк на WhisperX, «повторите» или Unknown."""
+    return result.get("decision") != DECISION_VOSK or result.get("intent") == "Unknown"
+
+
+class AudioStore:
+    def __init__(self, root: str, max_bytes: int, max_age_s: float, sample: float = 0.0,
+                 sample_hard: float = 0.0, janitor_interval: float = 300.0, queue_size: int = 64,
+                 legacy_grace_s: float = 600.0) -> None:
+        """
+        :param root: каталог хранилища (settings.tmp_dir)
+        :param max_bytes: предел объема архива
+        :param max_age_s: сколько хранить фразу
+        :param sample: доля всех фраз, попадающих в архив
+        :param sample_hard: доля трудных фраз (см. is_hard), берется вместо sample, если больше
+        :param janitor_interval: период уборки, секунд
+        :param queue_size: сколько фраз может ждать записи (лишние отбрасываются)
+        :param legacy_grace_s: каталоги voice_* моложе этого не трогаем (старый воркер еще пишет)
+        """
+        self.root = pathlib.Path(root)
+        self.archive = self.root / ARCHIVE_DIR
+        self.max_bytes = max_bytes
+        self.max_age = max_age_s
+        self.sample = sample
+        self.sample_hard = sample_hard
+        self.janitor_interval = janitor_interval
+        self.legacy_grace = legacy_grace_s
+        self._queue: "queue.Queue[tuple]" = queue.Queue(maxsize=max(1, queue_size))
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()  # соединение с индексом: поток записи, /stats и CLI
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._next_sweep = 0.0
+        # счетчики для /stats
+        self.archived = 0
+        self.dropped = 0
+        self.evicted = 0
+        self.legacy_removed = 0
+        self.errors = 0
+
+    # ---------- индекс ----------
+    def _index(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.archive.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(str(self.archive / INDEX_NAME), check_same_thread=False,
+                                 isolation_level=None, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(_SCHEMA)
+            self._db = db
+        return self._db
+
+    # ---------- запись ----------
+    def offer(self, audio: AudioBuffer, result: dict, context: Optional[str] = None,
+              terminal: Optional[str] = None) -> bool:
+        """Решает жребием, сохранять ли фразу, и ставит ее в очередь записи; True — поставлена."""
+        hard = is_hard(result)
+        rate = max(self.sample, self.sample_hard) if hard else self.sample
+        if rate <= 0 or (rate < 1 and random.random() >= rate):
+            return False
+        try:
+            self._queue.put_nowait((time.time(), audio, dict(result), context, terminal, hard))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _write(self, created: float, audio: AudioBuffer, result: dict, context: Optional[str],
+               terminal: Optional[str], hard: bool) -> None:
+        uid = uuid.uuid4().hex[:16]
+        rel = f"{time.strftime('%Y%m%d', time.localtime(created))}/{uid}.wav"
+        path = self.archive / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with wave.open(str(path), "wb") as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(audio.rate)
+            wf.writeframes(audio.pcm)
+        size = path.stat().st_size
+        # файл пишется раньше записи в индексе: при падении между ними его уберет уборщик
+        with self._lock:
+            self._index().execute(
+                "INSERT INTO utterances (id, created, path, bytes, duration, terminal, context, engine, decision,"
+                " confidence, text, vosk_text, intent, fields, hard) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                (uid, created, rel, size, round(audio.duration, 3), terminal, context, result.get("engine"),
+                 result.get("decision"), result.get("confidence"), result.get("text"), result.get("vosk_text"),
+                 result.get("intent"), json.dumps(result.get("fields") or {}, ensure_ascii=False), int(hard)),
+            )
+        self.archived += 1
+
+    # ---------- уборка ----------
+    def sweep(self) -> dict:
+        """Один проход уборщика; возвращает, сколько удалено записей, файлов-сирот и старых каталогов."""
+        now = time.time()
+        with self._lock:
+            db = self._index()
+            expired = db.execute("SELECT id, path FROM utterances WHERE created < ?",
+                                 (now - self.max_age,)).fetchall()
+            over = []
+            total = db.execute("SELECT COALESCE(SUM(bytes), 0) FROM utterances WHERE created >= ?",
+                               (now - self.max_age,)).fetchone()[0]
+            if total > self.max_bytes:
+                # сверх бюджета — удаляем самые старые, пока не уложимся
+                for uid, rel, size in db.execute("SELECT id, path, bytes FROM utterances WHERE created >= ?"
+                                                 " ORDER BY created", (now - self.max_age,)):
+                    if total <= self.max_bytes:
+                        break
+                    over.append((uid, rel))
+                    total -= size
+            victims = expired + over
+            if victims:
+                db.executemany("DELETE FROM utterances WHERE id = ?", [(uid,) for uid, _ in victims])
+            known = {row[0] for row in db.execute("SELECT path FROM utterances")}
+            # индекс пишется редкими одиночными вставками — WAL не даем разрастаться до автоконтрольной точки
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        for _, rel in victims:
+            try:
+                (self.archive / rel).unlink()
+            except FileNotFoundError:
+                pass
+        self.evicted += len(victims)
+        orphans = self._remove_orphans(known, now)
+        legacy = self._remove_legacy(now)
+        if victims or orphans or legacy:
+            logger.info("audio store: evicted %d (expired %d), orphans %d, legacy dirs %d",
+                        len(victims), len(expired), orphans, legacy)
+        return {"evicted": len(victims), "expired": len(expired), "orphans": orphans, "legacy": legacy}
+
+    def _remove_orphans(self, known: set, now: float) -> int:
+        removed = 0
+        for day in self.archive.iterdir():
+            if not day.is_dir():
+                continue
+            for path in day.iterdir():
+                rel = f"{day.name}/{path.name}"
+                try:
+                    # свежий файл может быть еще не внесен в индекс (в том числе другим процессом)
+                    if rel not in known and now - path.stat().st_mtime > 60:
+                        path.unlink()
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+            try:
+                day.rmdir()  # только пустой
+            except OSError:
+                pass
+        return removed
+
+    def _remove_legacy(self, now: float) -> int:
+        removed = 0
+        for path in self.root.glob(_LEGACY_PREFIX + "*"):
+            try:
+                if now - path.stat().st_mtime < self.legacy_grace:
+                    continue
+                if path.is_dir():
+                    shutil.rmtree(path)
+                else:
+                    path.unlink()
+                removed += 1
+            except OSError as e:
+                logger.warning("audio store: cannot remove %s: %s", path, e)
+        self.legacy_removed += removed
+        return removed
+
+    # ---------- фоновый поток ----------
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="audio-store", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            now = time.monotonic()
+            if now >= self._next_sweep:
+                self._next_sweep = now + self.janitor_interval
+                try:
+                    self.sweep()
+                except Exception:
+                    self.errors += 1
+                    logger.exception("audio store: sweep failed")
+            try:
+                item = self._queue.get(timeout=min(1.0, max(0.0, self._next_sweep - time.monotonic())))
+            except queue.Empty:
+                continue
+            try:
+                self._write(*item)
+            except Exception:
+                self.errors += 1
+                logger.exception("audio store: cannot archive utterance")
+
+    # ---------- выгрузка и статистика ----------
+    def export(self, output: str, since: Optional[float] = None, hard_only: bool = False,
+               engine: Optional[str] = None, intent: Optional[str] = None, limit: Optional[int] = None) -> int:
+        """Пишет выборку в манифест бенчмарка (JSON Lines); возвращает число строк."""
+        query = "SELECT * FROM utterances WHERE created >= ?"
+        args: list = [since or 0.0]
+        if hard_only:
+            query += " AND hard = 1"
+        if engine:
+            query += " AND engine = ?"
+            args.append(engine)
+        if intent:
+            query += " AND intent = ?"
+            args.append(intent)
+        query += " ORDER BY created"
+        if limit:
+            query += " LIMIT ?"
+            args.append(limit)
+        with self._lock:
+            cursor = self._index().execute(query, args)
+            columns = [c[0] for c in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor]
+        output_path = pathlib.Path(output).resolve()
+        base = output_path.parent
+        with open(output_path, "w", encoding="utf-8") as f:
+            for row in rows:
+                entry = {
+                    "audio": os.path.relpath(self.archive.resolve() / row["path"], base).replace(os.sep, "/"),
+                    "intent": row["intent"],
+                    "fields": json.loads(row["fields"]),
+                    "context": row["context"],
+                    "text": row["text"],
+                    "vosk_text": row["vosk_text"],
+                    "engine": row["engine"],
+                    "decision": row["decision"],
+                    "confidence": row["confidence"],
+                    "terminal": row["terminal"],
+                    "created": row["created"],
+                }
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        return len(rows)
+
+    def stats(self) -> dict:
+        stats = {"archived": self.archived, "dropped": self.dropped, "evicted": self.evicted,
+                 "legacy_removed": self.legacy_removed, "errors": self.errors, "queued": self._queue.qsize(),
+                 "max_bytes": self.max_bytes}
+        if self._db is not None:
+            with self._lock:
+                count, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM utterances").fetchone()
+            stats.update(stored=count, bytes=size)
+        return stats
+
+
+def create_store() -> AudioStore:
+    return AudioStore(
+        settings.tmp_dir,
+        max_bytes=int(settings.audio_store_max_mb * 1024 * 1024),
+        max_age_s=settings.audio_store_max_age_days * 86400,
+        sample=settings.audio_store_sample,
+        sample_hard=settings.audio_store_sample_hard,
+        janitor_interval=settings.audio_store_janitor_interval,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Архив фраз в tmp_dir: уборка и выгрузка в манифест бенчмарка")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="выгрузить выборку в JSON Lines для benchmark --manifest")
+    export.add_argument("output")
+    export.add_argument("--days", type=float, help="только за последние N дней")
+    export.add_argument("--hard", action="store_true", help="только трудные фразы (WhisperX, повтор, Unknown)")
+    export.add_argument("--engine", choices=["vosk", "whisper"])
+    export.add_argument("--intent")
+    export.add_argument("--limit", type=int)
+    commands.add_parser("sweep", help="убрать просроченное и лишнее сейчас")
+    commands.add_parser("stats", help="объем архива")
+    args = parser.parse_args()
+
+    store = create_store()
+    try:
+        if args.command == "export":
+            since = time.time() - args.days * 86400 if args.days else None
+            count = store.export(args.output, since, args.hard, args.engine, args.intent, args.limit)
+            print(f"{count} utterances → {args.output}")
+        elif args.command == "sweep":
+            print(json.dumps(store.sweep(), ensure_ascii=False))
+        else:
+            store._index()
+            print(json.dumps(store.stats(), ensure_ascii=False))
+    finally:
+        store.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,347 @@
+# voice_server/benchmark.py
+"""
+Сквозной бенчмарк и генератор нагрузки для сервера распознавания.
+
+Проигрывает размеченный корпус WAV на работающий сервер (/recognize) с заданной
+конкурентностью и считает по ответам:
+- p50/p95/p99 по этапам из timings_ms сервера (ingest, vosk, parse, whisper,
+  whisper_parse, dispatch, total), по ожиданию в очередях (queue_fast, queue_slow)
+  и по полному времени запроса на клиенте (client); dispatch — только запись
+  команды в журнал, доставка в 1С идет в фоне после ответа и сюда не входит
+  (ее время — voice_stage_seconds{stage="deliver"} в /metrics);
+- пропускную способность, долю фолбэков на WhisperX, точность интентов и полей;
+- отказы (503 при переполнении очереди) и ошибки.
+
+Корпус — JSON Lines, одна фраза в строке (пути — относительно файла корпуса):
+    {"audio": "test1.wav", "intent": "OpenDocumentByNumber", "fields": {"number": "15"}, "context": "document"}
+Поля intent, fields и context необязательны; фразы без intent не входят в точность.
+Без --manifest берутся все test_data/*.wav без разметки.
+
+Каждая распознанная команда сервера уходит в 1С, поэтому бенчмарк запускается
+только против сервера с VOICE_SINK=file, http или poll; приемник com (рабочая
+база 1С) нужно разрешить явно флагом --allow-live-1c. Корпус прогоняется
+несколько раз, и с кэшем распознавания по хешу PCM (VOICE_TRANSCRIPT_CACHE_SIZE)
+все запросы после прогрева — попадания в кэш, а этапы vosk/whisper меряют кэш;
+поэтому сервер с включенным кэшем принимается только с флагом --allow-cache.
+
+Результат пишется в JSON (--output) для сравнения сборок:
+    python -m voice_server.benchmark --manifest corpus.jsonl --concurrency 1 4 16 --output new.json
+    python -m voice_server.benchmark --compare old.json new.json
+"""
+from __future__ import annotations
+import argparse
+import itertools
+import json
+import math
 import os
-import whisperx
+import pathlib
+import platform
+import subprocess
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import requests
+
+_DATA_DIR = pathlib.Path(__file__).parent / "test_data"
+_STAGES = ("ingest", "vosk", "parse", "whisper", "whisper_parse", "dispatch", "total")
+
+
+@dataclass
+class Utterance:
+    audio: bytes
+    name: str
+    intent: Optional[str] = None
+    fields: Optional[dict] = None
+    context: Optional[str] = None
+
+
+@dataclass
+class Sample:
+    """Один запрос: статус, время на клиенте и то, что вернул сервер."""
+    status: int
+    client_ms: float
+    timings: Dict[str, float] = field(default_factory=dict)
+    engine: Optional[str] = None
+    cached: bool = False
+    intent_ok: Optional[bool] = None
+    fields_ok: Optional[bool] = None
+    error: Optional[str] = None
+
+
+def load_manifest(path: Optional[str]) -> List[Utterance]:
+    """Корпус из JSON Lines или, без пути, все WAV из test_data без разметки."""
+    if path is None:
+        return [Utterance(p.read_bytes(), p.name) for p in sorted(_DATA_DIR.glob("*.wav"))]
+    base = pathlib.Path(path).parent
+    corpus = []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            entry = json.loads(line)
+            try:
+                audio = base / entry["audio"]
+            except KeyError:
+                raise ValueError(f"{path}:{line_no}: no 'audio' field") from None
+            corpus.append(Utterance(audio.read_bytes(), entry["audio"], entry.get("intent"),
+                                    entry.get("fields"), entry.get("context")))
+    return corpus
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль по ближайшему рангу (значения уже отсортированы)."""
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def _distribution(values: List[float]) -> dict:
+    values = sorted(values)
+    return {
+        "n": len(values),
+        "mean": round(sum(values) / len(values), 2) if values else 0.0,
+        "p50": round(percentile(values, 50), 2),
+        "p95": round(percentile(values, 95), 2),
+        "p99": round(percentile(values, 99), 2),
+        "max": round(values[-1], 2) if values else 0.0,
+    }
+
+
+def _fields_match(expected: dict, got: dict) -> bool:
+    """Ожидаемые поля есть в ответе с тем же значением (строки — без учета регистра)."""
+    for name, value in expected.items():
+        actual = got.get(name)
+        if isinstance(value, str) and isinstance(actual, str):
+            if value.casefold() != actual.casefold():
+                return False
+        elif str(value) != str(actual):
+            return False
+    return True
+
+
+def _send(session: requests.Session, url: str, utt: Utterance, terminal: str, timeout: float,
+          idempotent: bool) -> Sample:
+    params = {"terminal": terminal}
+    if utt.context:
+        params["context"] = utt.context
+    headers = {"Idempotency-Key": uuid.uuid4().hex} if idempotent else {}
+    started = time.perf_counter()
+    try:
+        resp = session.post(f"{url}/recognize", params=params, headers=headers, timeout=timeout,
+                            files={"file": (pathlib.Path(utt.name).name, utt.audio, "audio/wav")})
+    except requests.RequestException as e:
+        return Sample(0, (time.perf_counter() - started) * 1000, error=type(e).__name__)
+    client_ms = (time.perf_counter() - started) * 1000
+    if resp.status_code != 200:
+        return Sample(resp.status_code, client_ms, error=resp.text[:200])
+    body = resp.json()
+    timings = dict(body.get("timings_ms") or {})
+    for lane, ms in (body.get("queue_wait_ms") or {}).items():
+        timings[f"queue_{lane}"] = ms
+    sample = Sample(200, client_ms, timings, body.get("engine"), bool(body.get("cached")))
+    if utt.intent is not None:
+        sample.intent_ok = body.get("intent") == utt.intent
+        if utt.fields is not None:
+            sample.fields_ok = sample.intent_ok and _fields_match(utt.fields, body.get("fields") or {})
+    return sample
+
+
+def run_load(url: str, corpus: List[Utterance], concurrency: int, total: int, timeout: float = 60.0,
+             idempotent: bool = False) -> dict:
+    """
+    total запросов по корпусу (по кругу) из concurrency потоков; у каждого потока
+    свой терминал и свое keep-alive соединение.
+    """
+    order = itertools.cycle(corpus)
+    lock = threading.Lock()
+    samples: List[Sample] = []
+    remaining = [total]
+
+    def worker(i: int) -> None:
+        terminal = f"bench-{i}"
+        with requests.Session() as session:
+            while True:
+                with lock:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+                    utt = next(order)
+                sample = _send(session, url, utt, terminal, timeout, idempotent)
+                with lock:
+                    samples.append(sample)
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return summarize(samples, concurrency, time.perf_counter() - started)
+
+
+def summarize(samples: List[Sample], concurrency: int, elapsed_s: float) -> dict:
+    ok = [s for s in samples if s.status == 200]
+    stages: Dict[str, List[float]] = {}
+    for s in ok:
+        for stage, ms in s.timings.items():
+            stages.setdefault(stage, []).append(ms)
+    labelled = [s for s in ok if s.intent_ok is not None]
+    with_fields = [s for s in ok if s.fields_ok is not None]
+    errors: Dict[str, int] = {}
+    for s in samples:
+        if s.status != 200:
+            errors[str(s.status)] = errors.get(str(s.status), 0) + 1
+    known = [*_STAGES, *sorted(k for k in stages if k not in _STAGES)]
+    return {
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "ok": len(ok),
+        "rejected": errors.get("503", 0),
+        "errors": errors,
+        "elapsed_s": round(elapsed_s, 3),
+        "throughput_rps": round(len(ok) / elapsed_s, 2) if elapsed_s else 0.0,
+        "fallback_rate": round(sum(s.engine == "whisper" for s in ok) / len(ok), 4) if ok else 0.0,
+        "cache_hit_rate": round(sum(s.cached for s in ok) / len(ok), 4) if ok else 0.0,
+        "intent_accuracy": round(sum(s.intent_ok for s in labelled) / len(labelled), 4) if labelled else None,
+        "fields_accuracy": round(sum(s.fields_ok for s in with_fields) / len(with_fields), 4) if with_fields else None,
+        "labelled": len(labelled),
+        "latency_ms": {
+            "client": _distribution([s.client_ms for s in ok]),
+            **{stage: _distribution(stages[stage]) for stage in known if stage in stages},
+        },
+    }
+
+
+def _build_info() -> dict:
+    """Чем отличаются прогоны: версия кода, окружение."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=pathlib.Path(__file__).parent, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "host": platform.node(),
+            "cpus": os.cpu_count()}
+
+
+def _print_run(run: dict) -> None:
+    acc = run["intent_accuracy"]
+    print(f"\nconcurrency {run['concurrency']}: {run['ok']}/{run['requests']} ok, "
+          f"{run['throughput_rps']} req/s, fallback {run['fallback_rate']:.1%}, "
+          f"accuracy {'n/a' if acc is None else f'{acc:.1%}'}"
+          + (f", errors {run['errors']}" if run["errors"] else ""))
+    print(f"  {'stage':<14}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for stage, d in run["latency_ms"].items():
+        print(f"  {stage:<14}{d['n']:>6}{d['p50']:>10.1f}{d['p95']:>10.1f}{d['p99']:>10.1f}{d['max']:>10.1f}")
+
 
-def main():
-    # 1) Информация о запуске
-    print("Loading Whisper‑medium model (CPU, float32)…")
-    
-    # 2) Загружаем модель WhisperX формата "medium" для CPU
-    #    compute_type="float32" — принудительно используем 32‑битные вычисления,
-    #    иначе на Windows по умолчанию попытка float16 упадёт
-    model = whisperx.load_model("medium", device="cpu", compute_type="float32")
+def compare(old_path: str, new_path: str, threshold: float, min_delta_ms: float = 1.0) -> int:
+    """
+    Сравнивает два файла результатов по одинаковой конкурентности:
+    p95 этапов, пропускная способность и точность. Код возврата 1 — есть регрессия.
+    Рост задержки меньше min_delta_ms регрессией не считается — это шум субмиллисекундных этапов.
+    """
+    with open(old_path, encoding="utf-8") as f:
+        old = {r["concurrency"]: r for r in json.load(f)["runs"]}
+    with open(new_path, encoding="utf-8") as f:
+        new = {r["concurrency"]: r for r in json.load(f)["runs"]}
+    regressions = 0
+    for level in sorted(old.keys() & new.keys()):
+        a, b = old[level], new[level]
+        print(f"\nconcurrency {level}:")
+        rows = [("throughput_rps", a["throughput_rps"], b["throughput_rps"], False)]
+        rows += [(f"{stage} p95", a["latency_ms"][stage]["p95"], b["latency_ms"][stage]["p95"], True)
+                 for stage in a["latency_ms"] if stage in b["latency_ms"]]
+        if a["intent_accuracy"] is not None and b["intent_accuracy"] is not None:
+            rows.append(("intent_accuracy", a["intent_accuracy"], b["intent_accuracy"], False))
+        for name, before, after, lower_is_better in rows:
+            change = (after - before) / before if before else 0.0
+            if lower_is_better:
+                worse = change > threshold and after - before >= min_delta_ms
+            else:
+                worse = change < -threshold
+            regressions += worse
+            print(f"  {name:<22}{before:>10.2f} → {after:<10.2f}{change:>+8.1%}{'  REGRESSION' if worse else ''}")
+    return 1 if regressions else 0
 
-    # 3) Путь до папки с тестовыми аудиофайлами
-    data_dir = os.path.join(os.path.dirname(__file__), "test_data")
 
-    # 4) Проходим по всем файлам в папке test_data
-    for fname in sorted(os.listdir(data_dir)):
-        # — пропускаем всё, что не .wav
-        if not fname.lower().endswith(".wav"):
-            continue
+def server_stats(url: str, timeout: float) -> dict:
+    """Ответ /stats сервера (приемник команд, кэш распознавания); {} — узнать не удалось."""
+    try:
+        resp = requests.get(f"{url}/stats", timeout=timeout)
+        resp.raise_for_status()
+        return resp.json()
+    except (requests.RequestException, ValueError):
+        return {}
 
-        path = os.path.join(data_dir, fname)
-        print(f"\n→ Processing {fname} …")
 
-        # 5) Транскрибируем аудио
-        #    result — это словарь с ключами: 'segments', 'language', и т.п.
-        result = model.transcribe(path)
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="адрес сервера распознавания")
+    parser.add_argument("--manifest", help="корпус JSON Lines (по умолчанию test_data/*.wav без разметки)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4], help="уровни конкурентности")
+    parser.add_argument("--requests", type=int, default=0,
+                        help="запросов на уровень (по умолчанию 5 проходов корпуса)")
+    parser.add_argument("--warmup", type=int, default=1, help="проходов корпуса перед замером")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--idempotent", action="store_true",
+                        help="слать уникальный Idempotency-Key с каждым запросом")
+    parser.add_argument("--output", help="куда записать результаты JSON")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="сравнить два файла результатов вместо прогона")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="допустимое ухудшение при --compare (доля)")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0,
+                        help="рост p95 меньше этого при --compare не считается регрессией")
+    parser.add_argument("--allow-live-1c", action="store_true",
+                        help="разрешить прогон против сервера с VOICE_SINK=com (команды попадут в базу 1С)")
+    parser.add_argument("--allow-cache", action="store_true",
+                        help="разрешить прогон с включенным кэшем распознавания (мерить будет кэш)")
+    args = parser.parse_args()
+    if args.compare:
+        return compare(*args.compare, args.threshold, args.min_delta_ms)
 
-        # 6) Извлекаем распарсенные фрагменты речи
-        #    segments — список словарей, каждый содержит ключ 'text'
-        segments = result.get("segments", [])
+    stats = server_stats(args.url, args.timeout)
+    sink = stats.get("sink", {}).get("sink")
+    if sink not in ("file", "http", "poll") and not args.allow_live_1c:
+        parser.error(f"server sink is {sink or 'unknown'}: every benchmark command would be sent to 1C; "
+                     "run the server with VOICE_SINK=file (or poll) or pass --allow-live-1c")
+    if sink == "com":
+        print("WARNING: sink=com — benchmark commands are written to the live 1C infobase")
+    cache_size = stats.get("transcript_cache", {}).get("max_items")
+    if cache_size != 0 and not args.allow_cache:
+        parser.error(f"server transcript cache size is {cache_size if cache_size is not None else 'unknown'}: "
+                     "after warmup every request would be a cache hit; "
+                     "run the server with VOICE_TRANSCRIPT_CACHE_SIZE=0 or pass --allow-cache")
 
-        # 7) Собираем финальный текст из всех сегментов
-        text = " ".join([seg["text"] for seg in segments]).strip()
+    corpus = load_manifest(args.manifest)
+    if not corpus:
+        parser.error("corpus is empty")
+    total = args.requests or len(corpus) * 5
+    if args.warmup:
+        run_load(args.url, corpus, 1, len(corpus) * args.warmup, args.timeout)
+    report = {
+        "build": _build_info(),
+        "url": args.url,
+        "manifest": args.manifest,
+        "corpus_size": len(corpus),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "runs": [],
+    }
+    for level in args.concurrency:
+        run = run_load(args.url, corpus, level, total, args.timeout, args.idempotent)
+        report["runs"].append(run)
+        _print_run(run)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nresults written to {args.output}")
+    return 0
 
-        # 8) Выводим результат
-        print(f"Result: «{text}»")
 
 # точка входа
 if __name__ == "__main__":
-    main()
+    raise SystemExit(main())
@@ -0,0 +1,75 @@
+# voice_server/benchmark_journal.py
+"""
+Пропускная способность журнала команд.
+
+N потоков одновременно записывают команды (append ждет fsync) и подтверждают
+их, как это делают обработчики /recognize. Сравниваются group commit (одна
+транзакция на пачку операций) и коммит каждой операции по отдельности
+(max_batch=1), затем измеряются компактификация и восстановление при старте.
+
+Запуск: python -m voice_server.benchmark_journal [--commands 5000] [--threads 16]
+"""
+from __future__ import annotations
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from .journal import CommandJournal
+
+
+def _run(path: str, commands: int, threads: int, max_batch: int) -> float:
+    journal = CommandJournal(path, max_batch=max_batch)
+    per_thread = commands // threads
+
+    def worker(t: int) -> None:
+        for i in range(per_thread):
+            command_id = journal.append("OpenDocumentByNumber", {"doc": "ПриходнаяНакладная", "number": f"{t}-{i}"})
+            journal.ack(command_id, "bench")
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    stats = journal.stats()
+    journal.close()
+    print(f"  max_batch={max_batch:<4} {per_thread * threads / elapsed:>9.0f} команд/с, "
+          f"операций на коммит {stats['ops_per_commit']}")
+    return elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--commands", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=16)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{args.commands} команд, {args.threads} потоков, append + ack, synchronous=FULL")
+        _run(os.path.join(tmp, "group.db"), args.commands, args.threads, max_batch=256)
+        _run(os.path.join(tmp, "single.db"), args.commands // 10, args.threads, max_batch=1)
+
+        # восстановление: команды, записанные, но не подтвержденные до «падения» (lease уже истек)
+        path = os.path.join(tmp, "group.db")
+        journal = CommandJournal(path, lease_s=0)
+        for i in range(1000):
+            journal.append("RunReport", {"report": "Остатки", "n": i})
+        journal.close()
+        started = time.perf_counter()
+        journal = CommandJournal(path)
+        recover_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        removed = journal.compact(0)
+        compact_ms = (time.perf_counter() - started) * 1000
+        print(f"восстановление {journal.recovered} команд при старте: {recover_ms:.0f} ms")
+        print(f"компактификация {removed} подтвержденных: {compact_ms:.0f} ms")
+        journal.close()
+
+
+# точка входа
+if __name__ == "__main__":
+    main()
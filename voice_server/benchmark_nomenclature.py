@@ -0,0 +1,101 @@
+# voice_server/benchmark_nomenclature.py
+"""
+Микро-бенчмарк NomenclatureIndex.
+
+Строит индекс по синтетическому каталогу (по умолчанию 100k позиций), ищет
+наименования с типичными ошибками распознавания (пропуск, замена и вставка
+букв) и печатает время поиска, долю найденных на первом месте, время записи
+и загрузки снимка и его размер.
+
+Запуск: python -m voice_server.benchmark_nomenclature [--items 100000]
+"""
+from __future__ import annotations
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from .nomenclature import NomenclatureIndex
+
+_SYLLABLES = ("ка", "ро", "ни", "ла", "мон", "тор", "ви", "зор", "бок", "кан", "тел", "пер", "сте", "лаж",
+              "ри", "фо", "ну", "шка", "дер", "сет", "ско", "бу", "мат", "ли", "кор", "пал", "ле", "та")
+_ATTRS = ("черный", "белый", "большой", "малый", "усиленный", "складной", "прозрачный", "стальной")
+_LETTERS = "абвгдеклмнопрстуя"
+
+
+def _words(n: int, rng: random.Random) -> list[str]:
+    """Словарь из псевдослов: у реальной номенклатуры тысячи разных слов, а не десяток."""
+    return sorted({"".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(n)})
+
+
+def _catalog(n: int, rng: random.Random):
+    goods, brands = _words(n // 50, rng), _words(n // 200, rng)
+    for i in range(n):
+        # наименования 1С обычно содержат модель: «монитор lg 24mk430h черный»
+        model = f"{rng.choice('abcdefghkmnpstx')}{rng.choice('abcdefghkmnpstx')}{rng.randint(10, 9999)}"
+        name = f"{rng.choice(goods)} {rng.choice(brands)} {model} {rng.choice(_ATTRS)}"
+        yield name, f"A{i:06d}", f"46{i:011d}"
+
+
+def _misspell(text: str, rng: random.Random) -> str:
+    chars = list(text)
+    for _ in range(2):
+        pos = rng.randrange(len(chars))
+        op = rng.randrange(3)
+        if op == 0 and len(chars) > 3:
+            del chars[pos]
+        elif op == 1:
+            chars[pos] = rng.choice(_LETTERS)
+        else:
+            chars.insert(pos, rng.choice(_LETTERS))
+    return "".join(chars)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--items", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+    rng = random.Random(args.items)
+
+    catalog = list(_catalog(args.items, rng))
+    started = time.perf_counter()
+    index = NomenclatureIndex()
+    index.add_many(catalog)
+    build_s = time.perf_counter() - started
+
+    picks = [rng.choice(catalog) for _ in range(args.queries)]
+    queries = [_misspell(name, rng) for name, _, _ in picks]
+    started = time.perf_counter()
+    results = [index.search(q, k=5) for q in queries]
+    search_us = (time.perf_counter() - started) / len(queries) * 1e6
+    # одинаковые наименования в каталоге возможны — сравниваем по тексту, не по артикулу
+    top1 = sum(bool(r) and r[0]["name"] == name for r, (name, _, _) in zip(results, picks)) / len(picks)
+    top5 = sum(any(c["name"] == name for c in r) for r, (name, _, _) in zip(results, picks)) / len(picks)
+
+    started = time.perf_counter()
+    for _, article, _ in picks:
+        index.search(article)
+    exact_us = (time.perf_counter() - started) / len(picks) * 1e6
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "nomenclature.idx")
+        started = time.perf_counter()
+        index.save(path)
+        save_s = time.perf_counter() - started
+        started = time.perf_counter()
+        loaded = NomenclatureIndex.load(path)
+        load_s = time.perf_counter() - started
+        size_mb = os.path.getsize(path) / 2**20
+    assert len(loaded) == len(index)
+
+    print(f"позиций: {len(index)}; построение {build_s:.1f} s")
+    print(f"поиск с ошибками: {search_us:.0f} us/запрос, top-1 {top1:.1%}, top-5 {top5:.1%}")
+    print(f"точный артикул/штрихкод: {exact_us:.1f} us/запрос")
+    print(f"снимок: {size_mb:.1f} MB, запись {save_s:.2f} s, загрузка {load_s:.2f} s")
+
+
+# точка входа
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# voice_server/benchmark_parser.py
+"""
+Микро-бенчмарк парсера интентов.
+
+Сравнивает последовательный перебор регулярок (как было раньше) с IntentMatcher
+на синтетическом наборе из сотен интентов, построенных по образцу реальных
+шаблонов (глагол-триггер, корень объекта, хвост (?:\\s+\\w+)*, номер).
+Отдельно проверяет худшие входы для реальных шаблонов — длинные фразы,
+на которых вложенные хвосты могли бы уйти в катастрофический бэктрекинг.
+
+Запуск: python -m voice_server.benchmark_parser [--sizes 10 100 500 1000]
+"""
+from __future__ import annotations
+import argparse
+import random
+import re
+import time
+
+from .nlu import intent_parser
+from .nlu.intent_parser import IntentMatcher
+
+_VERBS = ("покажи", "выведи", "открой", "открыть", "создай", "добавь", "запусти")
+_ALPHABET = "бвгдклмнпрстфхцчшщ"
+
+
+def _stem(i: int) -> str:
+    """Уникальный корень объекта: 'сущ' + номер в «буквенной» системе счисления."""
+    digits = []
+    while True:
+        i, r = divmod(i, len(_ALPHABET))
+        digits.append(_ALPHABET[r])
+        if i == 0:
+            break
+    return "сущ" + "".join(reversed(digits)) + "о"
+
+
+def _build(n: int):
+    """n синтетических интентов: (последовательный список, матчер, примеры фраз)."""
+    rng = random.Random(n)
+    stems = {f"g{i}": _stem(i) for i in range(n)}
+    matcher = IntentMatcher(stems)
+    sequential = []
+    samples = []
+    for i in range(n):
+        verb = _VERBS[i % len(_VERBS)]
+        pattern = re.compile(
+            rf"^(?:{verb})\s+(?:справочн\w*\s+)?(?P<obj>{stems[f'g{i}']}\w*(?:\s+\w+)*?)"
+            rf"(?:\s+номер\s+(?P<number>\d+))?$",
+            re.I,
+        )
+        sequential.append((pattern, f"Intent{i}"))
+        matcher.add(pattern, f"Intent{i}", (verb,), f"g{i}")
+        samples.append(f"{verb} справочник {stems[f'g{i}']}в товаров номер {rng.randint(1, 999)}")
+    # фразы мимо всех интентов: известный глагол + неизвестный объект
+    samples += [f"{rng.choice(_VERBS)} что-то непонятное {k}" for k in range(n // 4 + 1)]
+    rng.shuffle(samples)
+    return sequential, matcher, samples
+
+
+def _sequential_parse(patterns, text: str) -> dict:
+    for pattern, intent in patterns:
+        m = pattern.search(text)
+        if m:
+            return {"intent": intent, "fields": {k: v for k, v in m.groupdict().items() if v}}
+    return {"intent": "Unknown", "fields": {}}
+
+
+def _per_call_us(fn, texts, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for text in texts:
+            fn(text)
+        best = min(best, time.perf_counter() - started)
+    return best / len(texts) * 1e6
+
+
+def bench_scaling(sizes) -> None:
+    print(f"{'intents':>8} {'sequential, us':>15} {'matcher, us':>12} {'speedup':>8}")
+    for n in sizes:
+        sequential, matcher, samples = _build(n)
+        for text in samples:  # результаты обязаны совпадать
+            assert _sequential_parse(sequential, text) == matcher.match(text), text
+        seq_us = _per_call_us(lambda t: _sequential_parse(sequential, t), samples)
+        mat_us = _per_call_us(matcher.match, samples)
+        print(f"{n:>8} {seq_us:>15.1f} {mat_us:>12.1f} {seq_us / mat_us:>7.1f}x")
+
+
+def bench_worst_case() -> None:
+    """Длинные фразы, которые почти совпадают с реальными шаблонами."""
+    print(f"\n{'words':>8} {'parse, us':>12}  (реальные шаблоны, без кэша)")
+    match = intent_parser._matcher.match
+    for words in (10, 50, 200, 1000):
+        text = "покажи приходная " + " ".join(["накладная"] * words) + " номер x"
+        print(f"{words:>8} {_per_call_us(match, [text], repeat=5):>12.1f}")
+
+
+def bench_cache() -> None:
+    texts = ["покажи справочник номенклатура", "открой документ приходная накладная номер 12",
+             "запусти отчёт остатки номенклатуры", "что-то непонятное"]
+    intent_parser._parse_cached.cache_clear()
+    cold = _per_call_us(intent_parser._matcher.match, texts)
+    intent_parser.parse(texts[0])
+    warm = _per_call_us(intent_parser.parse, texts)
+    print(f"\nреальные шаблоны: matcher {cold:.1f} us, parse() с LRU-кэшем {warm:.1f} us")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500, 1000])
+    args = parser.parse_args()
+    bench_scaling(args.sizes)
+    bench_worst_case()
+    bench_cache()
+
+
+# точка входа
+if __name__ == "__main__":
+    main()
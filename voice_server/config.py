@@ -1,4 +1,6 @@
 # voice_server/config.py
+from typing import Literal, Optional
+
 from pydantic_settings import BaseSettings
 
 
@@ -6,12 +8,122 @@ class Settings(BaseSettings):
     # домены, которым разрешён CORS-доступ
     cors_origins: str = "*"
 
-    # каталог для временных WAV-файлов
+    # каталог хранилища аудио: выборка фраз (archive/) с индексом; уборщик держит его в бюджете
     tmp_dir: str = "temp_audio"
+    audio_store_max_mb: float = 512.0          # предел объема архива
+    audio_store_max_age_days: float = 14.0     # фразы старше удаляются
+    audio_store_sample: float = 0.0            # доля всех фраз, сохраняемых в архив
+    audio_store_sample_hard: float = 0.2       # доля трудных (WhisperX, «повторите», Unknown)
+    audio_store_janitor_interval: float = 300.0  # период уборки, секунд
+
+    # размер LRU-кэша «нормализованный текст → интент»
+    intent_cache_size: int = 4096
+    # выгрузка имен метаданных 1С (JSON-список или по имени в строке) для MetadataMapper
+    metadata_names_path: Optional[str] = None
+    # выгрузка номенклатуры (CSV: наименование;артикул;штрихкод) и ее снимок для быстрого старта
+    nomenclature_path: Optional[str] = None
+    nomenclature_snapshot: Optional[str] = None
+    nomenclature_min_score: float = 0.5   # ниже — совпадение не передается в 1С (поля nomenclature_*)
+
+    # журнал команд на диске (SQLite WAL): доставка «хотя бы один раз» с повторами
+    journal_path: str = "commands.db"
+    journal_lease: float = 60.0          # через сколько незавершенная доставка считается потерянной, секунд
+    journal_retry_base: float = 1.0      # первая задержка повтора (далее удваивается с разбросом)
+    journal_retry_cap: float = 300.0     # максимальная задержка повтора
+    journal_retention: float = 3600.0    # сколько хранить доставленные команды до компактификации
+
+    # доставка через /intent: долгий опрос и SSE
+    intent_wait_max: float = 60.0     # дольше этого запрос /intent?wait= не держится, секунд
+    intent_batch_max: int = 100       # максимум команд в одном ответе
+    intent_recheck: float = 1.0       # перечитывать журнал во время ожидания (команды других процессов)
+    intent_keepalive: float = 15.0    # пинг SSE при отсутствии команд, секунд
 
+    # кэш распознавания по хешу PCM: размер (0 — выключен), TTL и файл SQLite для перезапусков
+    transcript_cache_size: int = 1024
+    transcript_cache_ttl: float = 600.0
+    transcript_cache_path: Optional[str] = None
+    idempotency_ttl: float = 600.0   # сколько помнить ответы на запросы с Idempotency-Key, секунд
+    idempotency_wait: float = 120.0  # сколько повтор ждет ответа первого запроса (затем 503), секунд
+
+    # доставка команд: "com" — 1С через V83.COMConnector, "file"/"http" — заменители для тестов без 1С
+    # "poll" — сервер сам не отправляет: 1С забирает команды долгим опросом /intent или SSE
+    sink: Literal["com", "file", "http", "poll"] = "com"
+    onec_infobase: str = r'File="C:\Users\elozo\OneDrive\Документы\InfoBase7"'
+    onec_connections: int = 1           # долгоживущих соединений (потоков доставки)
+    onec_batch_method: Optional[str] = None  # экспортный метод 1С, принимающий JSON-массив команд
+    onec_health_interval: float = 60.0  # простой, после которого соединение проверяется, секунд
+    sink_batch_size: int = 16           # сколько команд можно отправить одной пачкой
+    sink_batch_wait_ms: float = 20.0    # сколько ждать добора пачки
+    sink_timeout: float = 30.0          # дольше доставку не ждем — команда остается в журнале для повтора
+    sink_file_path: str = "commands.jsonl"
+    sink_http_url: str = "http://127.0.0.1:8090/commands"
+
+    # контексты диалога: JSON {"контекст": {"intents": [...], "phrases": [...]}} поверх встроенных
+    grammar_contexts_path: Optional[str] = None
+
+    # модели: путь к Vosk, размер и устройство WhisperX
+    vosk_model_path: str = r"C:\vosk\vosk-model-small-ru-0.22"
     voicemodel: str = "small"
     device: str = "cpu"
 
+    # где живут модели: "local" — в каждом HTTP-процессе, "remote" — в общем сервере инференса
+    inference_mode: Literal["local", "remote"] = "local"
+    inference_address: str = "127.0.0.1:8765"  # host:port, путь Unix-сокета или \\.\pipe\имя
+    inference_authkey: Optional[str] = None    # общий секрет канала; обязателен в режиме remote
+    inference_threads: int = 0                 # потоков BLAS/torch у сервера инференса (0 — по умолчанию)
+
+    # пул распознавания: число потоков, глубина очередей и слоты для WhisperX
+    workers: int = 4
+    queue_depth: int = 32           # максимум ожидающих задач Vosk
+    whisper_queue_depth: int = 8    # максимум ожидающих фолбэков WhisperX
+    whisper_slots: int = 3          # сколько потоков одновременно могут занимать WhisperX
+    retry_after: int = 1            # значение заголовка Retry-After при 503, секунд
+    terminal_queue_depth: int = 4   # максимум ожидающих задач одного терминала в полосе (0 — без лимита)
+    max_terminals: int = 1024       # для скольких последних терминалов хранить статистику
+
+    # потоковое распознавание (/recognize/stream): предел длины фразы и простоя между фреймами
+    stream_max_seconds: float = 30.0   # длиннее — поток закрывается с ошибкой
+    stream_idle_timeout: float = 10.0  # столько без фреймов — поток закрывается, секунд
+
+    # заголовок Server-Timing в ответе /recognize (время этапов для DevTools и прокси)
+    server_timing: bool = False
+
+    # профилирование по запросу (/admin/profile); без токена админка доступна только с localhost
+    admin_token: Optional[str] = None
+    profile_max_seconds: float = 300.0   # предел длительности одной сессии профилирования
+
+    # логирование: запись через очередь фоновым потоком, JSON с request_id, ротация по размеру
+    log_file: str = "voice_server.log"   # пустая строка — без файла
+    log_format: Literal["json", "text"] = "json"
+    log_console: bool = True
+    log_level: str = "INFO"
+    # уровни отдельных логгеров: "имя=УРОВЕНЬ,..." (по умолчанию глушим DEBUG сторонних библиотек)
+    log_levels: str = ("multipart=WARNING,python_multipart=WARNING,urllib3=WARNING,numba=WARNING,"
+                       "speechbrain=WARNING,pyannote=WARNING,faster_whisper=WARNING,matplotlib=WARNING")
+    log_sampling: str = ""               # "имя=доля,...": доля сохраняемых записей ниже WARNING
+    # size — ротация по размеру самим сервером (у каждого воркера uvicorn --workers свой файл .<pid>);
+    # external — общий файл, ротацию делает logrotate и т.п. (WatchedFileHandler переоткрывает файл)
+    log_rotation: Literal["size", "external"] = "size"
+    log_max_bytes: int = 10 * 1024 * 1024
+    log_backups: int = 5
+    log_queue_size: int = 10000          # при переполнении записи ниже WARNING отбрасываются
+
+    # микро-батчинг WhisperX: размер пачки и время ее добора; пачка не больше числа одновременных
+    # фолбэков (whisper_slots + спекуляции), 0 — ровно по нему
+    whisper_batch_size: int = 0
+    whisper_batch_wait_ms: float = 30.0
+
+    # политика выбора движка по средней уверенности слов Vosk
+    vosk_accept_confidence: float = 0.90   # выше — WhisperX не запускается
+    vosk_reject_confidence: float = 0.50   # ниже — low_confidence_action
+    low_confidence_action: Literal["whisper", "repeat"] = "whisper"
+
+    # спекулятивный запуск WhisperX параллельно с Vosk (по умолчанию выключен)
+    speculative_whisper: bool = False
+    speculative_min_duration: float = 3.0   # фраза длиннее, с — вероятно вне грамматики
+    speculative_max_snr_db: float = 12.0    # шумнее — Vosk вероятно ошибется
+    speculative_max_inflight: int = 1       # бюджет CPU на одновременные спекуляции
+
     class Config:
         env_prefix = "VOICE_"      # можно переопределять переменными окружения
 
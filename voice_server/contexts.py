@@ -0,0 +1,107 @@
+# voice_server/contexts.py
+"""
+Грамматики Vosk по контексту диалога.
+
+Общая грамматика (grammar.json) подходит для любого экрана, но когда оператор
+уже открыл документ, осмысленна лишь малая часть команд. Контекст — это набор
+интентов: фразы grammar.json разбираются тем же парсером, что и ответы Vosk,
+и в грамматику контекста попадают только фразы его интентов (плюс свои фразы
+из файла контекстов и [unk] для речи вне грамматики). Фразы, которые парсер
+пока не понимает, относятся к контексту по группе корней объекта. Меньшая грамматика
+декодируется быстрее и реже превращает посторонние фразы в Unknown, уводящий
+запрос на WhisperX.
+"""
+from __future__ import annotations
+import json
+import pathlib
+from functools import lru_cache
+from typing import Dict, Iterable, List
+
+from .config import settings
+from .nlu.intent_parser import parse, stem_groups
+from .recognizer_pool import grammar_version
+
+DEFAULT_CONTEXT = "default"  # полная грамматика grammar.json
+# Файл grammar.json, в котором описаны правила грамматики для Vosk
+GRAMMAR_PATH = pathlib.Path(__file__).parent / "grammar.json"
+
+# контекст → интенты, группы корней и дополнительные фразы;
+# дополняется файлом VOICE_GRAMMAR_CONTEXTS_PATH
+_BUILTIN: Dict[str, dict] = {
+    "catalog": {"intents": ["OpenCatalogList", "OpenCatalogByCode", "OpenCatalogByName", "CreateCatalog"],
+                "groups": ["catalog"]},
+    "document": {"intents": ["OpenDocumentList", "OpenDocumentByNumber", "CreateDocument"],
+                 "groups": ["doc"]},
+    "report": {"intents": ["RunReport", "OpenInfoRegister"], "groups": ["report", "reg"]},
+}
+
+
+class UnknownContext(ValueError):
+    """Клиент передал контекст, для которого нет грамматики."""
+
+    def __init__(self, context: str) -> None:
+        super().__init__(f"unknown grammar context {context!r}")
+        self.context = context
+
+
+def _load_contexts() -> Dict[str, dict]:
+    contexts = {name: dict(spec) for name, spec in _BUILTIN.items()}
+    if settings.grammar_contexts_path:
+        text = pathlib.Path(settings.grammar_contexts_path).read_text(encoding="utf-8-sig")
+        contexts.update(json.loads(text))
+    return contexts
+
+
+_contexts = _load_contexts()
+
+
+def names() -> List[str]:
+    return [DEFAULT_CONTEXT, *_contexts]
+
+
+def resolve(context: str | None) -> str:
+    """Имя контекста для запроса (None или пусто — общая грамматика)."""
+    if not context:
+        return DEFAULT_CONTEXT
+    if context != DEFAULT_CONTEXT and context not in _contexts:
+        raise UnknownContext(context)
+    return context
+
+
+def _keys_of(phrase: str) -> List[str]:
+    """Интент фразы, а если парсер ее не понимает — группы корней объекта."""
+    # (*) в grammar.json — место для кода/номера; для разбора подставляем число
+    intent = parse(phrase.replace("(*)", "1"))["intent"]
+    if intent != "Unknown":
+        return [intent]
+    return [f"group:{g}" for g in stem_groups(phrase)]
+
+
+def build_grammars(phrases: Iterable[str]) -> Dict[str, List[str]]:
+    """Список фраз Vosk для каждого контекста, включая общий."""
+    phrases = list(phrases)
+    by_key: Dict[str, List[str]] = {}
+    for phrase in phrases:
+        for key in _keys_of(phrase):
+            by_key.setdefault(key, []).append(phrase)
+    grammars = {DEFAULT_CONTEXT: phrases}
+    for name, spec in _contexts.items():
+        keys = [*spec.get("intents", []), *(f"group:{g}" for g in spec.get("groups", []))]
+        selected = [p for key in keys for p in by_key.get(key, [])]
+        selected += spec.get("phrases", [])
+        # [unk] — речь вне контекста распознается как «неизвестно», а не подгоняется под команду
+        grammars[name] = list(dict.fromkeys(selected)) + ["[unk]"]
+    return grammars
+
+
+@lru_cache(maxsize=None)
+def grammars() -> Dict[str, str]:
+    """JSON-грамматика KaldiRecognizer для каждого контекста (grammar.json читается один раз)."""
+    with GRAMMAR_PATH.open(encoding="utf-8") as f:
+        phrases = json.load(f)
+    return {name: json.dumps(p) for name, p in build_grammars(phrases).items()}
+
+
+def version(context: str) -> str:
+    """Версия грамматики контекста — меняется при правке grammar.json или файла контекстов."""
+    return grammar_version(grammars()[context])
@@ -3,85 +3,191 @@ from __future__ import annotations  # Поддержка аннотаций ти
 import json  # Для работы с JSON (грамматика Vosk и результат WhisperX)
 import logging  # Для логирования работы модуля
 import pathlib  # Для удобной работы с путями файловой системы
-import wave  # Для чтения WAV-файлов
 import re  # Для очистки и нормализации текста
+import threading  # Бюджет спекулятивных запусков WhisperX
+import time  # Время этапов распознавания (timings_ms в ответе)
+import weakref  # Привязка спекулятивного WhisperX к аудиобуферу
+from concurrent.futures import Future  # Результат спекулятивного WhisperX
 
 from vosk import Model as VoskModel, KaldiRecognizer  # Vosk для быстрого CTC-распознавания
 import whisperx  # WhisperX для более точного, но медленного распознавания
 
+from .audio_io import AudioBuffer, TARGET_RATE, read_file  # Аудио в памяти: PCM s16le 16 kHz моно
+from .config import settings  # Пути и параметры моделей, размеры пулов
+from .models import ModelManager  # Фоновая загрузка и прогрев моделей
+from . import metrics  # Гистограммы этапов и счетчики для /metrics
+from . import contexts  # Грамматики Vosk по контексту диалога
+from . import nomenclature  # Нечеткий поиск распознанных наименований по номенклатуре
+from .policy import (  # Политика выбора движка по уверенности Vosk
+    DECISION_VOSK, DECISION_WHISPER, DECISION_REPEAT, decide, needs_fallback,
+)
+from .recognizer_pool import RecognizerPool  # Пул готовых KaldiRecognizer
+from .whisper_batcher import WhisperBatcher  # Сбор одновременных фолбэков в пачки
 from .nlu.intent_parser import parse_and_enrich as parse_intent  # Наш парсер интентов и полей из текста
+from .nlu.intent_parser import has_intent_prefix  # Ранняя проверка промежуточных гипотез
 
 # --- Настройка логирования --------------------------------
-# Получаем логгер текущего модуля по его __name__
+# Получаем логгер текущего модуля по его __name__; вывод настраивает logging_setup
 logger = logging.getLogger(__name__)
-# Создаем обработчик для вывода логов в консоль (терминал)
-console_handler = logging.StreamHandler()
-# Уровень вывода логов в консоль
-console_handler.setLevel(logging.DEBUG)
-# Формат сообщения (время, уровень, имя логгера, сообщение)
-console_formatter = logging.Formatter(
-    "%(asctime)s [%(levelname)s] %(name)s: %(message)s"
-)
-console_handler.setFormatter(console_formatter)
-# Добавляем консольный обработчик к логгеру
-logger.addHandler(console_handler)
 # -----------------------------------------------------------
 
 # ---------- Пути к моделям и файлам ----------
-# Путь к папке с моделью Vosk (модель ru small)
-_VOSK_PATH = pathlib.Path(r"C:\vosk\vosk-model-small-ru-0.22")
-# Путь к файлу grammar.json, в котором описаны правила грамматики для Vosk
-_GRAMMAR_PATH = pathlib.Path(__file__).with_suffix("").parent / "grammar.json"
+# Путь к папке с моделью Vosk (модель ru small), переопределяется VOICE_VOSK_MODEL_PATH
+_VOSK_PATH = pathlib.Path(settings.vosk_model_path)
+# Тестовые фразы для прогрева моделей
+_WARMUP_DIR = pathlib.Path(__file__).parent / "test_data"
+# Частота дискретизации потокового режима (WhisperX ожидает именно 16 kHz)
+STREAM_RATE = TARGET_RATE
+
+# Модели грузятся в фоне после старта сервера (model_manager.start()), а не при импорте
+model_manager = ModelManager()
 
 # ---------- Загрузка модели Vosk ----------
-logger.info("Loading Vosk model from %s …", _VOSK_PATH)
-# Создаем экземпляр модели Vosk
-_vosk_model = VoskModel(str(_VOSK_PATH))
-# Загружаем грамматику из JSON в строку для передачи KaldiRecognizer
-with _GRAMMAR_PATH.open(encoding="utf-8") as f:
-    _grammar = json.dumps(json.load(f))
-
-
-def _recognize_vosk(wav: pathlib.Path) -> str:
-    """Быстрое CTC-распознавание через Vosk с применением заданной grammar."""
-    # Открываем WAV-файл для чтения
-    with wave.open(str(wav), "rb") as wf:
-        # Инициализируем распознаватель с моделью, частотой дискретизации и грамматикой
-        rec = KaldiRecognizer(_vosk_model, wf.getframerate(), _grammar)
-        rec.SetWords(True)  # Включаем возвращение слов и метаинформации
-        # Считываем аудиопоток порциями
-        while True:
-            data = wf.readframes(4000)
-            if not data:
-                break
-            rec.AcceptWaveform(data)  # Передаем порцию аудио в распознаватель
+def _load_vosk() -> VoskModel:
+    logger.info("Loading Vosk model from %s …", _VOSK_PATH)
+    # Создаем экземпляр модели Vosk
+    return VoskModel(str(_VOSK_PATH))
+
+
+def _new_recognizer(rate: int, grammar: str) -> KaldiRecognizer:
+    """Создает KaldiRecognizer с грамматикой и включенным выводом слов."""
+    rec = KaldiRecognizer(model_manager.get("vosk"), rate, grammar)
+    rec.SetWords(True)  # Включаем возвращение слов и метаинформации
+    return rec
+
+
+# Пул готовых распознавателей: грамматика компилируется один раз на экземпляр
+recognizer_pool = RecognizerPool(_new_recognizer, max_idle=settings.workers)
+# Грамматики grammar.json по контекстам диалога (JSON-строки для KaldiRecognizer) и их версии — ключи пула
+CONTEXT_GRAMMARS = {name: recognizer_pool.register_grammar(g) for name, g in contexts.grammars().items()}
+GRAMMAR_VERSION = CONTEXT_GRAMMARS[contexts.DEFAULT_CONTEXT]
+
+
+def grammar_for(context: str | None) -> str:
+    """Версия грамматики контекста; :raises contexts.UnknownContext: контекст не описан."""
+    return CONTEXT_GRAMMARS[contexts.resolve(context)]
+
+
+def _vosk_confidence(words: list) -> float:
+    """Оценка гипотезы Vosk: средняя уверенность по словам (0 — слов нет)."""
+    if not words:
+        return 0.0
+    return sum(w.get("conf", 0.0) for w in words) / len(words)
+
+
+def _recognize_vosk(audio: AudioBuffer, version: str = GRAMMAR_VERSION) -> tuple[str, float]:
+    """Быстрое CTC-распознавание через Vosk с применением заданной grammar: (текст, уверенность)."""
+    # Берем из пула готовый распознаватель для этой частоты и грамматики
+    with recognizer_pool.checkout(audio.rate, version) as rec:
+        # Передаем аудио порциями по 4000 отсчетов
+        for data in audio.chunks():
+            rec.AcceptWaveform(data)
         # Получаем финальный результат в виде JSON строки
         result = json.loads(rec.FinalResult())
-        raw = result.get("text", "")  # Извлекаем текст
-    # Очищаем и нормализуем текст перед возвратом
-    return clean_text(raw)
+    raw = result.get("text", "")  # Извлекаем текст
+    # Очищаем и нормализуем текст, слова с conf идут в оценку уверенности
+    return clean_text(raw), _vosk_confidence(result.get("result", []))
 
 # ---------- Загрузка и настройка WhisperX ----------
-_MODEL_NAME = "small"    # Название модели: tiny | base | small | medium | large
-_DEVICE     = "cpu"       # Устройство: 'cpu' или 'cuda' для GPU
-logger.info("Loading WhisperX model %s on %s (int8)…", _MODEL_NAME, _DEVICE)
-# Загружаем модель WhisperX с низкой точностью int8 для экономии памяти
-_wh_model = whisperx.load_model(_MODEL_NAME, device=_DEVICE, compute_type="int8")
+_MODEL_NAME = settings.voicemodel  # Название модели: tiny | base | small | medium | large
+_DEVICE     = settings.device      # Устройство: 'cpu' или 'cuda' для GPU
 
 
-def _recognize_whisper(wav: pathlib.Path) -> str:
-    """Более точное, но медленное распознавание через WhisperX."""
-    # Запускаем транскрипцию через WhisperX
-    result = _wh_model.transcribe(str(wav), language="ru")
-    logger.debug("WhisperX output: %s", result)  # Логируем подробности
-    # Извлекаем текст из сегментов, если они есть
+def _load_whisper():
+    logger.info("Loading WhisperX model %s on %s (int8)…", _MODEL_NAME, _DEVICE)
+    # Загружаем модель WhisperX с низкой точностью int8 для экономии памяти;
+    # язык задаем сразу, чтобы токенизатор был готов и для батчированного вызова
+    return whisperx.load_model(_MODEL_NAME, device=_DEVICE, compute_type="int8", language="ru")
+
+
+def _whisper_text(result: dict) -> str:
+    """Извлекаем текст из сегментов ответа WhisperX, если они есть."""
     if "segments" in result:
-        raw = " ".join(seg["text"] for seg in result["segments"])
-    else:
-        raw = result.get("text", "")
+        return " ".join(seg["text"] for seg in result["segments"])
+    return result.get("text", "")
+
+
+def _whisper_batch(batch: list) -> list:
+    """
+    Распознает несколько фраз одним проходом модели.
+    Команды короче 30 s, поэтому каждая фраза — один вход пайплайна без VAD-нарезки.
+    Одиночная фраза идет тем же вызовом, что и пачка: текст не зависит от того,
+    с кем фраза попала в пачку.
+    """
+    wh_model = model_manager.get("whisper")
+    try:
+        outputs = wh_model(({"inputs": audio} for audio in batch), batch_size=len(batch))
+        texts = []
+        for out in outputs:
+            text = out["text"]
+            texts.append(text[0] if isinstance(text, list) else text)
+        # только текст: полный ответ WhisperX с сегментами раздувал лог на каждом фолбэке
+        logger.debug("WhisperX output (batch of %d): %r", len(batch), texts)
+        return texts
+    except Exception:
+        # батчированный вызов не поддержан этой версией пайплайна — распознаем по одной
+        logger.exception("Batched WhisperX call failed, falling back to sequential")
+        return [_whisper_text(wh_model.transcribe(audio, language="ru")) for audio in batch]
+
+
+def _whisper_batch_limit() -> int:
+    """
+    Размер пачки: больше фраз, чем может одновременно ждать WhisperX (слоты полосы SLOW
+    и спекуляции), не соберется — такая пачка каждый раз ждала бы добора до конца.
+    """
+    concurrent = settings.whisper_slots + (settings.speculative_max_inflight if settings.speculative_whisper else 0)
+    return min(settings.whisper_batch_size, concurrent) if settings.whisper_batch_size > 0 else concurrent
+
+
+# Пачки формируются в отдельном потоке, вызывающие потоки ждут свой результат
+whisper_batcher = WhisperBatcher(
+    _whisper_batch,
+    max_batch=_whisper_batch_limit(),
+    max_wait_ms=settings.whisper_batch_wait_ms,
+)
+
+
+def _recognize_whisper(audio: AudioBuffer) -> str:
+    """Более точное, но медленное распознавание через WhisperX."""
+    # Ставим буфер в очередь батчера и ждем текст своей фразы
+    raw = whisper_batcher.transcribe(audio.float32)
     # Очищаем и нормализуем текст перед возвратом
     return clean_text(raw)
 
+# ---------- Прогрев моделей ----------
+def _warmup_audio() -> list:
+    return [read_file(p) for p in sorted(_WARMUP_DIR.glob("*.wav"))]
+
+
+def _warm_vosk() -> None:
+    """Собирает пул распознавателей и прогоняет тестовые фразы через быстрый путь."""
+    # грамматики всех контекстов компилируются до трафика
+    for version in dict.fromkeys(CONTEXT_GRAMMARS.values()):
+        recognizer_pool.prewarm(TARGET_RATE, version)
+    for audio in _warmup_audio():
+        _recognize_vosk(audio)
+
+
+def _warm_whisper() -> None:
+    """Первый вызов WhisperX заметно медленнее остальных — делаем его до трафика."""
+    samples = _warmup_audio()[:1]
+    if samples:
+        _whisper_batch([samples[0].float32])
+
+
+def _load_nomenclature() -> nomenclature.NomenclatureIndex:
+    logger.info("Loading nomenclature from %s …", settings.nomenclature_path)
+    return nomenclature.activate(
+        nomenclature.load_index(settings.nomenclature_path, settings.nomenclature_snapshot)
+    )
+
+
+# Порядок важен: сначала быстрый путь, затем WhisperX
+model_manager.register("vosk", _load_vosk, _warm_vosk)
+if settings.nomenclature_path:
+    model_manager.register("nomenclature", _load_nomenclature)
+model_manager.register("whisper", _load_whisper, _warm_whisper)
+
 # ---------- Очистка и нормализация текста ----------
 def clean_text(text: str) -> str:
     """
@@ -93,25 +199,288 @@ def clean_text(text: str) -> str:
     norm    = re.sub(r'\s+', ' ', no_punct).strip()
     return norm.lower()
 
+# ---------- Спекулятивный запуск WhisperX ----------
+class Speculation:
+    """
+    WhisperX, запущенный параллельно с Vosk, когда дешевые признаки (длина фразы,
+    SNR, промежуточная гипотеза без начала команды) предсказывают фолбэк.
+    Если Vosk уверенно дал известный интент, задача отменяется (или ее результат отбрасывается).
+    """
+
+    # бюджет CPU: сколько спекулятивных WhisperX может выполняться одновременно
+    _slots = threading.BoundedSemaphore(max(1, settings.speculative_max_inflight))
+    _lock = threading.Lock()
+    _stats = {"started": 0, "used": 0, "cancelled": 0, "skipped_budget": 0}
+
+    def __init__(self, future: Future) -> None:
+        self._future = future
+
+    @classmethod
+    def _count(cls, key: str) -> None:
+        with cls._lock:
+            cls._stats[key] += 1
+
+    @classmethod
+    def start(cls, audio: AudioBuffer, reason: str) -> "Speculation | None":
+        """Запускает WhisperX, если есть свободный слот и очередь батчера не перегружена."""
+        if not model_manager.available("whisper"):
+            return None
+        if whisper_batcher.stats()["queued"] >= whisper_batcher.max_batch or not cls._slots.acquire(blocking=False):
+            cls._count("skipped_budget")
+            return None
+        future = whisper_batcher.submit(audio.float32)
+        future.add_done_callback(lambda _: cls._slots.release())
+        cls._count("started")
+        logger.debug("Speculative WhisperX started (%s)", reason)
+        return cls(future)
+
+    def cancel(self) -> None:
+        """Vosk справился сам: снимаем задачу с очереди или игнорируем ее результат."""
+        self._future.cancel()
+        self._count("cancelled")
+
+    def result(self) -> str:
+        self._count("used")
+        return self._future.result()
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._lock:
+            return {"enabled": settings.speculative_whisper, **cls._stats}
+
+
+# спекулятивные задачи, привязанные к аудио, — их подхватывает transcribe_fallback
+_speculations: "weakref.WeakKeyDictionary[AudioBuffer, Speculation]" = weakref.WeakKeyDictionary()
+
+
+def _speculation_reason(audio: AudioBuffer, partial_ok: bool = True) -> str | None:
+    """Дешевые признаки будущего фолбэка; None — спекулировать не нужно."""
+    if not settings.speculative_whisper:
+        return None
+    if not partial_ok:
+        return "partial"
+    if audio.duration >= settings.speculative_min_duration:
+        return "duration"
+    if audio.snr_db() <= settings.speculative_max_snr_db:
+        return "snr"
+    return None
+
+
+def _maybe_speculate(audio: AudioBuffer, partial_ok: bool = True) -> None:
+    reason = _speculation_reason(audio, partial_ok)
+    if reason is not None:
+        spec = Speculation.start(audio, reason)
+        if spec is not None:
+            _speculations[audio] = spec
+
+
+def _settle_speculation(audio: AudioBuffer, result: dict) -> None:
+    """После решения политики: отменяем ненужную спекуляцию."""
+    if not needs_fallback(result):
+        spec = _speculations.pop(audio, None)
+        if spec is not None:
+            spec.cancel()
+
+
 # ---------- Публичный API модуля ----------
-def transcribe_and_parse(wav_path: pathlib.Path) -> dict:
+def _ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 2)
+
+
+def _observe(timings: dict) -> None:
+    """Время этапов из timings_ms — в гистограммы /metrics."""
+    for stage, ms in timings.items():
+        metrics.STAGE_SECONDS.observe(ms / 1000, stage)
+
+
+def _parse_vosk(text: str, confidence: float, vosk_ms: float) -> dict:
     """
-    Выполняет транскрипцию аудио и парсинг интента.
-    1) Сначала Vosk+grammar — быстрый режим.
-    2) Если интент неизвестен, переходит на WhisperX — точный режим.
+    Парсинг текста Vosk в ответ быстрого пути с решением политики.
+    В timings_ms ответа — время Vosk и парсинга, мс.
     """
-    # 1) Быстрое распознавание через Vosk
-    text = _recognize_vosk(wav_path)
-    # Первичный парсинг интента
+    started = time.perf_counter()
     intent_data = parse_intent(text)
-    logger.debug("Parsed intent from Vosk: %s", intent_data)
-    # Если интент понятен, возвращаем результат сразу
-    if intent_data.get("intent") != "Unknown":
-        return {"text": text, "engine": "vosk", **intent_data}
-
-    # 2) Переходим к медленному, но точному WhisperX
-    logger.info("Vosk не распознал intent, используем WhisperX")
-    text = _recognize_whisper(wav_path)
+    decision = decide(intent_data["intent"], confidence)
+    logger.debug("Parsed intent from Vosk: %s (conf=%.3f, decision=%s)", intent_data, confidence, decision)
+    extra = {}
+    if decision == DECISION_WHISPER:
+        reason = "low_confidence" if confidence < settings.vosk_reject_confidence else "unknown_intent"
+        if not model_manager.available("whisper"):
+            # WhisperX еще загружается — отдаем то, что понял Vosk, и помечаем это в ответе
+            decision, extra, reason = DECISION_VOSK, {"fallback_unavailable": True}, "whisper_unavailable"
+        metrics.FALLBACKS.inc(reason)
+    if decision == DECISION_REPEAT:
+        intent_data = {"intent": "Unknown", "fields": {}}
+    timings = {"vosk": vosk_ms, "parse": _ms(started)}
+    _observe(timings)
+    return {
+        "text": text, "engine": "vosk", **intent_data,
+        "confidence": round(confidence, 3), "decision": decision, **extra,
+        "timings_ms": timings,
+    }
+
+
+def transcribe_fast(audio: AudioBuffer, context: str | None = None) -> dict:
+    """
+    Быстрый путь: Vosk+grammar и парсинг интента (со спекулятивным WhisperX, если включен).
+    :param context: контекст диалога — определяет грамматику Vosk (None — общая)
+    """
+    version = grammar_for(context)
+    _maybe_speculate(audio)
+    started = time.perf_counter()
+    text, confidence = _recognize_vosk(audio, version)
+    result = _parse_vosk(text, confidence, _ms(started))
+    _settle_speculation(audio, result)
+    return result
+
+
+def transcribe_fallback(audio: AudioBuffer, fast: dict | None = None) -> dict:
+    """
+    Медленный, но точный путь: WhisperX и парсинг интента.
+    :param fast: результат быстрого пути — из него переносятся уверенность и решение
+    """
+    logger.info("Vosk не распознал intent уверенно, используем WhisperX")
+    started = time.perf_counter()
+    spec = _speculations.pop(audio, None)
+    if spec is not None:
+        # WhisperX уже запущен параллельно с Vosk — просто ждем его результат
+        text = clean_text(spec.result())
+    else:
+        text = _recognize_whisper(audio)
+    whisper_ms = _ms(started)
+    started = time.perf_counter()
     intent_data = parse_intent(text)
     logger.debug("Parsed intent from WhisperX: %s", intent_data)
-    return {"text": text, "engine": "whisper", **intent_data}
\ No newline at end of file
+    result = {"text": text, "engine": "whisper", **intent_data, "decision": DECISION_WHISPER,
+              "speculative": spec is not None}
+    timings = {"whisper": whisper_ms, "whisper_parse": _ms(started)}
+    _observe(timings)
+    if fast is not None:
+        result["confidence"] = fast.get("confidence")
+        result["vosk_text"] = fast.get("text")
+        timings = {**fast.get("timings_ms", {}), **timings}
+    result["timings_ms"] = timings
+    return result
+
+
+def transcribe_and_parse(audio: AudioBuffer, context: str | None = None) -> dict:
+    """
+    Выполняет транскрипцию аудио и парсинг интента.
+    1) Сначала Vosk+grammar — быстрый режим.
+    2) Если интент неизвестен, переходит на WhisperX — точный режим.
+    """
+    result = transcribe_fast(audio, context)
+    if not needs_fallback(result):
+        return result
+    return transcribe_fallback(audio, result)
+
+
+class StreamingSession:
+    """
+    Потоковое распознавание одной команды: PCM 16 kHz моно подается порциями
+    по мере записи, Vosk декодирует их сразу, а к концу речи остается только
+    FinalResult и парсинг. Весь звук копится в буфере для фолбэка на WhisperX.
+    Распознаватель берется из пула и возвращается в finish() или close().
+    Звука принимается не больше settings.stream_max_seconds.
+    """
+
+    def __init__(self, context: str | None = None) -> None:
+        self._version = grammar_for(context)
+        self._rec = recognizer_pool.acquire(STREAM_RATE, self._version)
+        self._pcm = bytearray()          # весь принятый звук для WhisperX
+        self._max_bytes = int(settings.stream_max_seconds * STREAM_RATE) * 2
+        self._segments: list[str] = []   # завершенные Vosk-фразы
+        self._words: list[dict] = []     # слова с уверенностью для политики выбора движка
+        self._partial = ""               # последняя промежуточная гипотеза
+        self._prefix_ok = True           # похожа ли гипотеза на начало команды
+        self._audio: AudioBuffer | None = None
+
+    @property
+    def duration(self) -> float:
+        """Длительность принятого аудио в секундах."""
+        return len(self._pcm) / 2 / STREAM_RATE
+
+    def accept(self, chunk: bytes) -> str | None:
+        """
+        Передает порцию PCM в распознаватель.
+        :return: новая промежуточная гипотеза или None, если она не изменилась
+        :raises ValueError: фраза длиннее settings.stream_max_seconds
+        """
+        if len(self._pcm) + len(chunk) > self._max_bytes:
+            raise ValueError(f"stream is longer than {settings.stream_max_seconds:g} s")
+        self._pcm.extend(chunk)
+        if self._rec.AcceptWaveform(chunk):
+            # Vosk закрыл фразу по паузе — сохраняем ее и начинаем новую гипотезу
+            result = json.loads(self._rec.Result())
+            segment = result.get("text", "")
+            if segment:
+                self._segments.append(segment)
+                self._words.extend(result.get("result", []))
+            partial = ""
+        else:
+            partial = json.loads(self._rec.PartialResult()).get("partial", "")
+        text = clean_text(" ".join([*self._segments, partial]))
+        if text == self._partial:
+            return None
+        self._partial = text
+        self._prefix_ok = has_intent_prefix(text)
+        return text
+
+    def fallback(self, fast: dict) -> dict:
+        """Фолбэк на WhisperX по всему принятому звуку (с учетом спекулятивного запуска)."""
+        return transcribe_fallback(self.audio(), fast)
+
+    def audio(self) -> AudioBuffer:
+        """Весь принятый звук — для фолбэка на WhisperX (после finish() — тот же буфер)."""
+        if self._audio is not None:
+            return self._audio
+        return AudioBuffer(bytes(self._pcm), STREAM_RATE)
+
+    def close(self) -> None:
+        """Возвращает распознаватель в пул (повторный вызов безопасен)."""
+        if self._rec is not None:
+            rec, self._rec = self._rec, None
+            recognizer_pool.release(STREAM_RATE, self._version, rec)
+
+    def finish(self) -> dict:
+        """Завершает поток: финальный текст Vosk и интент (фолбэк — transcribe_fallback(audio()))."""
+        # спекулятивный WhisperX стартует до FinalResult и идет параллельно с ним
+        self._audio = self.audio()
+        _maybe_speculate(self._audio, self._prefix_ok)
+        started = time.perf_counter()
+        result = json.loads(self._rec.FinalResult())
+        self.close()
+        self._words.extend(result.get("result", []))
+        text = clean_text(" ".join([*self._segments, result.get("text", "")]))
+        logger.debug("Streaming Vosk result (%.2f s): %s", self.duration, text)
+        parsed = _parse_vosk(text, _vosk_confidence(self._words), _ms(started))
+        _settle_speculation(self._audio, parsed)
+        return parsed
+
+
+# ---------- Состояние для HTTP-сервера ----------
+def start() -> None:
+    """Запускает фоновую загрузку моделей."""
+    model_manager.start()
+
+
+def ready() -> bool:
+    """Готов ли быстрый путь (Vosk загружен и прогрет)."""
+    return model_manager.ready("vosk")
+
+
+def models_status() -> dict:
+    return model_manager.status()
+
+
+def nomenclature_version() -> str:
+    """Версия индекса номенклатуры — часть ключа кэша распознавания."""
+    return nomenclature.version()
+
+
+def stats() -> dict:
+    return {
+        "vosk_pool": recognizer_pool.stats(),
+        "whisper_batcher": whisper_batcher.stats(),
+        "speculation": Speculation.stats(),
+    }
@@ -0,0 +1,371 @@
+# voice_server/inference_server.py
+"""
+Общий сервер инференса.
+
+Один процесс держит модели Vosk и WhisperX и выполняет распознавание на своем
+пуле потоков, а HTTP-воркеры uvicorn (``--workers N``) обращаются к нему через
+локальный IPC (multiprocessing.connection: TCP на localhost, Unix-сокет или
+именованный канал Windows). Аудио передается через shared memory, по каналу
+идут только короткие сообщения — так N воркеров не держат N копий моделей.
+
+Канал передает сообщения через pickle, поэтому доступ к нему закрыт общим
+секретом VOICE_INFERENCE_AUTHKEY: без него не стартует ни сервер, ни воркеры.
+
+Запуск сервера:  VOICE_INFERENCE_AUTHKEY=<секрет> python -m voice_server.inference_server
+HTTP-воркеры:    VOICE_INFERENCE_AUTHKEY=<секрет> VOICE_INFERENCE_MODE=remote uvicorn voice_server.main:app --workers N
+"""
+from __future__ import annotations
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, Optional
+
+from .audio_io import AudioBuffer, TARGET_RATE
+from .config import settings
+from .contexts import UnknownContext
+from . import metrics
+from .models import ModelNotReady
+from .scheduler import FAST, SLOW, QueueFull, RecognitionScheduler
+
+logger = logging.getLogger(__name__)
+
+_MAX_BUFFERS = 256        # сколько последних аудио сервер держит для фолбэка без повторной передачи
+_SESSION_IDLE_S = 120.0   # брошенные потоковые сессии закрываются после этого простоя
+
+
+class _Expired(Exception):
+    """Сервер уже не помнит аудио по токену — его нужно передать заново."""
+
+
+def parse_address(address: str) -> Any:
+    """host:port → кортеж для AF_INET; путь Unix-сокета или \\\\.\\pipe\\... — как есть."""
+    if address.startswith("\\\\") or "/" in address or ":" not in address:
+        return address
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def require_authkey(authkey: Optional[str]) -> bytes:
+    """
+    Секрет канала IPC. Встроенного значения нет: любой, кто знает ключ и достает
+    до сокета, может выполнить код в сервере инференса (сообщения — pickle).
+    """
+    if not authkey:
+        raise RuntimeError("VOICE_INFERENCE_AUTHKEY is not set: the inference channel needs an explicit "
+                           "shared secret (e.g. python -c \"import secrets; print(secrets.token_hex(32))\")")
+    return authkey.encode()
+
+
+def _read_shared(name: str, size: int) -> bytes:
+    """Копирует PCM из сегмента shared memory, созданного клиентом."""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+        if os.name == "posix":
+            # до Python 3.13 подключение тоже регистрирует сегмент в resource_tracker,
+            # и тот удалил бы чужой сегмент при выходе — сегментом владеет клиент
+            resource_tracker.unregister(shm._name, "shared_memory")
+
+
+# ---------- сервер ----------
+class InferenceServer:
+    def __init__(self, address: str, authkey: Optional[str]) -> None:
+        # модели импортируются только в процессе сервера
+        from . import hybrid_recognizer as engine
+
+        self._engine = engine
+        self._address = parse_address(address)
+        self._authkey = require_authkey(authkey)
+        self._scheduler = RecognitionScheduler(
+            workers=settings.workers,
+            queue_depth=settings.queue_depth,
+            slow_queue_depth=settings.whisper_queue_depth,
+            slow_slots=settings.whisper_slots,
+            retry_after=settings.retry_after,
+        )
+        self._lock = threading.Lock()
+        self._buffers: "OrderedDict[str, AudioBuffer]" = OrderedDict()
+        self._sessions: dict = {}  # sid -> [StreamingSession, время последнего обращения]
+        metrics.REGISTRY.gauge(
+            "voice_inference_queue_depth", "Jobs waiting in the inference server scheduler",
+            lambda: [((lane,), self._scheduler.queue_depth(lane)) for lane in (FAST, SLOW)], ("lane",),
+        )
+        metrics.REGISTRY.gauge("voice_inference_stream_sessions", "Open streaming sessions",
+                               lambda: len(self._sessions))
+
+    def serve_forever(self) -> None:
+        self._engine.start()
+        self._scheduler.start()
+        with Listener(self._address, authkey=self._authkey) as listener:
+            logger.info("Inference server listening on %s", self._address)
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception:
+                    # неверный authkey или оборванное рукопожатие — ждем следующего клиента
+                    logger.exception("Inference server: accept failed")
+                    continue
+                threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+    def _serve_connection(self, conn: Connection) -> None:
+        with conn:
+            while True:
+                try:
+                    op, *args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = ("ok", self._handle(op, args))
+                except QueueFull as e:
+                    reply = ("queue_full", e.lane, e.retry_after)
+                except ModelNotReady as e:
+                    reply = ("not_ready", e.name, e.state)
+                except UnknownContext as e:
+                    reply = ("unknown_context", e.context)
+                except _Expired:
+                    reply = ("expired",)
+                except Exception as e:
+                    logger.exception("Inference op %s failed", op)
+                    reply = ("error", f"{type(e).__name__}: {e}")
+                try:
+                    conn.send(reply)
+                except (EOFError, OSError):
+                    return
+
+    def _run(self, fn, *args, lane: str = FAST) -> Any:
+        return self._scheduler.submit(fn, *args, lane=lane).result()
+
+    def _remember(self, audio: AudioBuffer) -> str:
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._buffers[token] = audio
+            while len(self._buffers) > _MAX_BUFFERS:
+                self._buffers.popitem(last=False)
+        return token
+
+    def _session(self, sid: str):
+        with self._lock:
+            entry = self._sessions[sid]
+            entry[1] = time.monotonic()
+            return entry[0]
+
+    def _sweep_sessions(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            stale = [sid for sid, (_, used) in self._sessions.items() if now - used > _SESSION_IDLE_S]
+            sessions = [self._sessions.pop(sid)[0] for sid in stale]
+        for session in sessions:
+            session.close()
+
+    def _handle(self, op: str, args: list) -> Any:
+        engine = self._engine
+        if op == "fast":
+            name, size, rate, context = args
+            audio = AudioBuffer(_read_shared(name, size), rate)
+            return self._remember(audio), self._run(engine.transcribe_fast, audio, context)
+        if op == "fallback":
+            token, fast = args
+            with self._lock:
+                audio = self._buffers.pop(token, None)
+            if audio is None:
+                raise _Expired()
+            return self._run(engine.transcribe_fallback, audio, fast, lane=SLOW)
+        if op == "fallback_audio":
+            name, size, rate, fast = args
+            audio = AudioBuffer(_read_shared(name, size), rate)
+            return self._run(engine.transcribe_fallback, audio, fast, lane=SLOW)
+        if op == "stream_open":
+            self._sweep_sessions()
+            session = self._run(engine.StreamingSession, args[0])
+            sid = uuid.uuid4().hex
+            with self._lock:
+                self._sessions[sid] = [session, time.monotonic()]
+            return sid
+        if op == "stream_feed":
+            sid, chunk = args
+            return self._run(self._session(sid).accept, chunk)
+        if op == "stream_finish":
+            return self._run(self._session(args[0]).finish)
+        if op == "stream_fallback":
+            sid, fast = args
+            return self._run(self._session(sid).fallback, fast, lane=SLOW)
+        if op == "stream_close":
+            with self._lock:
+                entry = self._sessions.pop(args[0], None)
+            if entry is not None:
+                entry[0].close()
+            return None
+        if op == "ready":
+            return engine.ready()
+        if op == "models_status":
+            return engine.models_status()
+        if op == "nomenclature_version":
+            return engine.nomenclature_version()
+        if op == "stats":
+            return {**engine.stats(), "inference_scheduler": self._scheduler.stats()}
+        if op == "metrics":
+            return metrics.REGISTRY.collect()
+        raise ValueError(f"unknown op {op!r}")
+
+
+# ---------- клиент для HTTP-воркеров ----------
+class InferenceClient:
+    """
+    Тот же интерфейс, что у hybrid_recognizer (transcribe_fast, transcribe_fallback,
+    StreamingSession, ready, stats...), но работа выполняется в сервере инференса.
+    Соединения переиспользуются из пула: одно соединение — один запрос за раз.
+    """
+
+    def __init__(self, address: str, authkey: Optional[str]) -> None:
+        self._address = parse_address(address)
+        self._authkey = require_authkey(authkey)
+        self._idle: "queue.LifoQueue[Connection]" = queue.LifoQueue()
+        # токен аудио на сервере — чтобы фолбэк не передавал звук повторно
+        self._tokens: "weakref.WeakKeyDictionary[AudioBuffer, str]" = weakref.WeakKeyDictionary()
+
+    def _call(self, op: str, *args: Any) -> Any:
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = Client(self._address, authkey=self._authkey)
+        try:
+            conn.send((op, *args))
+            reply = conn.recv()
+        except (EOFError, OSError) as e:
+            conn.close()
+            raise ConnectionError(f"inference server unavailable: {e}") from e
+        self._idle.put(conn)
+        kind, *rest = reply
+        if kind == "ok":
+            return rest[0]
+        if kind == "queue_full":
+            raise QueueFull(*rest)
+        if kind == "not_ready":
+            raise ModelNotReady(*rest)
+        if kind == "unknown_context":
+            raise UnknownContext(*rest)
+        if kind == "expired":
+            raise _Expired()
+        raise RuntimeError(rest[0])
+
+    def _call_with_audio(self, op: str, audio: AudioBuffer, *args: Any) -> Any:
+        """Передает PCM через shared memory; сегмент удаляется после ответа сервера."""
+        size = len(audio.pcm)
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        try:
+            shm.buf[:size] = audio.pcm
+            return self._call(op, shm.name, size, audio.rate, *args)
+        finally:
+            shm.close()
+            shm.unlink()
+
+    # --- интерфейс hybrid_recognizer ---
+    def start(self) -> None:
+        """Модели загружает сервер инференса — воркеру запускать нечего."""
+
+    def ready(self) -> bool:
+        return self._call("ready")
+
+    def models_status(self) -> dict:
+        return self._call("models_status")
+
+    def nomenclature_version(self) -> str:
+        # номенклатура загружена в сервере инференса; недоступен — ответ все равно не получить
+        try:
+            return self._call("nomenclature_version")
+        except ConnectionError:
+            return "unavailable"
+
+    def stats(self) -> dict:
+        try:
+            return self._call("stats")
+        except ConnectionError as e:
+            return {"inference_server": {"error": str(e)}}
+
+    def metrics(self) -> list:
+        """Снимок метрик процесса инференса (этапы Vosk и WhisperX, его очереди)."""
+        return self._call("metrics")
+
+    def transcribe_fast(self, audio: AudioBuffer, context: str | None = None) -> dict:
+        token, result = self._call_with_audio("fast", audio, context)
+        self._tokens[audio] = token
+        return result
+
+    def transcribe_fallback(self, audio: AudioBuffer, fast: dict | None = None) -> dict:
+        token = self._tokens.pop(audio, None)
+        if token is not None:
+            try:
+                return self._call("fallback", token, fast)
+            except _Expired:
+                pass
+        return self._call_with_audio("fallback_audio", audio, fast)
+
+    def StreamingSession(self, context: str | None = None) -> "RemoteStreamingSession":
+        return RemoteStreamingSession(self, context)
+
+
+class RemoteStreamingSession:
+    """Потоковая сессия, состояние которой живет в сервере инференса."""
+
+    def __init__(self, client: InferenceClient, context: str | None = None) -> None:
+        self._client = client
+        self._sid: str | None = client._call("stream_open", context)
+        self._bytes = 0
+
+    @property
+    def duration(self) -> float:
+        return self._bytes / 2 / TARGET_RATE
+
+    def accept(self, chunk: bytes) -> str | None:
+        self._bytes += len(chunk)
+        return self._client._call("stream_feed", self._sid, chunk)
+
+    def finish(self) -> dict:
+        return self._client._call("stream_finish", self._sid)
+
+    def fallback(self, fast: dict) -> dict:
+        return self._client._call("stream_fallback", self._sid, fast)
+
+    def close(self) -> None:
+        if self._sid is not None:
+            sid, self._sid = self._sid, None
+            try:
+                self._client._call("stream_close", sid)
+            except ConnectionError:
+                pass
+
+
+def main() -> None:
+    from .logging_setup import setup_logging
+    # свой файл: ротацию одного файла из двух процессов RotatingFileHandler не переживает
+    base, ext = os.path.splitext(settings.log_file)
+    setup_logging(log_file=f"{base}.inference{ext}" if settings.log_file else "")
+    try:
+        require_authkey(settings.inference_authkey)
+    except RuntimeError as e:
+        raise SystemExit(str(e))
+    threads = settings.inference_threads
+    if threads > 0:
+        # число потоков BLAS/OpenMP нужно задать до импорта torch
+        os.environ.setdefault("OMP_NUM_THREADS", str(threads))
+    server = InferenceServer(settings.inference_address, settings.inference_authkey)
+    if threads > 0:
+        try:
+            import torch
+            torch.set_num_threads(threads)
+        except ImportError:
+            pass
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,443 @@
+# voice_server/journal.py
+"""
+Журнал команд для 1С на диске.
+
+Каждая распознанная команда сначала записывается в журнал (SQLite в режиме
+WAL), а уже потом отправляется; доставленная подтверждается (ack). Неудачная
+доставка откладывается с экспоненциальной задержкой и случайным разбросом,
+и ее повторяет фоновый поток (или забирает 1С опросом /intent). Команды,
+записанные, но не подтвержденные до падения процесса, снова забираются в
+доставку, когда истечет их lease — доставка «хотя бы один раз». Сразу при
+старте их не трогаем: это могут быть отправки соседнего воркера uvicorn или
+команды, выданные опросу /intent и еще не подтвержденные.
+
+Все изменения идут через один поток записи: одновременные добавления
+коммитятся одной транзакцией (один fsync на пачку — group commit), а append()
+возвращается только после того, как его пачка на диске. Подтвержденные
+записи вычищает компактификация в собственном потоке журнала — при любом
+приемнике, в том числе poll; в памяти журнал ничего не копит.
+
+Команда может быть адресована сессии 1С (session): такую забирает только
+опрос /intent этой сессии, и после коммита будятся только ее ожидающие.
+Команды без сессии достаются любому опросу, а опрос без сессии получает только
+их — адресованные команды чужим опросам не выдаются.
+"""
+from __future__ import annotations
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Deque, List, Optional, Set, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# состояния записи
+PENDING = 0    # ждет доставки (повтор или опрос /intent)
+INFLIGHT = 1   # доставляется сейчас; после истечения lease снова считается ожидающей
+ACKED = 2      # доставлена
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS commands (
+    id        INTEGER PRIMARY KEY AUTOINCREMENT,
+    created   REAL    NOT NULL,
+    intent    TEXT    NOT NULL,
+    fields    TEXT    NOT NULL,
+    state     INTEGER NOT NULL,
+    attempts  INTEGER NOT NULL DEFAULT 0,
+    next_try  REAL    NOT NULL,
+    acked     REAL,
+    via       TEXT,
+    error     TEXT,
+    claimed_by TEXT,
+    session   TEXT
+);
+CREATE INDEX IF NOT EXISTS commands_due ON commands (state, next_try);
+"""
+# индекс по сессии создается после миграции: в старых базах колонки еще нет
+_SESSION_INDEX = "CREATE INDEX IF NOT EXISTS commands_session ON commands (session, state, next_try)"
+
+WriteOp = Callable[[sqlite3.Connection], Any]
+# кого будить после коммита: False — никого, True — всех, строка — ожидающих этой сессии
+Notify = Union[bool, str]
+_Op = Tuple[WriteOp, Optional[Future], Notify]  # операция, ее Future, кого будить после коммита
+Listener = Callable[[Optional[Set[str]]], None]
+# claim/has_ready без фильтра по сессии (поток повторов); "*" не бывает id сессии
+ANY_SESSION = "*"
+
+
+def backoff(attempts: int, base: float, cap: float) -> float:
+    """Экспоненциальная задержка с разбросом («equal jitter»): половина фиксирована, половина случайна."""
+    delay = min(cap, base * 2 ** max(0, attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _session_filter(session: Optional[str], params: list) -> str:
+    """Условие WHERE на сессию для claim/has_ready (параметр дописывается в params)."""
+    if session == ANY_SESSION:
+        return ""
+    if session is None:
+        return " AND session IS NULL"
+    params.append(session)
+    return " AND (session = ? OR session IS NULL)"
+
+
+class CommandJournal:
+    def __init__(self, path: str, max_batch: int = 256, lease_s: float = 60.0,
+                 retry_base: float = 1.0, retry_cap: float = 300.0,
+                 retention_s: Optional[float] = None, compact_interval: float = 60.0) -> None:
+        """
+        :param path: файл SQLite
+        :param max_batch: сколько операций записи объединять в одну транзакцию
+        :param lease_s: через сколько незавершенная доставка снова считается ожидающей
+        :param retry_base: первая задержка повтора, секунд (дальше удваивается)
+        :param retry_cap: максимальная задержка повтора, секунд
+        :param retention_s: сколько хранить подтвержденные записи (None — без компактификации)
+        :param compact_interval: период компактификации, секунд
+        """
+        self.path = path
+        self.max_batch = max(1, max_batch)
+        self.lease = lease_s
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self.retention = retention_s
+        self.compact_interval = compact_interval
+        self._ops: Deque[_Op] = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._stop = threading.Event()
+        # выставляется, когда появилась отложенная команда — будит поток повторов
+        self.changed = threading.Event()
+        self._listeners: List[Listener] = []
+        self._db = self._connect()
+        self._db.executescript(_SCHEMA)
+        self._migrate()
+        self._reader = self._connect()
+        self._reader_lock = threading.Lock()
+        # счетчики для /stats
+        self._commits = 0
+        self._ops_done = 0
+        self.recovered = self._recover()
+        self._writer = threading.Thread(target=self._write_loop, name="journal-writer", daemon=True)
+        self._writer.start()
+        self._compactor: Optional[threading.Thread] = None
+        if retention_s is not None:
+            self._compactor = threading.Thread(target=self._compact_loop, name="journal-compact", daemon=True)
+            self._compactor.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        # FULL: каждый коммит — fsync WAL; стоимость делится на всю пачку
+        db.execute("PRAGMA synchronous=FULL")
+        return db
+
+    def _migrate(self) -> None:
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(commands)")}
+        if "claimed_by" not in columns:
+            self._db.execute("ALTER TABLE commands ADD COLUMN claimed_by TEXT")
+        if "session" not in columns:
+            self._db.execute("ALTER TABLE commands ADD COLUMN session TEXT")
+        self._db.execute(_SESSION_INDEX)
+
+    def add_listener(self, callback: Listener) -> None:
+        """
+        callback вызывается из потока записи, когда после коммита появились ожидающие команды.
+        Аргумент — множество сессий с новыми командами или None, если будить нужно всех.
+        """
+        self._listeners.append(callback)
+
+    def _recover(self) -> int:
+        """
+        Считает потерянные доставки (lease истек) — их заберет claim. Живые INFLIGHT
+        не сбрасываются: они могут принадлежать другому процессу с тем же журналом.
+        """
+        count = self._db.execute("SELECT COUNT(*) FROM commands WHERE state = ? AND next_try <= ?",
+                                 (INFLIGHT, time.time())).fetchone()[0]
+        if count:
+            logger.warning("Journal: %d undelivered command(s) with expired lease in %s", count, self.path)
+        return count
+
+    # ---------- поток записи ----------
+    def _submit(self, op: WriteOp, wait: bool = True, notify: Notify = False) -> Any:
+        future: Optional[Future] = Future() if wait else None
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("journal is closed")
+            self._ops.append((op, future, notify))
+            self._cond.notify()
+        return future.result() if future is not None else None
+
+    def _write_loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._ops and not self._closed:
+                    self._cond.wait()
+                if not self._ops:
+                    return
+                batch = [self._ops.popleft() for _ in range(min(len(self._ops), self.max_batch))]
+            results = []
+            try:
+                self._db.execute("BEGIN IMMEDIATE")
+                for op, _, _ in batch:
+                    # точка сохранения: упавшая операция откатывается целиком, соседи по пачке коммитятся
+                    self._db.execute("SAVEPOINT op")
+                    try:
+                        results.append((True, op(self._db)))
+                    except Exception as e:
+                        self._db.execute("ROLLBACK TO op")
+                        results.append((False, e))
+                    self._db.execute("RELEASE op")
+                self._db.execute("COMMIT")
+            except Exception as e:
+                # поток записи не должен умирать: иначе все следующие _submit() ждут вечно
+                logger.exception("Journal: commit of %d operation(s) failed", len(batch))
+                try:
+                    if self._db.in_transaction:
+                        self._db.execute("ROLLBACK")
+                except sqlite3.Error:
+                    logger.exception("Journal: rollback failed")
+                results = [(False, e)] * len(batch)
+            notified = [notify for _, _, notify in batch if notify]
+            if notified:
+                # новые ожидающие команды уже на диске — будим повторы и долгий опрос
+                self.changed.set()
+                sessions = None if True in notified else set(notified)
+                for callback in self._listeners:
+                    try:
+                        callback(sessions)
+                    except Exception:
+                        logger.exception("Journal listener failed")
+            for (_, future, _), (ok, value) in zip(batch, results):
+                if future is None:
+                    if not ok:
+                        logger.error("Journal: operation failed: %s", value)
+                elif ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+            self._commits += 1
+            self._ops_done += len(batch)
+
+    # ---------- операции ----------
+    def append(self, intent: str, fields: dict, pending: bool = False, session: Optional[str] = None) -> int:
+        """
+        Записывает команду; возвращается после fsync.
+        :param pending: False — команда сразу отправляется приемником (INFLIGHT),
+                        True — ждет, пока ее заберет 1С (/intent)
+        :param session: сессия 1С, которой адресована команда (None — любой)
+        """
+        now = time.time()
+        payload = json.dumps(fields or {}, ensure_ascii=False)
+        state, next_try = (PENDING, now) if pending else (INFLIGHT, now + self.lease)
+        return self._submit(lambda db: db.execute(
+            "INSERT INTO commands (created, intent, fields, state, next_try, session) VALUES (?, ?, ?, ?, ?, ?)",
+            (now, intent, payload, state, next_try, session),
+        ).lastrowid, notify=pending and (session or True))
+
+    def ack(self, command_id: int, via: str) -> None:
+        """Подтверждает доставку (не ждет записи: повторная доставка допустима)."""
+        now = time.time()
+        self._submit(lambda db: db.execute(
+            "UPDATE commands SET state = ?, acked = ?, via = ? WHERE id = ? AND state != ?",
+            (ACKED, now, via, command_id, ACKED),
+        ), wait=False)
+
+    def defer(self, command_id: int, error: str) -> None:
+        """Доставка не удалась — следующая попытка через экспоненциально растущую задержку."""
+        def op(db: sqlite3.Connection) -> None:
+            row = db.execute("SELECT attempts FROM commands WHERE id = ? AND state != ?",
+                             (command_id, ACKED)).fetchone()
+            if row is None:
+                return
+            attempts = row[0] + 1
+            db.execute(
+                "UPDATE commands SET state = ?, attempts = ?, next_try = ?, error = ? WHERE id = ?",
+                (PENDING, attempts, time.time() + backoff(attempts, self.retry_base, self.retry_cap),
+                 error[:500], command_id),
+            )
+        self._submit(op, wait=False, notify=True)
+
+    def claim(self, limit: int = 1, due_only: bool = True, owner: str = "retry",
+              session: Optional[str] = ANY_SESSION) -> List[dict]:
+        """
+        Забирает ожидающие команды в доставку (INFLIGHT на время lease), старые — первыми.
+        :param due_only: только те, у которых наступило время повтора (False — для опроса /intent)
+        :param owner: кто забрал — подтверждение по курсору касается только его команд
+        :param session: только команды этой сессии и команды без сессии;
+                        None — только команды без сессии, ANY_SESSION — все
+        """
+        def op(db: sqlite3.Connection) -> List[dict]:
+            now = time.time()
+            # истекший lease — доставка потерялась (например, зависла) и снова ожидает
+            where = "(state = ? OR (state = ? AND next_try <= ?))"
+            params: list = [PENDING, INFLIGHT, now]
+            if due_only:
+                where += " AND next_try <= ?"
+                params.append(now)
+            where += _session_filter(session, params)
+            rows = db.execute(
+                f"SELECT id, intent, fields, attempts, session FROM commands WHERE {where} ORDER BY id LIMIT ?",
+                (*params, limit),
+            ).fetchall()
+            db.executemany("UPDATE commands SET state = ?, next_try = ?, claimed_by = ? WHERE id = ?",
+                           [(INFLIGHT, now + self.lease, owner, row[0]) for row in rows])
+            return [{"id": r[0], "intent": r[1], "fields": json.loads(r[2]), "attempts": r[3], "session": r[4]}
+                    for r in rows]
+        return self._submit(op)
+
+    def ack_through(self, cursor: int, owner: str) -> int:
+        """Подтверждает все команды владельца с номером не больше cursor; возвращает их число."""
+        now = time.time()
+        return self._submit(lambda db: db.execute(
+            "UPDATE commands SET state = ?, acked = ?, via = ? WHERE id <= ? AND state = ? AND claimed_by = ?",
+            (ACKED, now, owner, cursor, INFLIGHT, owner),
+        ).rowcount)
+
+    def compact(self, retention_s: float) -> int:
+        """Удаляет подтвержденные записи старше retention_s."""
+        cutoff = time.time() - retention_s
+        return self._submit(lambda db: db.execute(
+            "DELETE FROM commands WHERE state = ? AND acked < ?", (ACKED, cutoff),
+        ).rowcount)
+
+    def _compact_loop(self) -> None:
+        while not self._stop.wait(self.compact_interval):
+            try:
+                removed = self.compact(self.retention)
+            except Exception:
+                logger.exception("Journal compaction failed")
+                continue
+            if removed:
+                logger.info("Journal: compacted %d acknowledged command(s)", removed)
+
+    def has_ready(self, session: Optional[str] = ANY_SESSION) -> bool:
+        """Есть ли команды, которые можно забрать опросом (дешевое чтение без блокировки записи)."""
+        params: list = [PENDING, INFLIGHT, time.time()]
+        where = "(state = ? OR (state = ? AND next_try <= ?))" + _session_filter(session, params)
+        with self._reader_lock:
+            row = self._reader.execute(f"SELECT 1 FROM commands WHERE {where} LIMIT 1", params).fetchone()
+        return row is not None
+
+    def next_due(self) -> Optional[float]:
+        """Время ближайшего повтора (None — ожидающих нет)."""
+        with self._reader_lock:
+            row = self._reader.execute("SELECT MIN(next_try) FROM commands WHERE state != ?", (ACKED,)).fetchone()
+        return row[0]
+
+    def pending_count(self) -> int:
+        with self._reader_lock:
+            return self._reader.execute("SELECT COUNT(*) FROM commands WHERE state != ?", (ACKED,)).fetchone()[0]
+
+    def session_stats(self) -> dict:
+        """
+        По сессиям: очередь (недоставленные), сколько доставлено за время хранения
+        и задержка от записи до подтверждения.
+        """
+        with self._reader_lock:
+            rows = self._reader.execute(
+                "SELECT session, SUM(state != ?), SUM(state = ?), "
+                "AVG(CASE WHEN state = ? THEN acked - created END), "
+                "MAX(CASE WHEN state = ? THEN acked - created END), "
+                "MIN(CASE WHEN state != ? THEN created END) "
+                "FROM commands GROUP BY session",
+                (ACKED, ACKED, ACKED, ACKED, ACKED),
+            ).fetchall()
+        now = time.time()
+        return {
+            session or "": {
+                "backlog": backlog,
+                "delivered": delivered,
+                "delivery_ms_avg": round(avg * 1000, 2) if avg is not None else 0.0,
+                "delivery_ms_max": round(worst * 1000, 2) if worst is not None else 0.0,
+                "oldest_pending_s": round(now - oldest, 2) if oldest is not None else 0.0,
+            }
+            for session, backlog, delivered, avg, worst, oldest in rows
+        }
+
+    def stats(self) -> dict:
+        with self._reader_lock:
+            counts = dict(self._reader.execute("SELECT state, COUNT(*) FROM commands GROUP BY state").fetchall())
+        with self._cond:
+            queued = len(self._ops)
+        return {
+            "pending": counts.get(PENDING, 0),
+            "inflight": counts.get(INFLIGHT, 0),
+            "acked": counts.get(ACKED, 0),
+            "recovered": self.recovered,
+            "write_queue": queued,
+            "commits": self._commits,
+            "ops_per_commit": round(self._ops_done / self._commits, 2) if self._commits else 0.0,
+        }
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._compactor is not None:
+            self._compactor.join(timeout=10)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join(timeout=10)
+        self._db.close()
+        self._reader.close()
+
+
+class RetryWorker:
+    """Фоновый поток: повторяет отложенные команды (компактификация — у самого журнала)."""
+
+    def __init__(self, journal: CommandJournal, deliver: Callable[[str, dict], None],
+                 batch: int = 16, idle_s: float = 5.0) -> None:
+        """
+        :param deliver: отправляет одну команду (intent, fields); исключение — доставка не удалась
+        :param batch: сколько команд забирать за проход
+        :param idle_s: максимальный интервал проверки, когда ждать нечего
+        """
+        self._journal = journal
+        self._deliver = deliver
+        self.batch = batch
+        self.idle = idle_s
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.retried = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="journal-retry", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._journal.changed.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                commands = self._journal.claim(self.batch)
+                for cmd in commands:
+                    try:
+                        self._deliver(cmd["intent"], cmd["fields"])
+                    except Exception as e:
+                        self.failed += 1
+                        self._journal.defer(cmd["id"], str(e))
+                    else:
+                        self.retried += 1
+                        self._journal.ack(cmd["id"], "retry")
+                if len(commands) == self.batch:
+                    continue  # очередь не разобрана — следующий проход сразу
+                due = self._journal.next_due()
+                wait = self.idle if due is None else min(self.idle, max(0.0, due - time.time()))
+            except Exception:
+                logger.exception("Journal retry pass failed")
+                wait = self.idle
+            # спим до ближайшего повтора или до новой отложенной команды
+            self._journal.changed.wait(max(wait, 0.05))
+            self._journal.changed.clear()
+
+    def stats(self) -> dict:
+        return {"retried": self.retried, "failed": self.failed}
@@ -0,0 +1,196 @@
+# voice_server/logging_setup.py
+"""
+Неблокирующее логирование сервера.
+
+Все логгеры пишут в очередь (QueueHandler), а форматирование в JSON и запись
+в файл с ротацией по размеру выполняет один фоновый поток (QueueListener).
+Потоки распознавания и event loop не касаются диска: вызов logger.info() —
+это проверка уровня, подстановка аргументов и put в очередь. Если писатель не
+успевает, записи ниже WARNING отбрасываются со счетчиком, а не тормозят запрос.
+
+Ротацию по размеру один файл переживает только в одном процессе, поэтому
+воркеры uvicorn --workers пишут каждый в свой файл (voice_server.<pid>.log),
+а при VOICE_LOG_ROTATION=external все пишут в общий файл, который
+переименовывает внешняя ротация (logrotate), — писатель переоткрывает его сам.
+
+Каждая запись несет request_id текущего запроса (contextvar, его выставляет
+middleware в main.py, а планировщик переносит в рабочие потоки). Уровни
+задаются по логгерам (VOICE_LOG_LEVELS="multipart=WARNING,voice_server=DEBUG"),
+а шумные логгеры можно проредить (VOICE_LOG_SAMPLING="voice_server.audio_io=0.1":
+сохраняется доля записей ниже WARNING).
+"""
+from __future__ import annotations
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import time
+from typing import Dict, Optional
+
+from .config import settings
+
+# идентификатор запроса, в рамках которого пишется запись ("-" — вне запроса)
+request_id: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+
+_TEXT_FORMAT = "%(asctime)s [%(levelname)s] %(name)s [%(request_id)s]: %(message)s"
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional["_DroppingQueueHandler"] = None
+
+
+def parse_levels(spec: str) -> Dict[str, str]:
+    """'a=WARNING, b.c=DEBUG' → {'a': 'WARNING', 'b.c': 'DEBUG'}."""
+    levels = {}
+    for item in spec.split(","):
+        name, sep, value = item.strip().partition("=")
+        if sep and name.strip() and value.strip():
+            levels[name.strip()] = value.strip().upper()
+    return levels
+
+
+class _SamplingFilter(logging.Filter):
+    """Пропускает долю записей ниже WARNING у заданных логгеров (и их потомков)."""
+
+    def __init__(self, rates: Dict[str, float]) -> None:
+        super().__init__()
+        # длинные префиксы первыми: voice_server.audio_io важнее voice_server
+        self._rates = sorted(rates.items(), key=lambda item: -len(item[0]))
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        for prefix, rate in self._rates:
+            if record.name == prefix or record.name.startswith(prefix + "."):
+                return rate >= 1.0 or random.random() < rate
+        return True
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Кладет запись в ограниченную очередь. Обычные записи при переполнении
+    отбрасываются, предупреждения и ошибки ждут место не дольше секунды.
+    Сообщение собирается здесь (аргументы могут измениться после возврата),
+    а форматирование — в писателе.
+    """
+
+    def __init__(self, log_queue: "queue.Queue[logging.LogRecord]") -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.request_id = request_id.get()
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            # трассировку тоже снимаем сейчас: объект исключения не должен уйти в другой поток
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno >= logging.WARNING:
+                # предупреждения и ошибки важнее задержки — для них недолго ждем место
+                try:
+                    self.queue.put(record, timeout=1.0)
+                    return
+                except queue.Full:
+                    pass
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created))
+                  + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        if not hasattr(record, "request_id"):
+            record.request_id = "-"
+        return super().format(record)
+
+
+def setup_logging(log_file: Optional[str] = None, console: Optional[bool] = None) -> None:
+    """
+    Переводит корневой логгер на очередь с фоновым писателем (повторный вызов ничего не делает).
+    :param log_file: файл лога (по умолчанию settings.log_file, пустая строка — без файла)
+    :param console: дублировать ли текстом в консоль (по умолчанию settings.log_console)
+    """
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+    log_file = settings.log_file if log_file is None else log_file
+    console = settings.log_console if console is None else console
+
+    handlers = []
+    if log_file and settings.log_rotation == "external":
+        # дописывать в общий файл из нескольких процессов безопасно, а переименовывать его должен кто-то один
+        file_handler = logging.handlers.WatchedFileHandler(log_file, encoding="utf-8")
+    elif log_file:
+        if multiprocessing.parent_process() is not None:
+            # воркер uvicorn --workers: ротация одного файла несколькими процессами теряет записи
+            base, ext = os.path.splitext(log_file)
+            log_file = f"{base}.{os.getpid()}{ext}"
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=settings.log_max_bytes, backupCount=settings.log_backups, encoding="utf-8",
+        )
+    if log_file:
+        file_handler.setFormatter(JsonFormatter() if settings.log_format == "json" else _TextFormatter(_TEXT_FORMAT))
+        handlers.append(file_handler)
+    if console:
+        console_handler = logging.StreamHandler(sys.stderr)
+        console_handler.setFormatter(_TextFormatter(_TEXT_FORMAT))
+        handlers.append(console_handler)
+
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=settings.log_queue_size)
+    _queue_handler = _DroppingQueueHandler(log_queue)
+    sampling = {name: float(rate) for name, rate in parse_levels(settings.log_sampling).items()}
+    if sampling:
+        _queue_handler.addFilter(_SamplingFilter(sampling))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(settings.log_level.upper())
+    for name, level in parse_levels(settings.log_levels).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging() -> None:
+    """Дописывает очередь и останавливает писателя."""
+    global _listener
+    if _listener is not None:
+        listener, _listener = _listener, None
+        listener.stop()
+
+
+def stats() -> dict:
+    if _queue_handler is None:
+        return {"enabled": False}
+    return {"enabled": True, "queued": _queue_handler.queue.qsize(), "dropped": _queue_handler.dropped}
@@ -1,41 +1,70 @@
 # server/main.py
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Response, BackgroundTasks  # FastAPI для создания сервера, UploadFile и File для получения файлов, HTTPException для ошибок, Request и Response для обработки запросов, BackgroundTasks для фоновых задач
+from fastapi import WebSocket, WebSocketDisconnect  # Потоковое распознавание по WebSocket
 from fastapi.middleware.cors import CORSMiddleware  # Middleware для управления CORS
-from starlette.responses import JSONResponse  # Удобный ответ с JSON
-from collections import deque  # Двусторонняя очередь для отложенных команд
-import tempfile  # Для создания временных директорий
-import subprocess  # Для вызова внешних процессов (ffmpeg)
-import shutil  # Для копирования файлов
+from starlette.responses import JSONResponse, StreamingResponse  # Ответ с JSON и поток SSE
+import asyncio  # Для фоновой отправки в 1С из WebSocket-обработчика
 import os  # Для работы с ОС (при необходимости)
 import json  # Для сериализации полей команд в JSON
-import pathlib  # Удобная работа с путями
 import logging  # Логирование событий приложения
-import pythoncom  # Для инициализации COM в потоке
-from win32com.client import Dispatch  # Для взаимодействия с COM-объектами 1С
+import time  # Замер времени ответа по терминалам
+import uuid  # Идентификаторы запросов для логов
+from concurrent.futures import Future, TimeoutError as FutureTimeout  # Ожидание доставки с пределом
+from typing import Dict, Optional, Set  # Необязательные параметры эндпоинтов
 from .config import settings  # Конфигурация приложения (пути, CORS и т.д.)
-from .hybrid_recognizer import transcribe_and_parse  # Модуль для распознавания и парсинга команд
+from . import contexts  # Контексты диалога для грамматик Vosk
+from .contexts import UnknownContext  # Клиент передал неизвестный контекст
+from .models import ModelNotReady  # Модель еще загружается в фоне
+from .policy import needs_fallback, should_dispatch  # Решения политики выбора движка
+from .audio_io import AudioBuffer, AudioDecodeError, TARGET_RATE, decode_bytes, ffmpeg_pool  # Декодирование загрузок в память
+from .scheduler import RecognitionScheduler, QueueFull, FAST, SLOW  # Пул потоков распознавания с очередями
+from . import transcript_cache  # Кэш распознавания и ключи идемпотентности
+from .sinks import create_sink  # Доставка команд в 1С (COM или заменитель)
+from .journal import CommandJournal, RetryWorker  # Журнал команд на диске и повторы доставки
+from .transcript_cache import IdempotencyKeys, TranscriptCache, environment_version
+from .terminals import InvalidTerminal, TerminalStats, check_id  # Терминалы ТСД и сессии 1С
+from . import metrics  # Метрики Prometheus (/metrics)
+from . import logging_setup  # Логирование через очередь: JSON, request_id, ротация
+from .profiling import ProfileBusy, profiler  # Профилирование живых запросов по команде администратора
+from .audio_store import create_store  # Выборка фраз на диске с уборкой по объему и возрасту
 
 # --- Настройка логирования --------------------------------
-# Конфигурация базового логирования: пишет в файл voice_server.log
-logging.basicConfig(
-    filename="voice_server.log",  # Имя файла для логов
-    level=logging.DEBUG,  # Минимальный уровень логирования (DEBUG и выше)
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-)
+# Все логгеры пишут в очередь, файл voice_server.log (JSON, с ротацией) и консоль
+# обслуживает фоновый поток; уровни и прореживание — VOICE_LOG_* в config.py
+logging_setup.setup_logging()
 # Получаем именованный логгер для нашего приложения
 logger = logging.getLogger("warehouse_voice_server")
-# Добавляем обработчик для вывода логов также в консоль
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)  # Консоль выводит всё от DEBUG и выше
-console_formatter = logging.Formatter(
-    "%(asctime)s [%(levelname)s] %(name)s: %(message)s"
-)
-console_handler.setFormatter(console_formatter)
-logger.addHandler(console_handler)
 # -----------------------------------------------------------
 
+class RequestIdMiddleware:
+    """
+    Присваивает каждому запросу (и WebSocket-соединению) идентификатор: из заголовка
+    X-Request-ID или новый. Он попадает во все записи лога запроса и в ответ.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        rid = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")[:64] or uuid.uuid4().hex[:16]
+        token = logging_setup.request_id.set(rid)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", []).append((b"x-request-id", rid.encode("latin-1")))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            logging_setup.request_id.reset(token)
+
+
 # --- Инициализация FastAPI и CORS ---
 app = FastAPI(title="Warehouse Voice Server")  # Создаем приложение FastAPI
+app.add_middleware(RequestIdMiddleware)  # request_id для логов и заголовок X-Request-ID
 # Разрешаем CORS для указанных источников из настроек
 app.add_middleware(
     CORSMiddleware,
@@ -44,85 +73,220 @@ app.add_middleware(
     allow_headers=["*"],  # Разрешаем все заголовки
 )
 
+# --- Распознавание: модели в этом процессе или общий сервер инференса ---
+if settings.inference_mode == "remote":
+    # Модели держит отдельный процесс (python -m voice_server.inference_server),
+    # HTTP-воркеры только принимают и декодируют аудио
+    from .inference_server import InferenceClient
+    backend = InferenceClient(settings.inference_address, settings.inference_authkey)
+else:
+    from . import hybrid_recognizer as backend  # Модуль для распознавания и парсинга команд
+
 # --- Глобальные структуры данных ---
-# Очередь для хранения команд, не отправленных в 1С из-за ошибок
-pending_commands = deque()
+# Приемник команд: долгоживущие соединения с 1С и пачки;
+# VOICE_SINK=poll — сервер сам не отправляет, 1С забирает команды через /intent
+sink = None if settings.sink == "poll" else create_sink()
+
+# Журнал команд: запись до отправки, подтверждение после; неудачные повторяются в фоне
+journal = CommandJournal(
+    settings.journal_path,
+    lease_s=settings.journal_lease,
+    retry_base=settings.journal_retry_base,
+    retry_cap=settings.journal_retry_cap,
+    retention_s=settings.journal_retention,
+)
+retry_worker = RetryWorker(
+    journal, lambda intent, fields: sink.send(intent, fields, settings.sink_timeout)
+) if sink else None
+# Ожидающие /intent (долгий опрос и SSE) по сессиям 1С: будятся, когда в журнале появились
+# команды их сессии; ключ None — опрос без сессии, ему подходят только команды без адресата
+_intent_waiters: Dict[Optional[str], Set[asyncio.Future]] = {}
+_POLL_OWNER = "poll"  # владелец команд, выданных через /intent, — для подтверждения по курсору
+
+# Статистика распознавания по терминалам
+terminal_stats = TerminalStats(settings.max_terminals)
+
+# Кэш ответов по хешу PCM и ответы на повторы с Idempotency-Key
+transcripts = TranscriptCache(settings.transcript_cache_size, settings.transcript_cache_ttl,
+                              settings.transcript_cache_path)
+idempotency = IdempotencyKeys(settings.idempotency_ttl)
+
+# Выборка распознанных фраз для офлайн-бенчмарков и настройки грамматик (tmp_dir/archive)
+audio_store = create_store()
+
+# Пул распознавания: Vosk и WhisperX выполняются вне event loop
+scheduler = RecognitionScheduler(
+    workers=settings.workers,
+    queue_depth=settings.queue_depth,
+    slow_queue_depth=settings.whisper_queue_depth,
+    slow_slots=settings.whisper_slots,
+    retry_after=settings.retry_after,
+    terminal_depth=settings.terminal_queue_depth,
+)
+
+
+# Мгновенные величины для /metrics снимаются в момент опроса
+metrics.REGISTRY.gauge("voice_queue_depth", "Jobs waiting in the recognition scheduler",
+                       lambda: [((lane,), scheduler.queue_depth(lane)) for lane in (FAST, SLOW)], ("lane",))
+metrics.REGISTRY.gauge("voice_workers_busy", "Recognition threads running a job",
+                       lambda: scheduler.stats()["running"])
+
+
+def _backlog() -> list:
+    counts = journal.stats()
+    return [(("pending",), counts["pending"]), (("inflight",), counts["inflight"])]
+
+
+metrics.REGISTRY.gauge("voice_1c_backlog", "Journaled commands not yet delivered to 1C, by state",
+                       _backlog, ("state",))
+metrics.REGISTRY.gauge("voice_sink_queue_depth", "Commands waiting in the 1C sink queue",
+                       lambda: sink.stats()["queued"] if sink is not None else None)
+metrics.REGISTRY.gauge("voice_intent_waiters", "Open /intent long polls and SSE streams",
+                       lambda: sum(len(w) for w in _intent_waiters.values()))
+metrics.REGISTRY.gauge("voice_terminals", "Terminals seen recently", lambda: len(terminal_stats))
+
+
+def _model_gauges() -> list:
+    # в режиме remote состояние моделей приходит от сервера инференса
+    families = []
+    status = backend.models_status()
+    for field, metric, help in (("load_s", "voice_model_load_seconds", "Model load time"),
+                                ("warmup_s", "voice_model_warmup_seconds", "Model warm-up time")):
+        samples = [("", {"model": name}, m[field]) for name, m in status.items() if m.get(field) is not None]
+        families.append((metric, "gauge", help, samples))
+    families.append(("voice_model_ready", "gauge", "1 when the model is loaded and warmed up",
+                     [("", {"model": name}, float(m["state"] == "ready")) for name, m in status.items()]))
+    return families
+
+
+@app.on_event("startup")
+async def _start_scheduler():
+    scheduler.start()
+    audio_store.start()
+    if retry_worker is not None:
+        retry_worker.start()
+    # журнал коммитит в своем потоке — ожидающих будим через event loop
+    loop = asyncio.get_running_loop()
+    journal.add_listener(lambda sessions: loop.call_soon_threadsafe(_wake_intent_waiters, sessions))
+    # Модели грузятся в фоне: сервер отвечает на /ping и /ready сразу
+    backend.start()
+
+
+@app.on_event("shutdown")
+async def _stop_scheduler():
+    scheduler.stop()
+    ffmpeg_pool.close()
+    audio_store.stop()
+    if retry_worker is not None:
+        retry_worker.stop()
+    if sink is not None:
+        sink.close()
+    journal.close()
+
+
+def _busy(e: QueueFull) -> HTTPException:
+    """503 с Retry-After, когда очередь распознавания переполнена."""
+    logger.warning("Очередь %s заполнена — отклоняем запрос", e.lane)
+    return HTTPException(503, "Recognition queue is full", headers={"Retry-After": str(e.retry_after)})
+
+
+def _not_ready(e: ModelNotReady) -> HTTPException:
+    """503 с Retry-After, пока нужная модель еще загружается."""
+    logger.warning("Модель %s не готова (%s) — отклоняем запрос", e.name, e.state)
+    return HTTPException(503, f"Model {e.name} is {e.state}", headers={"Retry-After": str(settings.retry_after)})
+
+def _context(context: Optional[str]) -> str:
+    """Проверяет контекст диалога из запроса; неизвестный — 400 со списком допустимых."""
+    try:
+        return contexts.resolve(context)
+    except UnknownContext as e:
+        raise HTTPException(400, f"{e}; known: {', '.join(contexts.names())}")
+
+def _ids(terminal: Optional[str], session: Optional[str], headers) -> tuple:
+    """
+    Терминал и сессия 1С из параметров или заголовков X-Terminal-Id / X-Session-Id.
+    Сессия по умолчанию совпадает с терминалом. Неверный идентификатор — 400.
+    """
+    try:
+        terminal = check_id(terminal or headers.get("X-Terminal-Id"))
+        session = check_id(session or headers.get("X-Session-Id"), "session")
+    except InvalidTerminal as e:
+        raise HTTPException(400, str(e))
+    return terminal, session or terminal
 
 # --- Вспомогательные функции ---
-def save_tmp(upload: UploadFile) -> pathlib.Path:
+def ingest(upload: UploadFile) -> AudioBuffer:
     """
-    Сохраняет загруженный файл во временную папку и конвертирует его в WAV 16 kHz моно через ffmpeg, если это нужно.
+    Декодирует загруженный файл прямо в память в PCM 16 kHz моно — без временных файлов.
+    WAV и PCM разбираются на месте, остальные форматы идут через пул ffmpeg.
     :param upload: загруженный файл от клиента
-    :return: путь к сохраненному *.wav или исходному файлу
-    """
-    # Определяем расширение файла или .bin по умолчанию
-    suffix = pathlib.Path(upload.filename or "audio").suffix or ".bin"
-    # Создаем уникальную временную папку внутри настроенной директории
-    tmp_dir = pathlib.Path(tempfile.mkdtemp(prefix="voice_", dir=settings.tmp_dir))
-    raw_path = tmp_dir / f"in{suffix}"  # Полный путь для исходного файла
-    logger.debug("save_tmp: writing raw upload to %s", raw_path)
-    # Копируем содержимое загруженного файла во временный файл
-    with raw_path.open("wb") as f:
-        shutil.copyfileobj(upload.file, f)
-
-    # Проверяем, нужно ли конвертировать в WAV
-    if suffix.lower() != ".wav":
-        wav_path = raw_path.with_suffix(".wav")
-        # Формируем команду ffmpeg для конвертации аудио
-        cmd = [
-            "ffmpeg", "-y",  # перезаписывать без запроса
-            "-i", str(raw_path),  # входной файл
-            "-ar", "16000",  # частота дискретизации 16 kHz
-            "-ac", "1",  # моно канал
-            "-c:a", "pcm_s16le",  # PCM 16-bit
-            str(wav_path)
-        ]
-        logger.debug("save_tmp: converting via ffmpeg: %s", " ".join(cmd))
-        # Запускаем ffmpeg и ждем завершения
-        result = subprocess.run(cmd, capture_output=True)
-        if result.returncode != 0:
-            # Если конвертация провалилась, логируем stderr и возвращаем ошибку клиенту
-            logger.error("ffmpeg stderr: %s", result.stderr.decode(errors="ignore"))
-            raise HTTPException(400, f"FFmpeg error: {result.stderr.decode()}")
-        return wav_path
-
-    # Если файл уже *.wav, возвращаем его путь без изменений
-    return raw_path
-
-
-def send_to_1c(intent: str, fields: dict) -> None:
-    """
-    Отправляет команду и поля в 1С через COM интерфейс.
-    При неудаче сохраняет команду в очередь pending_commands для повторной попытки.
+    :return: аудиобуфер, общий для Vosk и WhisperX
+    """
+    data = upload.file.read()
+    logger.debug("ingest: %d bytes, filename=%s", len(data), upload.filename)
+    try:
+        return decode_bytes(data, upload.filename)
+    except AudioDecodeError as e:
+        # Если конвертация провалилась, возвращаем ошибку клиенту
+        raise HTTPException(400, str(e))
+
+
+async def _journal_command(result: dict, session: Optional[str] = None) -> Optional[int]:
+    """Записывает команду в журнал до отправки (после fsync); None — журнал недоступен."""
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            # без приемника команда сразу ждет, пока ее заберет 1С
+            None, journal.append, result.get("intent"), result.get("fields", {}), sink is None, session
+        )
+    except Exception:
+        logger.exception("Не удалось записать команду в журнал — отправляем без гарантии доставки")
+        return None
+
+
+def send_to_1c(command_id: Optional[int], intent: str, fields: dict) -> None:
+    """
+    Отправляет команду и поля в 1С через приемник (по умолчанию COM).
+    Успех подтверждается в журнале, неудача откладывает команду для повтора.
+    Доставку ждем не дольше sink_timeout: зависший вызов 1С не держит поток пула,
+    а команда остается в журнале недоставленной.
+    :param command_id: номер команды в журнале (None — команда не записана)
     :param intent: имя интента (действия)
     :param fields: словарь параметров для интента
     """
-    # COM нужно инициализировать в каждом потоке
-    pythoncom.CoInitialize()
+    started = time.perf_counter()
     try:
-        # Подключаемся к COMConnector 1С по пути к информационной базе
-        connector = Dispatch("V83.COMConnector")
-        ib_path = r'File="C:\Users\elozo\OneDrive\Документы\InfoBase7"'
-        conn = connector.Connect(ib_path)
-
-        # Опционально: логируем доступные методы COM-соединения
-        available = [m for m in dir(conn) if not m.startswith("_")]
-        logger.debug("Экспортные процедуры в conn: %s", available)
-
-        # Сериализуем поля в JSON (с сохранением русских символов)
-        payload = json.dumps(fields or {}, ensure_ascii=False)
-        logger.debug("Передаваемые данные в 1С через COM: intent=%s, fields=%s", intent, payload)
-
-        # Вызываем метод 1С для записи команды в регистр
-        conn.COMConnection.WriteTheCommandToTheRegister(intent, payload)
-        logger.info("✔ Команда успешно записана через COM")
+        # Соединение с базой уже открыто потоком приемника; команда может уйти в пачке с соседними
+        future = sink.submit(intent, fields or {})
+        future.exception(settings.sink_timeout)
+    except FutureTimeout:
+        # не откладываем сразу: повтор встал бы в очередь за зависшим вызовом и ушел бы дважды.
+        # Итог подтвердится, когда вызов вернется; не вернется до конца lease — повторит RetryWorker
+        logger.warning("⌛ 1С не ответила за %g с — команда %s остается в журнале", settings.sink_timeout, command_id)
+        metrics.DELIVERIES.inc(sink.name, "timeout")
+        future.add_done_callback(lambda f: _delivered(command_id, f, started))
+        return
     except Exception as e:
-        # При ошибке логируем и сохраняем команду в очередь на повтор
-        logger.error("❌ Ошибка отправки в 1С через COM: %s — добавляю в очередь", e)
-        pending_commands.append({"intent": intent, "fields": fields or {}})
-    finally:
-        # Всегда деинициализируем COM
-        pythoncom.CoUninitialize()
+        # приемник закрыт — команду повторит журнал
+        future = Future()
+        future.set_exception(e)
+    _delivered(command_id, future, started)
+
+
+def _delivered(command_id: Optional[int], future: Future, started: float) -> None:
+    """Итог отправки: подтверждение в журнале или отсрочка для повтора."""
+    error = future.exception()
+    if error is not None:
+        # При ошибке логируем; повтор — по журналу (фоновый поток или опрос /intent)
+        logger.error("❌ Ошибка отправки в 1С через %s: %s — повтор по журналу", sink.name, error)
+        metrics.DELIVERIES.inc(sink.name, "error")
+        if command_id is not None:
+            journal.defer(command_id, str(error))
+        return
+    logger.info("✔ Команда успешно записана через %s", sink.name)
+    metrics.STAGE_SECONDS.observe(time.perf_counter() - started, "deliver")
+    metrics.DELIVERIES.inc(sink.name, "ok")
+    if command_id is not None:
+        journal.ack(command_id, sink.name)
 
 # --- HTTP-эндпоинты FastAPI ---
 @app.get("/ping")
@@ -132,53 +296,561 @@ async def ping():
     """
     return JSONResponse({"status": "ok"})
 
+@app.get("/ready")
+async def ready():
+    """
+    Готовность для балансировщика: 200, когда быстрый путь (Vosk) загружен и прогрет,
+    иначе 503. В теле — состояние каждой модели.
+    """
+    try:
+        is_ready, models = backend.ready(), backend.models_status()
+    except OSError as e:
+        # сервер инференса недоступен
+        is_ready, models = False, {"error": str(e)}
+    return JSONResponse(
+        {"ready": is_ready, "models": models},
+        status_code=200 if is_ready else 503,
+    )
+
+def _wake_intent_waiters(sessions: Optional[Set[str]]) -> None:
+    """Будит ожидающих сессий sessions; None — будит всех (в том числе опросы без сессии)."""
+    if sessions is None:
+        groups = list(_intent_waiters.values())
+    else:
+        groups = [_intent_waiters[s] for s in sessions if s in _intent_waiters]
+    for waiters in groups:
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+def _owner(session: Optional[str]) -> str:
+    """Владелец выданных команд: курсор одной сессии не подтверждает команды другой."""
+    return f"{_POLL_OWNER}:{session}" if session else _POLL_OWNER
+
+
+async def _claim_commands(limit: int, wait: float, session: Optional[str] = None) -> list:
+    """
+    Забирает до limit ожидающих команд сессии; если их нет — ждет до wait секунд.
+    Пробуждение — по сигналу журнала; раз в intent_recheck журнал перечитывается,
+    чтобы заметить команды, записанные другим процессом (uvicorn --workers).
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    waiters = _intent_waiters.setdefault(session, set())
+    while True:
+        # ожидающий регистрируется до проверки журнала — сигнал между ними не потеряется
+        waiter = loop.create_future()
+        waiters.add(waiter)
+        try:
+            if await loop.run_in_executor(None, journal.has_ready, session):
+                commands = await loop.run_in_executor(None, journal.claim, limit, False, _owner(session), session)
+                if commands:
+                    return commands
+            left = deadline - loop.time()
+            if left <= 0:
+                return []
+            await asyncio.wait({waiter}, timeout=min(left, settings.intent_recheck))
+        finally:
+            waiters.discard(waiter)
+            if not waiters and _intent_waiters.get(session) is waiters:
+                del _intent_waiters[session]
+
+
+def _command_batch(commands: list) -> dict:
+    return {
+        "commands": [{"id": c["id"], "intent": c["intent"], "fields": c["fields"]} for c in commands],
+        "cursor": commands[-1]["id"],
+    }
+
+
+async def _ack_cursor(cursor: Optional[int], session: Optional[str] = None) -> int:
+    if cursor is None:
+        return 0
+    return await asyncio.get_running_loop().run_in_executor(None, journal.ack_through, cursor, _owner(session))
+
+
+def _poll_session(request: Request, session: Optional[str]) -> Optional[str]:
+    try:
+        return check_id(session or request.headers.get("X-Session-Id"), "session")
+    except InvalidTerminal as e:
+        raise HTTPException(400, str(e))
+
+
 @app.get("/intent")
-async def get_intent():
+async def get_intent(request: Request, wait: Optional[float] = None, limit: Optional[int] = None,
+                     cursor: Optional[int] = None, session: Optional[str] = None):
     """
-    Эндпоинт для фонового опроса 1С.
-    Возвращает одну отложенную команду или 204, если очередь пуста.
+    Эндпоинт для опроса 1С.
+    session (или заголовок X-Session-Id) — сессия 1С: отдаются только ее команды
+    и команды без адресата. Без сессии — только команды без адресата.
+    Без wait/limit/cursor — как раньше: одна отложенная команда {"intent", "fields"} или сразу 204.
+    С параметрами — пакетный долгий опрос:
+      cursor — подтверждает все полученные ранее команды с id <= cursor;
+      limit — сколько команд отдать за раз (до intent_batch_max);
+      wait — сколько секунд держать запрос, если команд нет (до intent_wait_max).
+    Ответ {"commands": [{"id", "intent", "fields"}, ...], "cursor": id последней} или 204 по таймауту.
+    Неподтвержденные команды выдаются повторно после истечения lease.
     """
-    if pending_commands:
-        cmd = pending_commands.popleft()  # Забираем первую команду из очереди
-        logger.info("/intent: delivering pending command %s", cmd)
-        return JSONResponse(cmd)
-    # Если команд нет, отдаем 204 No Content
-    return Response(status_code=204)
+    session = _poll_session(request, session)
+    if wait is None and limit is None and cursor is None:
+        claimed = await asyncio.get_running_loop().run_in_executor(
+            None, journal.claim, 1, False, _owner(session), session
+        )
+        if claimed:
+            cmd = claimed[0]  # Забираем самую старую недоставленную команду
+            logger.info("/intent: delivering pending command %s", cmd)
+            journal.ack(cmd["id"], _owner(session))
+            return JSONResponse({"intent": cmd["intent"], "fields": cmd["fields"]})
+        # Если команд нет, отдаем 204 No Content
+        return Response(status_code=204)
+
+    await _ack_cursor(cursor, session)
+    limit = max(1, min(limit or 1, settings.intent_batch_max))
+    commands = await _claim_commands(limit, max(0.0, min(wait or 0.0, settings.intent_wait_max)), session)
+    if not commands:
+        return Response(status_code=204)
+    logger.info("/intent: delivering %d command(s) up to #%d to session %s",
+                len(commands), commands[-1]["id"], session)
+    return JSONResponse(_command_batch(commands))
+
+
+@app.post("/intent/ack")
+async def ack_intent(request: Request, cursor: int, session: Optional[str] = None):
+    """Подтверждает все команды сессии, выданные через /intent или /intent/stream, с id <= cursor."""
+    return JSONResponse({"acked": await _ack_cursor(cursor, _poll_session(request, session))})
+
+
+@app.get("/intent/stream")
+async def intent_stream(request: Request, limit: int = 10, cursor: Optional[int] = None,
+                        session: Optional[str] = None):
+    """
+    Доставка команд по Server-Sent Events: событие "commands" с тем же телом, что у
+    пакетного /intent, и id = курсор. Подтверждение — POST /intent/ack?cursor=...,
+    параметр cursor или заголовок Last-Event-ID при переподключении.
+    Пока команд нет, раз в intent_keepalive секунд идет комментарий-пинг.
+    session — как у /intent.
+    """
+    session = _poll_session(request, session)
+    last_event = request.headers.get("Last-Event-ID")
+    if cursor is None and last_event and last_event.isdigit():
+        cursor = int(last_event)
+    await _ack_cursor(cursor, session)
+    limit = max(1, min(limit, settings.intent_batch_max))
+
+    async def events():
+        yield "retry: 1000\n\n"
+        while not await request.is_disconnected():
+            commands = await _claim_commands(limit, settings.intent_keepalive, session)
+            if not commands:
+                yield ": keepalive\n\n"
+                continue
+            batch = _command_batch(commands)
+            yield f"id: {batch['cursor']}\nevent: commands\ndata: {json.dumps(batch, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """
+    Метрики в текстовом формате Prometheus: гистограммы этапов, выбор движка,
+    причины фолбэка, очереди, недоставленные команды 1С, время загрузки моделей.
+    При uvicorn --workers каждый воркер отдает свои счетчики.
+    """
+    def collect() -> str:
+        families = metrics.REGISTRY.collect()
+        try:
+            families += _model_gauges()
+            if settings.inference_mode == "remote":
+                families += metrics.with_labels(backend.metrics(), process="inference")
+        except OSError as e:
+            # сервер инференса недоступен — свои метрики все равно отдаем
+            logger.warning("/metrics: inference server unavailable: %s", e)
+        return metrics.render(families)
+
+    text = await asyncio.get_running_loop().run_in_executor(None, collect)
+    return Response(text, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/stats")
+async def stats():
+    """
+    Состояние внутренних очередей и пулов сервера.
+    """
+    return JSONResponse({
+        "scheduler": scheduler.stats(),
+        **backend.stats(),
+        "models": backend.models_status(),
+        "transcript_cache": transcripts.stats(),
+        "idempotency": idempotency.stats(),
+        "sink": sink.stats() if sink is not None else {"sink": "poll"},
+        "journal": {**journal.stats(), **(retry_worker.stats() if retry_worker is not None else {})},
+        "logging": logging_setup.stats(),
+        "audio_store": audio_store.stats(),
+        "intent_waiters": sum(len(w) for w in _intent_waiters.values()),
+        "intent_sessions_waiting": len(_intent_waiters),
+        "terminals": len(terminal_stats),
+        "pending_commands": journal.pending_count(),
+    })
+
+@app.get("/stats/terminals")
+async def stats_terminals():
+    """
+    По терминалам: число запросов, ошибки и время ответа /recognize;
+    по сессиям 1С: очередь недоставленных команд и задержка доставки.
+    Анонимный терминал (без идентификатора) и команды без сессии — под ключом "".
+    """
+    sessions = await asyncio.get_running_loop().run_in_executor(None, journal.session_stats)
+    return JSONResponse({"terminals": terminal_stats.stats(), "sessions": sessions})
+
+def _require_admin(request: Request) -> None:
+    """Админка: заголовок X-Admin-Token, а без настроенного токена — только с localhost."""
+    if settings.admin_token:
+        if request.headers.get("X-Admin-Token") != settings.admin_token:
+            raise HTTPException(403, "admin token required")
+    elif request.client is None or request.client.host not in ("127.0.0.1", "::1", "localhost"):
+        raise HTTPException(403, "admin endpoints are local-only without VOICE_ADMIN_TOKEN")
+
+@app.post("/admin/profile")
+async def start_profile(request: Request, mode: str = "sampling", requests: int = 50,
+                        seconds: float = 60.0, interval_ms: float = 5.0):
+    """
+    Включает профилирование следующих `requests` запросов /recognize (не дольше `seconds`).
+    mode=sampling — стеки рабочих потоков раз в interval_ms (collapsed stacks для flamegraph),
+    mode=cprofile — полный cProfile обработчиков (pstats). Одновременно идет одна сессия.
+    """
+    _require_admin(request)
+    try:
+        session = profiler.start(mode, requests, min(seconds, settings.profile_max_seconds), interval_ms)
+    except ProfileBusy as e:
+        raise HTTPException(409, str(e))
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    logger.warning("Профилирование %s включено: %s запросов, до %s с", session.mode, session.requests, session.seconds)
+    return JSONResponse(session.status())
+
+@app.get("/admin/profile")
+async def profile_status(request: Request):
+    _require_admin(request)
+    session = profiler.session
+    if session is None:
+        raise HTTPException(404, "no profile session")
+    return JSONResponse(session.status())
+
+@app.get("/admin/profile/result")
+async def profile_result(request: Request, format: Optional[str] = None, wait: float = 0.0):
+    """
+    Результат последней сессии: format=collapsed|text (sampling) или pstats|text (cprofile).
+    wait — сколько секунд подождать завершения идущей сессии.
+    """
+    _require_admin(request)
+    session = profiler.session
+    if session is None:
+        raise HTTPException(404, "no profile session")
+    if wait > 0 and not session.done.is_set():
+        await asyncio.get_running_loop().run_in_executor(
+            None, session.done.wait, min(wait, settings.profile_max_seconds)
+        )
+    if not session.done.is_set():
+        raise HTTPException(409, f"profile {session.id} is still running", headers={"Retry-After": "1"})
+    fmt = format or session.formats()[0]
+    try:
+        body = await asyncio.get_running_loop().run_in_executor(None, session.render, fmt)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    if fmt == "pstats":
+        return Response(body, media_type="application/octet-stream",
+                        headers={"Content-Disposition": f'attachment; filename="profile-{session.id}.pstats"'})
+    suffix = "folded" if fmt == "collapsed" else "txt"
+    return Response(body, media_type="text/plain; charset=utf-8",
+                    headers={"Content-Disposition": f'attachment; filename="profile-{session.id}.{suffix}"'})
+
+@app.delete("/admin/profile")
+async def stop_profile(request: Request):
+    """Досрочно завершает сессию; собранное остается доступным в /admin/profile/result."""
+    _require_admin(request)
+    session = profiler.session
+    if session is None:
+        raise HTTPException(404, "no profile session")
+    session.stop()
+    return JSONResponse(session.status())
 
 @app.post("/recognize")
 async def recognize(
     request: Request,
     background_tasks: BackgroundTasks,
-    file: UploadFile = File(...)
+    file: UploadFile = File(...),
+    context: Optional[str] = None,
+    terminal: Optional[str] = None,
+    session: Optional[str] = None,
 ):
     """
     Основной эндпоинт: принимает аудио-файл, распознает команду и возвращает результат.
     Одновременно ставит отправку в 1С в фоновую задачу.
+    ?context= — контекст диалога (экран оператора), сужающий грамматику Vosk.
+    ?terminal= / X-Terminal-Id — терминал: очередность в пуле распознавания и статистика.
+    ?session= / X-Session-Id — сессия 1С, которой адресована команда (по умолчанию — терминал).
+    Заголовок Idempotency-Key: повтор с тем же ключом получает прежний ответ без повторной отправки в 1С.
     """
+    terminal, session = _ids(terminal, session, request.headers)
+    profile = profiler.begin_request()
+    try:
+        response = await _recognize_request(request, background_tasks, file, context, terminal, session)
+    except BaseException:
+        if profile is not None:
+            profile.release()
+        raise
+    if profile is not None:
+        # сессия отпускает запрос после фоновой отправки в 1С — она тоже попадает в профиль
+        background_tasks.add_task(profile.release)
+    return response
+
+
+async def _recognize_request(request: Request, background_tasks: BackgroundTasks, file: UploadFile,
+                             context: Optional[str], terminal: Optional[str], session: Optional[str]) -> Response:
     # IP клиента для логирования
     client = request.client.host
-    logger.info("🟢 /recognize from %s: filename=%s", client, file.filename)
+    logger.info("🟢 /recognize from %s (terminal %s): filename=%s, context=%s",
+                client, terminal, file.filename, context)
+    context = _context(context)
 
-    # 1) Сохраняем и конвертируем файл
+    key = request.headers.get("Idempotency-Key")
+    if key:
+        # ключи разных терминалов не пересекаются
+        key = f"{terminal or ''}|{key}"
+        state, previous = idempotency.begin(key)
+        if state != transcript_cache.NEW:
+            # повтор того же запроса: ждем (или сразу берем) ответ первого и в 1С не отправляем
+            logger.info("/recognize: replay of Idempotency-Key %s (%s)", key, state)
+            try:
+                # shield: таймаут одного повтора не должен отменять общий Future для остальных
+                result = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(previous)),
+                                                settings.idempotency_wait)
+            except asyncio.TimeoutError:
+                raise HTTPException(503, "Request with this Idempotency-Key is still in progress",
+                                    headers={"Retry-After": str(settings.retry_after)})
+            except HTTPException:
+                raise
+            except Exception as e:
+                raise HTTPException(500, f"Recognition error: {e}")
+            return JSONResponse({**result, "idempotent_replay": True})
+    started = time.perf_counter()
+    # от begin до complete ключ «в работе»: любая ошибка или отмена должна его освободить,
+    # иначе повторы с этим ключом ждали бы ответа, который не придет
     try:
-        path = save_tmp(file)
-        logger.debug("Uploaded file saved to %s", path)
-    except Exception as e:
-        logger.exception("save_tmp failed")
-        # Выбрасываем ошибку 400, если не удалось сохранить/конвертировать
-        raise HTTPException(400, f"Cannot save file: {e}")
+        result = await _recognize_upload(file, context, terminal)
+        # 3) Записываем команду в журнал и запускаем отправку в 1С в фоне, чтобы не тормозить ответ
+        if should_dispatch(result):
+            dispatch_started = time.perf_counter()
+            command_id = await _journal_command(result, session)
+            if sink is not None:
+                background_tasks.add_task(profiler.wrap(send_to_1c), command_id, result.get("intent"),
+                                          result.get("fields", {}))
+            result["timings_ms"]["dispatch"] = round((time.perf_counter() - dispatch_started) * 1000, 2)
+        total_ms = (time.perf_counter() - started) * 1000
+        result["timings_ms"]["total"] = round(total_ms, 2)
+        _record_metrics(result, total_ms)
+        if key:
+            idempotency.complete(key, result)
+    except BaseException as e:
+        terminal_stats.record(terminal, 0.0, ok=False)
+        if key:
+            # отмена (клиент отключился) — для ожидающих повторов это обычная ошибка
+            idempotency.abort(key, e if isinstance(e, Exception) else RuntimeError("request was cancelled"))
+        raise
+    terminal_stats.record(terminal, total_ms)
+
+    # 4) Возвращаем результат клиенту сразу
+    headers = {}
+    if settings.server_timing:
+        headers["Server-Timing"] = metrics.server_timing(result["timings_ms"], result.get("queue_wait_ms"))
+    return JSONResponse(result, headers=headers)
+
+
+def _record_metrics(result: dict, total_ms: float) -> None:
+    """Итог запроса в /metrics; этапы Vosk и WhisperX учитывает сам распознаватель."""
+    timings = result.get("timings_ms", {})
+    for stage in ("ingest", "dispatch"):
+        if stage in timings:
+            metrics.STAGE_SECONDS.observe(timings[stage] / 1000, stage)
+    metrics.STAGE_SECONDS.observe(total_ms / 1000, "total")
+    metrics.RECOGNITIONS.inc("cache" if result.get("cached") else result.get("engine", "?"),
+                             result.get("decision", "?"))
 
-    # 2) Распознаем и парсим команду
+
+async def _recognize_upload(file: UploadFile, context: str, terminal: Optional[str] = None) -> dict:
+    """Декодирование и распознавание загрузки: кэш по хешу PCM, Vosk и при необходимости WhisperX."""
+    environment = environment_version(contexts.version(context), backend.nomenclature_version())
+
+    timings = {}  # время этапов, мс: ingest, vosk, parse, whisper, whisper_parse (+ dispatch, total)
+
+    # 1) Декодируем файл в память, ищем его в кэше и распознаем через Vosk в пуле (полоса FAST)
+    def ingest_and_recognize():
+        started = time.perf_counter()
+        try:
+            audio = ingest(file)
+            logger.debug("Uploaded audio decoded: %.2f s", audio.duration)
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.exception("ingest failed")
+            # Выбрасываем ошибку 400, если не удалось прочитать/конвертировать
+            raise HTTPException(400, f"Cannot read file: {e}")
+        timings["ingest"] = round((time.perf_counter() - started) * 1000, 2)
+        cache_key = transcripts.key(audio, environment)
+        cached = transcripts.get(cache_key)
+        if cached is not None:
+            # тот же звук уже распознан — ни Vosk, ни WhisperX не нужны
+            return audio, cache_key, {**cached, "cached": True}
+        return audio, cache_key, backend.transcribe_fast(audio, context)
+
+    queue_wait = {}
     try:
-        result = transcribe_and_parse(path)  # Возвращает словарь с text, engine, intent и fields
+        (audio, cache_key, result), queue_wait[FAST] = await scheduler.run(profiler.wrap(ingest_and_recognize), lane=FAST, key=terminal)
+        # 2) Если Vosk не справился — WhisperX по тому же буферу в полосе SLOW
+        if not result.get("cached") and needs_fallback(result):
+            result, queue_wait[SLOW] = await scheduler.run(
+                profiler.wrap(backend.transcribe_fallback), audio, result, lane=SLOW, key=terminal
+            )
         logger.info("transcribe_and_parse result: %s", result)
+    except QueueFull as e:
+        raise _busy(e)
+    except ModelNotReady as e:
+        raise _not_ready(e)
+    except ConnectionError as e:
+        logger.error("Сервер инференса недоступен: %s", e)
+        raise HTTPException(503, str(e), headers={"Retry-After": str(settings.retry_after)})
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception("transcribe_and_parse failed")
         # Ошибка распознавания -> 500 Internal Server Error
         raise HTTPException(500, f"Recognition error: {e}")
+    # время этапов относится к этому запросу, а не к ответу — в кэш не попадает
+    timings.update(result.pop("timings_ms", None) or {})
+    # ответ без WhisperX, пока тот грузится, — временный, его не кэшируем
+    if not result.get("cached") and not result.get("fallback_unavailable"):
+        transcripts.put(cache_key, result)
+    if not result.get("cached"):
+        audio_store.offer(audio, result, context, terminal)
+    result["queue_wait_ms"] = {lane: round(ms, 2) for lane, ms in queue_wait.items()}
+    result["timings_ms"] = timings
+    return result
 
-    # 3) Запускаем отправку команды в 1С в фоне, чтобы не тормозить ответ
-    background_tasks.add_task(send_to_1c, result.get("intent"), result.get("fields", {}))
 
-    # 4) Возвращаем результат клиенту сразу
-    return JSONResponse(result)
+@app.websocket("/recognize/stream")
+async def recognize_stream(ws: WebSocket):
+    """
+    Потоковое распознавание: клиент шлет бинарные фреймы PCM s16le 16 kHz моно
+    по мере записи и текстовое сообщение {"event": "end"} в конце речи.
+    Сервер отвечает {"type": "partial", "text": ...} по ходу декодирования
+    и {"type": "result", ...} с интентом сразу после конца речи.
+    Команда уходит в 1С только после явного "end": при обрыве соединения фраза
+    отбрасывается. Поток длиннее stream_max_seconds или без фреймов дольше
+    stream_idle_timeout закрывается с ошибкой.
+    Параметры context, terminal и session — как у /recognize.
+    """
+    await ws.accept()
+    client = ws.client.host if ws.client else "?"
+    context = ws.query_params.get("context")
+    try:
+        context = contexts.resolve(context)
+        terminal, session = _ids(ws.query_params.get("terminal"), ws.query_params.get("session"), ws.headers)
+    except (UnknownContext, HTTPException) as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        await ws.send_json({"type": "error", "detail": detail, "contexts": contexts.names()})
+        await ws.close(code=1008)  # Policy Violation
+        return
+    logger.info("🟢 /recognize/stream from %s (terminal %s), context=%s", client, terminal, context)
+    queue_wait = {}
+    stream = None
+    max_bytes = int(settings.stream_max_seconds * TARGET_RATE) * 2  # PCM s16le
+    received = 0
+
+    try:
+        stream, _ = await scheduler.run(backend.StreamingSession, context, lane=FAST, key=terminal)
+
+        # 1) Принимаем аудио и сразу декодируем его в пуле
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(ws.receive(), settings.stream_idle_timeout)
+                except asyncio.TimeoutError:
+                    logger.warning("Поток без аудио %g с — закрываем", settings.stream_idle_timeout)
+                    await ws.send_json({"type": "error",
+                                        "detail": f"No audio for {settings.stream_idle_timeout:g} s"})
+                    await ws.close(code=1008)  # Policy Violation
+                    return
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000))
+                if message.get("bytes"):
+                    received += len(message["bytes"])
+                    if received > max_bytes:
+                        logger.warning("Поток длиннее %g с — закрываем", settings.stream_max_seconds)
+                        await ws.send_json({"type": "error",
+                                            "detail": f"Stream is longer than {settings.stream_max_seconds:g} s"})
+                        await ws.close(code=1009)  # Message Too Big
+                        return
+                    partial, _ = await scheduler.run(
+                        stream.accept, message["bytes"], lane=FAST, key=terminal
+                    )
+                    if partial is not None:
+                        await ws.send_json({"type": "partial", "text": partial})
+                elif message.get("text"):
+                    try:
+                        event = json.loads(message["text"]).get("event")
+                    except (ValueError, AttributeError):
+                        event = None
+                    if event == "end":
+                        break
+        except WebSocketDisconnect:
+            # без "end" оператор фразу не подтверждал — в 1С ничего не уходит
+            logger.info("Поток %s закрыт без end — фраза отброшена (%.2f s audio)", client, stream.duration)
+            return
+
+        # 2) Конец речи: финальный результат Vosk, при необходимости WhisperX по буферу
+        started = time.perf_counter()  # время ответа терминалу считается от конца речи
+        result, queue_wait[FAST] = await scheduler.run(stream.finish, lane=FAST, key=terminal)
+        if needs_fallback(result):
+            result, queue_wait[SLOW] = await scheduler.run(stream.fallback, result, lane=SLOW, key=terminal)
+        logger.info("stream result (%.2f s audio): %s", stream.duration, result)
+    except QueueFull as e:
+        logger.warning("Очередь %s заполнена — закрываем поток", e.lane)
+        terminal_stats.record(terminal, 0.0, ok=False)
+        await ws.send_json({"type": "error", "detail": "Recognition queue is full",
+                            "retry_after": e.retry_after})
+        await ws.close(code=1013)  # Try Again Later
+        return
+    except (ModelNotReady, ConnectionError) as e:
+        logger.warning("Распознавание недоступно (%s) — закрываем поток", e)
+        terminal_stats.record(terminal, 0.0, ok=False)
+        await ws.send_json({"type": "error", "detail": str(e), "retry_after": settings.retry_after})
+        await ws.close(code=1013)
+        return
+    except Exception as e:
+        logger.exception("stream recognition failed")
+        terminal_stats.record(terminal, 0.0, ok=False)
+        await ws.send_json({"type": "error", "detail": f"Recognition error: {e}"})
+        await ws.close(code=1011)
+        return
+    finally:
+        if stream is not None:
+            stream.close()  # распознаватель возвращается в пул даже при обрыве
+    result["queue_wait_ms"] = {lane: round(ms, 2) for lane, ms in queue_wait.items()}
+    timings = result.setdefault("timings_ms", {})
+
+    # 3) Команда — в журнал, отправку в 1С запускаем в фоне, ответ клиенту — сразу
+    if should_dispatch(result):
+        dispatch_started = time.perf_counter()
+        command_id = await _journal_command(result, session)
+        if sink is not None:
+            asyncio.get_running_loop().run_in_executor(
+                None, send_to_1c, command_id, result.get("intent"), result.get("fields", {})
+            )
+        timings["dispatch"] = round((time.perf_counter() - dispatch_started) * 1000, 2)
+    total_ms = (time.perf_counter() - started) * 1000
+    timings["total"] = round(total_ms, 2)  # от конца речи
+    _record_metrics(result, total_ms)
+    terminal_stats.record(terminal, total_ms)
+    await ws.send_json({"type": "result", **result})
+    await ws.close()
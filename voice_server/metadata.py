@@ -1,5 +1,40 @@
 # server/metadata.py
-from typing import Dict, List, Optional
+import json
+import pathlib
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class _PrefixTrie:
+    """Префиксное дерево ключей: поиск самого длинного ключа-префикса за O(длины строки)."""
+
+    __slots__ = ("_root",)
+
+    def __init__(self, items: Iterable[Tuple[str, str]]) -> None:
+        self._root: dict = {}
+        for key, value in items:
+            node = self._root
+            for ch in key:
+                node = node.setdefault(ch, {})
+            node[None] = value  # значение хранится под ключом None
+
+    def longest_prefix(self, text: str) -> Optional[str]:
+        node, found = self._root, None
+        for ch in text:
+            node = node.get(ch)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
+
+
+def load_names(path: str) -> List[str]:
+    """Имена объектов метаданных 1С из выгрузки: JSON-список или текст по одному имени в строке."""
+    text = pathlib.Path(path).read_text(encoding="utf-8-sig")
+    if text.lstrip().startswith("["):
+        return [str(n) for n in json.loads(text)]
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
 
 class MetadataMapper:
     __STATIC_MAP: Dict[str, str] = {
@@ -36,19 +71,39 @@ class MetadataMapper:
     }
 
     def __init__(self, dynamic_names: Optional[List[str]] = None) -> None:
-        self.__map = self.__STATIC_MAP.copy()
-        if dynamic_names:
-            for name in dynamic_names:
-                self.__map.setdefault(name.lower(), name)
+        self.__lock = threading.Lock()
+        # (словарь, дерево) меняются одной операцией присваивания — читатели без блокировок
+        self.__state = self.__build(self.__STATIC_MAP.copy(), dynamic_names)
+
+    @staticmethod
+    def __build(mapping: Dict[str, str], names: Optional[Iterable[str]]) -> Tuple[Dict[str, str], _PrefixTrie]:
+        if names:
+            for name in names:
+                mapping.setdefault(name.lower(), name)
+        return mapping, _PrefixTrie(mapping.items())
+
+    def load_dynamic(self, names: Iterable[str]) -> None:
+        """Пакетно добавляет имена метаданных к уже загруженным."""
+        with self.__lock:
+            self.__state = self.__build(self.__state[0].copy(), names)
+
+    def rebuild(self, names: Iterable[str]) -> None:
+        """Заменяет все динамические имена: новый индекс строится в стороне и подменяется атомарно."""
+        with self.__lock:
+            self.__state = self.__build(self.__STATIC_MAP.copy(), names)
+
+    def __len__(self) -> int:
+        return len(self.__state[0])
+
+    def as_dict(self) -> Dict[str, str]:
+        """Копия текущего словаря «ключ в нижнем регистре → имя метаданных»."""
+        return dict(self.__state[0])
 
     def normalize(self, raw: str) -> str:
         raw = raw.lower().strip()
         # ищем самый длинный ключ, который является префиксом raw
-        candidates = [k for k in self.__map if raw.startswith(k)]
-        if not candidates:
-            return raw
-        key = max(candidates, key=len)
-        return self.__map[key]
+        name = self.__state[1].longest_prefix(raw)
+        return raw if name is None else name
 
     def enrich_fields(self, intent: str, fields: Dict) -> Dict:
         for f in ("catalog", "doc", "report", "reg"):
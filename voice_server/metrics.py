@@ -0,0 +1,229 @@
+# voice_server/metrics.py
+"""
+Метрики сервера в текстовом формате Prometheus (/metrics).
+
+Счетчики и гистограммы — без внешних зависимостей: запись значения — это
+поиск корзины и инкремент под блокировкой метрики, поэтому их можно ставить
+прямо на горячий путь распознавания. Мгновенные величины (глубина очередей,
+очередь 1С, время загрузки моделей) не хранятся, а снимаются колбэками в
+момент опроса.
+
+В режиме общего сервера инференса этапы Vosk и WhisperX выполняются в его
+процессе: HTTP-воркер забирает их снимок (collect()) и отдает вместе со своими
+с меткой process="inference".
+"""
+from __future__ import annotations
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+Labels = Tuple[str, ...]
+# снимок одного семейства: (имя, тип, описание, [(суффикс, {метка: значение}, число)])
+Family = Tuple[str, str, str, List[Tuple[str, Dict[str, str], float]]]
+
+# корзины задержек, секунд: от долей миллисекунды (парсинг) до десятков секунд (WhisperX на CPU)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, values: Tuple[str, ...]) -> Labels:
+        if len(values) != len(self.labels):
+            raise ValueError(f"{self.name}: expected labels {self.labels}, got {values}")
+        return tuple(str(v) for v in values)
+
+    def _labels(self, key: Labels) -> Dict[str, str]:
+        return dict(zip(self.labels, key))
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def collect(self) -> Family:
+        with self._lock:
+            samples = [("_total", self._labels(k), v) for k, v in self._values.items()]
+        return self.name, self.type, self.help, samples
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (),
+                 buckets: Iterable[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # по набору меток: [счетчики корзин..., +Inf], сумма
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def collect(self) -> Family:
+        samples = []
+        with self._lock:
+            values = [(k, list(counts), total[0]) for k, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                samples.append(("_bucket", {**labels, "le": _format_bound(bound)}, cumulative))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, cumulative))
+        return self.name, self.type, self.help, samples
+
+
+class Gauge(_Metric):
+    """Снимается в момент опроса: fn возвращает число или [(значения меток, число)]."""
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, fn: Callable[[], object], labels: Iterable[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._fn = fn
+
+    def collect(self) -> Family:
+        value = self._fn()
+        if self.labels:
+            samples = [("", self._labels(self._key(tuple(k))), float(v)) for k, v in value]
+        else:
+            samples = [("", {}, float(value))] if value is not None else []
+        return self.name, self.type, self.help, samples
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            # повторная регистрация (перезагрузка модуля, второй экземпляр сервера) заменяет колбэк
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Iterable[str] = (),
+                  buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, fn: Callable[[], object], labels: Iterable[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help, fn, labels))
+
+    def collect(self) -> List[Family]:
+        """Снимок всех метрик (простые кортежи — их можно передать между процессами)."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        families = []
+        for metric in metrics:
+            try:
+                families.append(metric.collect())
+            except Exception:
+                # сломанный колбэк не должен ронять весь /metrics
+                continue
+        return families
+
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if bound == math.inf else repr(float(bound))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if not math.isfinite(value):
+        return "NaN" if math.isnan(value) else ("+Inf" if value > 0 else "-Inf")
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def with_labels(families: List[Family], **extra: str) -> List[Family]:
+    """Добавляет метки ко всем образцам (например, process="inference" для чужого снимка)."""
+    return [(name, kind, help, [(suffix, {**extra, **labels}, value) for suffix, labels, value in samples])
+            for name, kind, help, samples in families]
+
+
+def render(families: List[Family]) -> str:
+    """Текстовый формат Prometheus 0.0.4; семейства с одинаковым именем объединяются."""
+    merged: Dict[str, Family] = {}
+    for name, kind, help, samples in families:
+        if name in merged:
+            merged[name][3].extend(samples)
+        else:
+            merged[name] = (name, kind, help, list(samples))
+    lines = []
+    for name, kind, help, samples in merged.values():
+        if not samples:
+            continue
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for suffix, labels, value in samples:
+            label_text = ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels.items())
+            lines.append(f"{name}{suffix}{{{label_text}}} {_format_value(value)}" if label_text
+                         else f"{name}{suffix} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def server_timing(timings_ms: Dict[str, float], queue_wait_ms: Optional[Dict[str, float]] = None) -> str:
+    """Заголовок Server-Timing из timings_ms ответа (видно в DevTools и у прокси)."""
+    parts = [f"{stage};dur={ms}" for stage, ms in timings_ms.items()]
+    parts += [f"queue-{lane};dur={ms}" for lane, ms in (queue_wait_ms or {}).items()]
+    return ", ".join(parts)
+
+
+# ---------- метрики сервера ----------
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "voice_stage_seconds",
+    "Time spent in a recognition stage (ingest, vosk, parse, whisper, whisper_parse, dispatch, deliver, total)",
+    ("stage",),
+)
+RECOGNITIONS = REGISTRY.counter(
+    "voice_recognitions", "Finished recognitions by engine that produced the answer and policy decision",
+    ("engine", "decision"),
+)
+FALLBACKS = REGISTRY.counter(
+    "voice_whisper_fallbacks", "Why the fast path wanted WhisperX (whisper_unavailable: it was still loading)", ("reason",),
+)
+DELIVERIES = REGISTRY.counter(
+    "voice_1c_deliveries", "Commands sent to 1C by the server, by sink and outcome", ("sink", "result"),
+)
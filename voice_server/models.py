@@ -0,0 +1,132 @@
+# voice_server/models.py
+"""
+Фоновая загрузка и прогрев моделей.
+
+HTTP-сервер поднимается сразу, а модели загружаются в отдельном потоке
+в порядке регистрации (сначала Vosk — быстрый путь, затем WhisperX)
+и прогреваются тестовыми фразами. Состояние каждой модели отдает /ready.
+"""
+from __future__ import annotations
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+# состояния модели
+PENDING = "pending"
+LOADING = "loading"
+WARMING = "warming"
+READY = "ready"
+FAILED = "failed"
+
+
+class ModelNotReady(Exception):
+    """Модель еще загружается (или не загрузилась) — запрос нужно повторить позже."""
+
+    def __init__(self, name: str, state: str) -> None:
+        super().__init__(f"model {name!r} is {state}")
+        self.name = name
+        self.state = state
+
+
+class _Entry:
+    __slots__ = ("name", "loader", "warmup", "model", "state", "error", "load_s", "warmup_s")
+
+    def __init__(self, name: str, loader: Callable[[], Any], warmup: Callable[[], None] | None) -> None:
+        self.name = name
+        self.loader = loader
+        self.warmup = warmup
+        self.model: Any = None
+        self.state = PENDING
+        self.error: str | None = None
+        self.load_s: float | None = None
+        self.warmup_s: float | None = None
+
+
+class ModelManager:
+    def __init__(self) -> None:
+        self._entries: Dict[str, _Entry] = {}
+        self._order: List[str] = []
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+
+    def register(self, name: str, loader: Callable[[], Any], warmup: Callable[[], None] | None = None) -> None:
+        """Регистрирует модель; загрузка идет в порядке регистрации."""
+        with self._cond:
+            self._entries[name] = _Entry(name, loader, warmup)
+            self._order.append(name)
+
+    def start(self) -> None:
+        """Запускает фоновую загрузку (повторный вызов ничего не делает)."""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._load_all, name="model-loader", daemon=True)
+            self._thread.start()
+
+    def _set_state(self, entry: _Entry, state: str) -> None:
+        with self._cond:
+            entry.state = state
+            self._cond.notify_all()
+
+    def _load_all(self) -> None:
+        for name in self._order:
+            entry = self._entries[name]
+            try:
+                self._set_state(entry, LOADING)
+                started = time.perf_counter()
+                model = entry.loader()
+                entry.load_s = time.perf_counter() - started
+                with self._cond:
+                    entry.model = model
+                logger.info("Model %s loaded in %.1f s", name, entry.load_s)
+                if entry.warmup is not None:
+                    self._set_state(entry, WARMING)
+                    started = time.perf_counter()
+                    entry.warmup()
+                    entry.warmup_s = time.perf_counter() - started
+                    logger.info("Model %s warmed up in %.1f s", name, entry.warmup_s)
+                self._set_state(entry, READY)
+            except Exception as e:
+                logger.exception("Model %s failed to load", name)
+                entry.error = str(e)
+                self._set_state(entry, FAILED)
+
+    def get(self, name: str) -> Any:
+        """
+        Возвращает загруженную модель (прогрев может еще идти — он сам ею пользуется).
+        :raises ModelNotReady: модель еще не загружена или загрузка провалилась
+        """
+        entry = self._entries[name]
+        model = entry.model
+        if model is None:
+            raise ModelNotReady(name, entry.state)
+        return model
+
+    def available(self, name: str) -> bool:
+        """Модель загружена и ею уже можно пользоваться (возможно, еще идет прогрев)."""
+        return self._entries[name].model is not None
+
+    def ready(self, name: str) -> bool:
+        return self._entries[name].state == READY
+
+    def wait(self, name: str, timeout: float | None = None) -> bool:
+        """Ждет, пока модель станет готовой или упадет; True — готова."""
+        entry = self._entries[name]
+        with self._cond:
+            self._cond.wait_for(lambda: entry.state in (READY, FAILED), timeout)
+        return entry.state == READY
+
+    def status(self) -> dict:
+        with self._cond:
+            return {
+                name: {
+                    "state": e.state,
+                    "load_s": round(e.load_s, 2) if e.load_s is not None else None,
+                    "warmup_s": round(e.warmup_s, 2) if e.warmup_s is not None else None,
+                    **({"error": e.error} if e.error else {}),
+                }
+                for name, e in ((n, self._entries[n]) for n in self._order)
+            }
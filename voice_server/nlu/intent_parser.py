@@ -1,8 +1,12 @@
 # server/nlu/intent_parser.py
 from __future__ import annotations
+import copy
 import re
-from typing import Dict
-from ..metadata import MetadataMapper
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, List, Optional, Pattern, Tuple
+from ..config import settings
+from ..metadata import MetadataMapper, load_names
+from .. import nomenclature
 
 # корни слов 
 _STEMS = {
@@ -12,10 +16,16 @@ _STEMS = {
     "report":  r"актуальн|результат|остатк|остаток|хранени|продаж",
 }
 
-_mapper: MetadataMapper = MetadataMapper()
+# имена метаданных из выгрузки конфигурации 1С дополняют статический словарь
+_mapper: MetadataMapper = MetadataMapper(
+    load_names(settings.metadata_names_path) if settings.metadata_names_path else None
+)
 
 # ---------- вспомогательные фрагменты ----------
-_TRIGGER  = r"(?:покажи|выведи|открой|открою|открыть)"
+_TRIGGER_WORDS = ("покажи", "выведи", "открой", "открою", "открыть")
+_OPEN_WORDS    = ("открой", "открыть")
+_CREATE_WORDS  = ("создай", "создать", "добавь", "добавить", "начать", "начни", "заключить")
+_TRIGGER  = rf"(?:{'|'.join(_TRIGGER_WORDS)})"
 _CATALOG  = rf"(?P<catalog>(?:{_STEMS['catalog']})\w*)"
 _DOC_SINGLE = rf"(?:{_STEMS['doc']})\w*"             
 _DOC_PHRASE = rf"(?P<doc>{_DOC_SINGLE}(?:\s+\w+)*)"  
@@ -30,22 +40,22 @@ _REPORT_PREFIX = r"(?:отч[её]т(?:\s+\w+)*\s+)?"
 _STEMS["reg"] = r"закупочн|цена|цен|список" 
 _REG_SINGLE = rf"(?:{_STEMS['reg']})\w*"           
 _REG_PHRASE = rf"(?P<reg>{_REG_SINGLE}(?:\s+\w+)*)"   
-_CREATE = r"(?:создай|создать|добавь|добавить|начать|начни|заключить)"
+_CREATE = rf"(?:{'|'.join(_CREATE_WORDS)})"
 
 
 _PATTERNS = [
     # -------- Справочник: список / код / наименование --------
     (re.compile(rf"^{_TRIGGER}\s+(?:справочн\w*\s+)?{_CATALOG}{_OPT_CODE}$",
-                re.I), "OpenCatalogList"),
+                re.I), "OpenCatalogList", _TRIGGER_WORDS, "catalog"),
     (re.compile(rf"^(?:открой|открыть)\s+(?:справочн\w*\s+)?{_CATALOG}\s+код\s+(?P<code>\S+)",
-                re.I), "OpenCatalogByCode"),
+                re.I), "OpenCatalogByCode", _OPEN_WORDS, "catalog"),
     (re.compile(rf"^(?:открой|открыть)\s+(?:справочн\w*\s+)?{_CATALOG}\s+наименован\w*\s+(?P<name>.+)$",
-                re.I), "OpenCatalogByName"),
+                re.I), "OpenCatalogByName", _OPEN_WORDS, "catalog"),
 
     (re.compile(
         rf"^{_CREATE}\s+(?:нов(ый|ую|ого)\s+)?"    
         rf"{_CATALOG_PHRASE}$",
-        re.I),"CreateCatalog"),
+        re.I),"CreateCatalog", _CREATE_WORDS, "catalog"),
 
     # -------- Документы --------
 
@@ -57,7 +67,7 @@ _PATTERNS = [
             rf"(?P<number>\d+)$",            
             re.I,
         ),
-        "OpenDocumentByNumber",
+        "OpenDocumentByNumber", _TRIGGER_WORDS, "doc",
     ),
 
     # 2. Список документов
@@ -67,14 +77,14 @@ _PATTERNS = [
             rf"{_DOC_PHRASE}$",
             re.I,
         ),
-        "OpenDocumentList",
+        "OpenDocumentList", _TRIGGER_WORDS, "doc",
     ),
 
     (re.compile(
         rf"^{_CREATE}\s+(?:нов(ый|ую|ое)\s+)?"     
         rf"{_DOC_PHRASE}$",
         re.I),
-     "CreateDocument"),              
+     "CreateDocument", _CREATE_WORDS, "doc"),              
 
 
     # -------- Отчёты --------
@@ -84,7 +94,7 @@ _PATTERNS = [
         rf"{_REPORT_PREFIX}"       
         rf"{_REPORT_PHRASE}$",
         re.I),
-        "RunReport",
+        "RunReport", ("запусти", *_TRIGGER_WORDS), "report",
     ),
 
     # -------- Регистры сведений --------
@@ -94,23 +104,147 @@ _PATTERNS = [
         rf"(?:регистр(?:\s+сведений)?\s+)?"     
         rf"{_REG_PHRASE}$",                    
         re.I),
-        "OpenInfoRegister",
+        "OpenInfoRegister", _TRIGGER_WORDS, "reg",
     ),
 
-    # -------- fallback --------
-    (re.compile(r".+", re.I), "Unknown"),
+    # -------- fallback: всё остальное — Unknown (см. IntentMatcher.match) --------
 ]
 
+
+# ---------- компилированный матчер ----------
+class IntentMatcher:
+    """
+    Однопроходный выбор шаблонов вместо последовательного перебора всех регулярок.
+
+    Каждое правило объявляет допустимые первые слова (глагол-триггер) и группу
+    корней, которая обязана встретиться в тексте. По тексту один раз строится
+    набор признаков: первое слово (поиск в словаре) и группы корней (проход
+    по префиксному дереву корней для каждого слова). Регулярки с извлечением
+    полей запускаются только для правил, совместимых с этими признаками,
+    в исходном порядке приоритета.
+    """
+
+    def __init__(self, stems: Dict[str, str]) -> None:
+        # префиксное дерево корней: символ -> узел, "" -> группы, заканчивающиеся здесь
+        self._trie: dict = {}
+        for group, alternatives in stems.items():
+            for stem in alternatives.split("|"):
+                node = self._trie
+                for ch in stem:
+                    node = node.setdefault(ch, {})
+                node.setdefault("", set()).add(group)
+        self._rules: List[Tuple[Pattern, str]] = []
+        # индекс: первое слово (None — любое) -> группа корней (None — без фильтра) -> номера правил
+        self._index: Dict[Optional[str], Dict[Optional[str], List[int]]] = {}
+
+    def add(self, pattern: Pattern, intent: str,
+            lead: Optional[Iterable[str]] = None, group: Optional[str] = None) -> None:
+        """
+        :param lead: допустимые первые слова (None — любое)
+        :param group: группа корней, без которой шаблон не может совпасть (None — без фильтра)
+        """
+        idx = len(self._rules)
+        self._rules.append((pattern, intent))
+        for word in (None,) if lead is None else lead:
+            self._index.setdefault(word, {}).setdefault(group, []).append(idx)
+
+    def _groups(self, words: List[str]) -> FrozenSet[str]:
+        found = set()
+        for word in words:
+            node = self._trie
+            for ch in word:
+                node = node.get(ch)
+                if node is None:
+                    break
+                found.update(node.get("", ()))
+        return frozenset(found)
+
+    def candidates(self, text: str) -> List[Tuple[Pattern, str]]:
+        """Правила, которые в принципе могут совпасть с текстом, в порядке приоритета."""
+        words = text.split()
+        if not words:
+            return []
+        keys = (None, *self._groups(words[1:]))
+        idxs = set()
+        for lead in (words[0], None):
+            by_group = self._index.get(lead)
+            if by_group:
+                for key in keys:
+                    idxs.update(by_group.get(key, ()))
+        return [self._rules[i] for i in sorted(idxs)]
+
+    def has_lead(self, word: str, partial: bool = False) -> bool:
+        """Начинается ли какое-нибудь правило с этого слова (partial — слово еще не договорено)."""
+        if None in self._index:
+            return True
+        if partial:
+            return any(w.startswith(word) for w in self._index)
+        return word in self._index
+
+    def match(self, text: str) -> Dict:
+        for pattern, intent in self.candidates(text):
+            m = pattern.match(text)
+            if m:
+                fields = {k: v for k, v in m.groupdict().items() if v}
+                return {"intent": intent, "fields": fields}
+        return {"intent": "Unknown", "fields": {}}
+
+
+_matcher = IntentMatcher(_STEMS)
+for _pattern, _intent, _lead, _group in _PATTERNS:
+    _matcher.add(_pattern, _intent, _lead, _group)
+
+
+@lru_cache(maxsize=settings.intent_cache_size)
+def _parse_cached(text: str) -> Dict:
+    return _matcher.match(text)
+
+
 def parse(text: str) -> Dict:
-    text = text.strip().lower()
-    for pattern, intent in _PATTERNS:
-        m = pattern.search(text)
-        if m:
-            fields = {k: v for k, v in m.groupdict().items() if v}
-            return {"intent": intent, "fields": fields}
-    return {"intent": "Unknown", "fields": {}}
+    # результат из кэша копируем: parse_and_enrich меняет fields на месте
+    return copy.deepcopy(_parse_cached(text.strip().lower()))
+
+def has_intent_prefix(text: str) -> bool:
+    """
+    Может ли текст (в том числе промежуточная гипотеза) стать началом команды:
+    первое слово — глагол одного из шаблонов (или его начало, пока слово не договорено).
+    """
+    words = text.strip().lower().split()
+    if not words:
+        return True
+    return _matcher.has_lead(words[0], partial=len(words) == 1)
+
+# поля с наименованием товара, которые сверяются с номенклатурой (текущая схема и v0.2)
+_ITEM_FIELDS = ("name", "Номенклатура")
+
+
+def _match_nomenclature(result: Dict) -> None:
+    """
+    Наименование оператора остается в поле как сказано; найденная позиция уходит
+    в 1С отдельно (nomenclature_code, nomenclature_name, nomenclature_score) —
+    1С сама решает, верить ли нечеткому совпадению.
+    """
+    index = nomenclature.active()
+    if index is None:
+        return
+    fields = result["fields"]
+    for f in _ITEM_FIELDS:
+        if fields.get(f):
+            candidates = index.search(fields[f], k=3)
+            if candidates and candidates[0]["score"] >= settings.nomenclature_min_score:
+                best = candidates[0]
+                fields["nomenclature_code"] = best["article"] or best["barcode"]
+                fields["nomenclature_name"] = best["name"]
+                fields["nomenclature_score"] = best["score"]
+            result["nomenclature"] = candidates
+            break
+
+def stem_groups(text: str) -> FrozenSet[str]:
+    """Группы корней объектов (catalog, doc, reg, report), встречающиеся в тексте."""
+    return _matcher._groups(text.strip().lower().split())
 
 def parse_and_enrich(text: str) -> Dict:
     result = parse(text)
     result["fields"] = _mapper.enrich_fields(result["intent"], result["fields"])
+    _match_nomenclature(result)
     return result
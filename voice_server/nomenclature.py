@@ -0,0 +1,271 @@
+# voice_server/nomenclature.py
+"""
+Нечеткий поиск по номенклатуре.
+
+Распознанное наименование товара (fields["name"]) сопоставляется с выгрузкой
+номенклатуры из 1С (наименование, артикул, штрихкод). Индекс — инвертированный
+по символьным триграммам: кандидаты набираются по самым редким триграммам
+запроса (подсчет совпадений — numpy.bincount), затем ранжируются точным
+коэффициентом Дайса. Постинги хранятся в array('I') — компактно в памяти
+и в снимке на диске, который грузится без повторного разбора CSV.
+"""
+from __future__ import annotations
+import csv
+import logging
+import os
+import pickle
+import re
+import threading
+import zlib
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_SNAPSHOT_VERSION = 1
+_STOP_GRAM_SHARE = 0.02   # триграмма чаще чем у 2% позиций считается «стоп-триграммой»
+_STOP_GRAM_MIN = 1000      # ... но не реже этого числа позиций (малые каталоги)
+_MIN_GRAMS = 4             # минимум триграмм запроса, участвующих в подсчете
+_COUNT_SLACK = 3           # насколько кандидат может отставать от лучшего по числу совпадений
+_RERANK_FACTOR = 4         # кандидатов на точное ранжирование: k * фактор
+_NON_WORD = re.compile(r"[^0-9a-zа-я]+")
+
+# заголовки колонок выгрузки 1С → поле индекса
+_COLUMNS = {
+    "name": "name", "наименование": "name", "номенклатура": "name",
+    "article": "article", "артикул": "article",
+    "barcode": "barcode", "штрихкод": "barcode",
+}
+
+Item = Tuple[str, str, str]  # (наименование, артикул, штрихкод)
+
+
+def normalize(text: str) -> str:
+    """Нижний регистр, ё → е, все разделители — один пробел."""
+    return _NON_WORD.sub(" ", text.lower().replace("ё", "е")).strip()
+
+
+def trigrams(norm: str) -> set:
+    padded = f"  {norm} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NomenclatureIndex:
+    def __init__(self) -> None:
+        self._items: Dict[int, Item] = {}
+        self._norm: Dict[int, str] = {}
+        self._postings: Dict[str, array] = {}
+        self._codes: Dict[str, int] = {}   # артикул / штрихкод → id
+        self._next_id = 0
+        self._dead = 0                     # постинги удаленных позиций до компактификации
+        self._digest = 0                   # XOR crc32 позиций — версия содержимого для кэша ответов
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def version(self) -> str:
+        """Версия содержимого: одинаковая для одного набора позиций и после перезапуска."""
+        return f"{len(self._items)}:{self._digest:08x}"
+
+    # ---------- изменение ----------
+    def add(self, name: str, article: str = "", barcode: str = "") -> int:
+        """Добавляет позицию; позиция с тем же артикулом заменяется."""
+        norm = normalize(name)
+        with self._lock:
+            if article and article in self._codes:
+                self._remove(self._codes[article])
+            item_id = self._next_id
+            self._next_id += 1
+            self._items[item_id] = (name, article, barcode)
+            self._digest ^= _item_crc(self._items[item_id])
+            self._norm[item_id] = norm
+            for gram in trigrams(norm):
+                self._postings.setdefault(gram, array("I")).append(item_id)
+            for code in (article, barcode):
+                if code:
+                    self._codes[code] = item_id
+        return item_id
+
+    def add_many(self, items: Iterable[Item]) -> None:
+        for name, article, barcode in items:
+            self.add(name, article, barcode)
+
+    def remove(self, code: str) -> bool:
+        """Удаляет позицию по артикулу или штрихкоду."""
+        with self._lock:
+            item_id = self._codes.get(code)
+            if item_id is None:
+                return False
+            self._remove(item_id)
+            if self._dead > len(self._items) * 8:
+                self._compact()
+            return True
+
+    def _remove(self, item_id: int) -> None:
+        item = self._items.pop(item_id)
+        self._digest ^= _item_crc(item)
+        _, article, barcode = item
+        # постинги чистятся лениво — при компактификации
+        self._dead += len(trigrams(self._norm.pop(item_id)))
+        for code in (article, barcode):
+            if code and self._codes.get(code) == item_id:
+                del self._codes[code]
+
+    def _compact(self) -> None:
+        items = self._items
+        for gram, ids in list(self._postings.items()):
+            alive = array("I", (i for i in ids if i in items))
+            if alive:
+                self._postings[gram] = alive
+            else:
+                del self._postings[gram]
+        self._dead = 0
+
+    # ---------- поиск ----------
+    def search(self, query: str, k: int = 5) -> List[dict]:
+        """Top-k позиций по убыванию сходства (0..1); точный артикул/штрихкод — 1.0."""
+        code = query.strip()
+        exact = self._codes.get(code) if code else None
+        if exact is not None and exact in self._items:
+            return [self._result(exact, 1.0)]
+        norm = normalize(query)
+        if not norm:
+            return []
+        grams = trigrams(norm)
+        # частые триграммы («ка», «ор ») почти ничего не различают, но дают основную
+        # часть постингов — считаем их, только если редких в запросе слишком мало
+        cap = max(_STOP_GRAM_MIN, int(len(self._items) * _STOP_GRAM_SHARE))
+        with self._lock:
+            lists = sorted((self._postings[g] for g in grams if g in self._postings), key=len)
+            if not lists:
+                return []
+            keep = max(_MIN_GRAMS, sum(len(ids) <= cap for ids in lists))
+            # concatenate копирует — после выхода из блокировки постинги можно дополнять
+            ids = np.concatenate([np.frombuffer(a, dtype=np.uint32) for a in lists[:keep]])
+        counts = np.bincount(ids)
+        # кандидаты — позиции, совпавшие почти по всем учтенным триграммам
+        best = np.flatnonzero(counts >= max(1, int(counts.max()) - _COUNT_SLACK))
+        n = k * _RERANK_FACTOR
+        if len(best) > n:
+            best = best[np.argpartition(counts[best], len(best) - n)[len(best) - n:]]
+        items, norms = self._items, self._norm
+        scored = []
+        for item_id in best.tolist():
+            norm_name = norms.get(item_id)
+            if norm_name is None:  # удалена, постинг еще не вычищен
+                continue
+            other = trigrams(norm_name)
+            scored.append((2 * len(grams & other) / (len(grams) + len(other)), item_id))
+        scored.sort(reverse=True)
+        return [self._result(item_id, score) for score, item_id in scored[:k] if item_id in items]
+
+    def _result(self, item_id: int, score: float) -> dict:
+        name, article, barcode = self._items[item_id]
+        return {"name": name, "article": article, "barcode": barcode, "score": round(score, 3)}
+
+    # ---------- загрузка и снимок ----------
+    @classmethod
+    def from_csv(cls, path: str, encoding: str = "utf-8-sig") -> "NomenclatureIndex":
+        """Выгрузка 1С: CSV с заголовком (наименование;артикул;штрихкод) или без него."""
+        index = cls()
+        with open(path, encoding=encoding, newline="") as f:
+            sample = f.read(4096)
+            f.seek(0)
+            dialect = csv.Sniffer().sniff(sample, delimiters=";,\t")
+            rows = csv.reader(f, dialect)
+            first = next(rows, None)
+            if first is None:
+                return index
+            header = [_COLUMNS.get(c.strip().lower()) for c in first]
+            if "name" in header:
+                cols = {field: header.index(field) for field in ("name", "article", "barcode") if field in header}
+            else:
+                cols = {"name": 0, "article": 1, "barcode": 2}
+                rows = _chain_row(first, rows)
+            for row in rows:
+                values = {field: row[i].strip() if i < len(row) else "" for field, i in cols.items()}
+                if values.get("name"):
+                    index.add(values["name"], values.get("article", ""), values.get("barcode", ""))
+        return index
+
+    def save(self, path: str) -> None:
+        """Пишет снимок атомарно (через временный файл)."""
+        with self._lock:
+            self._compact()
+            state = {
+                "version": _SNAPSHOT_VERSION,
+                "items": self._items,
+                "norm": self._norm,
+                "postings": self._postings,
+                "next_id": self._next_id,
+            }
+            tmp = f"{path}.tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "NomenclatureIndex":
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        if state.get("version") != _SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported nomenclature snapshot version {state.get('version')!r}")
+        index = cls()
+        index._items = state["items"]
+        index._postings = state["postings"]
+        index._next_id = state["next_id"]
+        index._norm = state["norm"]
+        for item_id, item in index._items.items():
+            index._digest ^= _item_crc(item)
+            for code in (item[1], item[2]):
+                if code:
+                    index._codes[code] = item_id
+        return index
+
+
+def _item_crc(item: Item) -> int:
+    return zlib.crc32("\0".join(item).encode("utf-8"))
+
+
+def _chain_row(first: list, rows):
+    yield first
+    yield from rows
+
+
+def load_index(csv_path: str, snapshot_path: Optional[str] = None) -> NomenclatureIndex:
+    """Снимок, если он свежее CSV; иначе разбор CSV и запись нового снимка."""
+    if snapshot_path and os.path.exists(snapshot_path) and (
+        not os.path.exists(csv_path) or os.path.getmtime(snapshot_path) >= os.path.getmtime(csv_path)
+    ):
+        try:
+            return NomenclatureIndex.load(snapshot_path)
+        except Exception:
+            logger.exception("Nomenclature snapshot %s is unreadable, rebuilding from CSV", snapshot_path)
+    index = NomenclatureIndex.from_csv(csv_path)
+    if snapshot_path:
+        index.save(snapshot_path)
+    return index
+
+
+# индекс, которым пользуется парсер; устанавливается фоновой загрузкой моделей
+_active: Optional[NomenclatureIndex] = None
+
+
+def activate(index: NomenclatureIndex) -> NomenclatureIndex:
+    global _active
+    _active = index
+    return index
+
+
+def active() -> Optional[NomenclatureIndex]:
+    return _active
+
+
+def version() -> str:
+    """Версия активного индекса для ключа кэша распознавания ("none" — еще не загружен)."""
+    index = _active
+    return index.version if index is not None else "none"
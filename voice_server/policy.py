@@ -0,0 +1,41 @@
+# voice_server/policy.py
+"""
+Политика выбора движка по уверенности Vosk.
+
+Модуль не зависит от моделей: его используют и процесс с моделями,
+и «тонкие» HTTP-воркеры в режиме общего сервера инференса.
+"""
+from __future__ import annotations
+
+from .config import settings
+
+# ---------- Политика выбора движка ----------
+DECISION_VOSK = "vosk"        # гипотеза Vosk принята, WhisperX не нужен
+DECISION_WHISPER = "whisper"  # нужен фолбэк на WhisperX
+DECISION_REPEAT = "repeat"    # уверенность слишком низкая — просим оператора повторить
+
+
+def decide(intent: str, confidence: float) -> str:
+    """
+    Выбирает дальнейший путь по уверенности Vosk:
+    - conf >= vosk_accept_confidence — принимаем Vosk даже при Unknown (фраза вне грамматики,
+      но услышана уверенно, WhisperX тут только тратит CPU);
+    - conf <  vosk_reject_confidence — low_confidence_action: WhisperX или «повторите»,
+      даже если текст совпал с шаблоном;
+    - между порогами — WhisperX только для Unknown.
+    """
+    if confidence >= settings.vosk_accept_confidence:
+        return DECISION_VOSK
+    if confidence < settings.vosk_reject_confidence:
+        return settings.low_confidence_action
+    return DECISION_WHISPER if intent == "Unknown" else DECISION_VOSK
+
+
+def needs_fallback(result: dict) -> bool:
+    """Нужно ли после быстрого пути запускать WhisperX."""
+    return result.get("decision") == DECISION_WHISPER
+
+
+def should_dispatch(result: dict) -> bool:
+    """Отправлять ли результат в 1С (команды с просьбой повторить не отправляются)."""
+    return result.get("decision") != DECISION_REPEAT
@@ -0,0 +1,252 @@
+# voice_server/profiling.py
+"""
+Профилирование по запросу на живом трафике.
+
+Администратор включает сессию профилирования (POST /admin/profile) на N
+следующих запросов /recognize или на T секунд. Попавшие в сессию запросы
+помечаются через contextvar; main.py оборачивает их работу в рабочих потоках
+(декодирование и Vosk, фолбэк на WhisperX, отправка в 1С) функцией wrap().
+
+Режимы:
+- "cprofile" — детерминированный cProfile на каждую обернутую функцию,
+  профили складываются в один pstats;
+- "sampling" — фоновый поток раз в interval_ms снимает стеки потоков, которые
+  сейчас выполняют помеченную работу, и копит их в формате collapsed stacks
+  (flamegraph.pl, speedscope).
+
+Без активной сессии wrap() возвращает функцию как есть, а begin_request() —
+это одно чтение атрибута: накладных расходов нет. В режиме remote распознавание
+идет в сервере инференса, и профиль HTTP-воркера покажет только ожидание IPC.
+"""
+from __future__ import annotations
+import contextvars
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Callable, Dict, Optional
+
+CPROFILE = "cprofile"
+SAMPLING = "sampling"
+
+_session: contextvars.ContextVar[Optional["ProfileSession"]] = contextvars.ContextVar("profile_session",
+                                                                                         default=None)
+
+
+class ProfileBusy(Exception):
+    """Сессия профилирования уже идет — одновременно допускается только одна."""
+
+
+class ProfileSession:
+    def __init__(self, mode: str, requests: int, seconds: float, interval_ms: float) -> None:
+        self.id = uuid.uuid4().hex[:12]
+        self.mode = mode
+        self.requests = requests
+        self.seconds = seconds
+        self.interval = interval_ms / 1000
+        self.started = time.time()
+        self._deadline = time.monotonic() + seconds
+        self._remaining = requests
+        self._inflight = 0
+        self._admitted = 0
+        self._lock = threading.Lock()
+        self._stats: Optional[pstats.Stats] = None
+        self._stacks: Counter = Counter()
+        self._samples = 0
+        self._threads: Dict[int, int] = {}  # поток → сколько помеченных задач в нем сейчас
+        self._closed = False
+        self.done = threading.Event()
+        self.finished: Optional[float] = None
+        self._thread = threading.Thread(target=self._run, name=f"profile-{self.id}", daemon=True)
+        self._thread.start()
+
+    # ---------- запросы ----------
+    def admit(self) -> bool:
+        """Берет запрос в сессию, пока не исчерпан лимит запросов и времени."""
+        with self._lock:
+            if self._closed or self._remaining <= 0 or time.monotonic() >= self._deadline:
+                return False
+            self._remaining -= 1
+            self._inflight += 1
+            self._admitted += 1
+            return True
+
+    def release(self) -> None:
+        with self._lock:
+            self._inflight -= 1
+            last = self._remaining <= 0 and self._inflight <= 0
+        if last:
+            self.stop()
+
+    # ---------- работа в потоках ----------
+    def run(self, fn: Callable, *args, **kwargs):
+        if self.mode == CPROFILE:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # в этом потоке уже работает профилировщик (вложенный wrap) — внешний все учтет
+                return fn(*args, **kwargs)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profile.disable()
+                self._add_profile(profile)
+        tid = threading.get_ident()
+        with self._lock:
+            self._threads[tid] = self._threads.get(tid, 0) + 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                if self._threads[tid] <= 1:
+                    del self._threads[tid]
+                else:
+                    self._threads[tid] -= 1
+
+    def _add_profile(self, profile: cProfile.Profile) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+
+    # ---------- фоновый поток сессии ----------
+    def _run(self) -> None:
+        while not self.done.is_set():
+            left = self._deadline - time.monotonic()
+            if left <= 0:
+                break
+            if self.mode == SAMPLING:
+                self._sample()
+                self.done.wait(min(self.interval, left))
+            else:
+                self.done.wait(left)
+        self.stop()
+
+    def _sample(self) -> None:
+        with self._lock:
+            threads = list(self._threads)
+        if not threads:
+            return
+        frames = sys._current_frames()
+        for tid in threads:
+            frame = frames.get(tid)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                # снаружи внутрь, как ожидают flamegraph.pl и speedscope
+                self._stacks[";".join(reversed(stack))] += 1
+        with self._lock:
+            self._samples += 1
+
+    def stop(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self.finished = time.time()
+        self.done.set()
+
+    # ---------- результат ----------
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "id": self.id,
+                "mode": self.mode,
+                "running": not self._closed,
+                "requests_limit": self.requests,
+                "requests_profiled": self._admitted,
+                "inflight": self._inflight,
+                "seconds_limit": self.seconds,
+                "started": self.started,
+                "finished": self.finished,
+                "samples": self._samples if self.mode == SAMPLING else None,
+            }
+
+    def formats(self) -> tuple:
+        return ("pstats", "text") if self.mode == CPROFILE else ("collapsed", "text")
+
+    def render(self, fmt: str) -> bytes:
+        """
+        cprofile: "pstats" (marshal, как pstats.dump_stats; открывается snakeviz и pstats.Stats)
+        или "text" (топ по cumulative); sampling: "collapsed" или "text" (топ стеков).
+        """
+        if fmt not in self.formats():
+            raise ValueError(f"{self.mode} profile has formats {', '.join(self.formats())}")
+        with self._lock:
+            if self.mode == CPROFILE:
+                if self._stats is None:
+                    return b""
+                if fmt == "pstats":
+                    return marshal.dumps(self._stats.stats)
+                out = io.StringIO()
+                self._stats.stream = out
+                self._stats.sort_stats("cumulative").print_stats(60)
+                return out.getvalue().encode("utf-8")
+            stacks = self._stacks.most_common()
+        if fmt == "collapsed":
+            return "".join(f"{stack} {count}\n" for stack, count in stacks).encode("utf-8")
+        total = sum(count for _, count in stacks) or 1
+        lines = [f"{count:>7} {count / total:6.1%}  {stack.rsplit(';', 1)[-1]}  <- {stack}"
+                 for stack, count in stacks[:60]]
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class Profiler:
+    """Одна активная сессия и последняя завершенная — ее результат можно скачать."""
+
+    def __init__(self) -> None:
+        self.session: Optional[ProfileSession] = None
+        self._lock = threading.Lock()
+
+    def start(self, mode: str, requests: int, seconds: float, interval_ms: float = 5.0) -> ProfileSession:
+        if mode not in (CPROFILE, SAMPLING):
+            raise ValueError(f"unknown profile mode {mode!r}: {CPROFILE} or {SAMPLING}")
+        with self._lock:
+            if self.session is not None and not self.session.done.is_set():
+                raise ProfileBusy(f"profile {self.session.id} is running")
+            self.session = ProfileSession(mode, max(1, requests), max(0.1, seconds), max(1.0, interval_ms))
+            return self.session
+
+    def begin_request(self) -> Optional[ProfileSession]:
+        """
+        Помечает текущий запрос, если идет сессия и в ней есть место; None — не помечен.
+        Пометка живет в контексте задачи запроса; по окончании работы запроса
+        (включая фоновые задачи) нужно вызвать session.release().
+        """
+        session = self.session
+        if session is not None and (session.done.is_set() or not session.admit()):
+            session = None
+        # ставим и None: uvicorn может начать следующий запрос keep-alive из задачи предыдущего,
+        # и тогда тот унаследовал бы чужую пометку
+        _session.set(session)
+        return session
+
+    @staticmethod
+    def wrap(fn: Callable) -> Callable:
+        """
+        Вызывается в контексте запроса: вне сессии — fn без изменений,
+        иначе обертка, профилирующая fn в том потоке, где ее выполнят.
+        """
+        session = _session.get()
+        if session is None:
+            return fn
+
+        def profiled(*args, **kwargs):
+            return session.run(fn, *args, **kwargs)
+        return profiled
+
+
+profiler = Profiler()
@@ -0,0 +1,120 @@
+# voice_server/recognizer_pool.py
+"""
+Пул готовых KaldiRecognizer.
+
+Создание распознавателя с грамматикой каждый раз заново разбирает JSON
+и компилирует граф грамматики. Пул хранит готовые экземпляры по ключу
+(частота дискретизации, версия грамматики) и переиспользует их через Reset().
+"""
+from __future__ import annotations
+import hashlib
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+PoolKey = Tuple[int, str]  # (частота, версия грамматики)
+
+
+def grammar_version(grammar: str) -> str:
+    """Короткий хеш JSON-грамматики — меняется при любой правке grammar.json."""
+    return hashlib.sha1(grammar.encode("utf-8")).hexdigest()[:12]
+
+
+class RecognizerPool:
+    def __init__(self, factory: Callable[[int, str], object], max_idle: int) -> None:
+        """
+        :param factory: создает распознаватель по (частота, JSON-грамматика)
+        :param max_idle: сколько свободных экземпляров хранить на ключ (обычно = числу потоков)
+        """
+        self._factory = factory
+        self.max_idle = max(1, max_idle)
+        self._grammars: Dict[str, str] = {}
+        self._idle: Dict[PoolKey, List[object]] = {}
+        self._lock = threading.Lock()
+        # счетчики для /stats
+        self._hits = 0
+        self._misses = 0
+        self._constructed = 0
+        self._construct_ms = 0.0
+        self._in_use = 0
+
+    def register_grammar(self, grammar: str) -> str:
+        """Регистрирует JSON-грамматику и возвращает ее версию (ключ пула)."""
+        version = grammar_version(grammar)
+        with self._lock:
+            self._grammars.setdefault(version, grammar)
+        return version
+
+    def _construct(self, key: PoolKey) -> object:
+        rate, version = key
+        started = time.perf_counter()
+        rec = self._factory(rate, self._grammars[version])
+        elapsed = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self._constructed += 1
+            self._construct_ms += elapsed
+        logger.debug("RecognizerPool: built recognizer %s in %.1f ms", key, elapsed)
+        return rec
+
+    def prewarm(self, rate: int, version: str, count: int | None = None) -> None:
+        """Заранее создает распознаватели, чтобы первые запросы не платили за сборку."""
+        key = (rate, version)
+        count = self.max_idle if count is None else min(count, self.max_idle)
+        built = [self._construct(key) for _ in range(count)]
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            idle.extend(built[: self.max_idle - len(idle)])
+
+    def acquire(self, rate: int, version: str) -> object:
+        """Забирает распознаватель из пула (или создает новый при промахе)."""
+        key = (rate, version)
+        with self._lock:
+            idle = self._idle.get(key)
+            self._in_use += 1
+            if idle:
+                self._hits += 1
+                return idle.pop()
+            self._misses += 1
+        return self._construct(key)
+
+    def release(self, rate: int, version: str, rec: object) -> None:
+        """Сбрасывает состояние распознавателя и возвращает его в пул."""
+        rec.Reset()
+        key = (rate, version)
+        with self._lock:
+            self._in_use -= 1
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(rec)
+
+    def discard(self) -> None:
+        """Учитывает распознаватель, который не вернется в пул (ошибка во время декодирования)."""
+        with self._lock:
+            self._in_use -= 1
+
+    @contextmanager
+    def checkout(self, rate: int, version: str) -> Iterator[object]:
+        rec = self.acquire(rate, version)
+        try:
+            yield rec
+        except BaseException:
+            # состояние после ошибки непредсказуемо — экземпляр в пул не возвращаем
+            self.discard()
+            raise
+        self.release(rate, version, rec)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "in_use": self._in_use,
+                "constructed": self._constructed,
+                "construct_ms_total": round(self._construct_ms, 1),
+                "construct_ms_avg": round(self._construct_ms / self._constructed, 2) if self._constructed else 0.0,
+                "idle": {f"{rate}/{version}": len(v) for (rate, version), v in self._idle.items()},
+            }
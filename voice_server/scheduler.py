@@ -0,0 +1,234 @@
+# voice_server/scheduler.py
+"""
+Планировщик задач распознавания.
+
+Задачи выполняются на ограниченном пуле потоков, а не в event loop FastAPI.
+Есть две полосы: FAST (ввод аудио + Vosk) и SLOW (фолбэк на WhisperX).
+Рабочие потоки всегда сначала берут задачи из FAST, а одновременно в SLOW
+может быть занято не больше ``slow_slots`` потоков — так одна тяжелая фраза
+не задерживает быстрые команды остальных терминалов.
+Внутри полосы задачи разложены по терминалам и берутся по кругу: терминал,
+приславший десяток фраз подряд, не отодвигает соседей в конец очереди.
+При переполнении очереди (общей или терминала) задача сразу отклоняется
+исключением QueueFull. Лимит терминала действует только на задачи с
+терминалом: запросы без X-Terminal-Id (агенты с "TERMINAL_ID": null) ограничены
+лишь общей очередью полосы, иначе весь такой парк делил бы бюджет одного ТСД.
+"""
+from __future__ import annotations
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Any, Callable, Deque, Dict, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+FAST = "fast"  # полоса быстрого пути (Vosk)
+SLOW = "slow"  # полоса медленного фолбэка (WhisperX)
+
+
+class QueueFull(Exception):
+    """Очередь полосы заполнена — клиенту нужно повторить запрос позже."""
+
+    def __init__(self, lane: str, retry_after: int) -> None:
+        super().__init__(f"{lane} queue is full")
+        self.lane = lane
+        self.retry_after = retry_after
+
+
+class _Job:
+    __slots__ = ("fn", "args", "context", "future", "enqueued_at")
+
+    def __init__(self, fn: Callable, args: Tuple) -> None:
+        self.fn = fn
+        self.args = args
+        # контекст вызывающего (request_id для логов) переезжает в рабочий поток вместе с задачей
+        self.context = contextvars.copy_context()
+        self.future: Future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class _FairQueue:
+    """Очередь полосы: по deque на терминал, задачи выдаются по кругу между терминалами."""
+
+    def __init__(self) -> None:
+        self._keys: "OrderedDict[Hashable, Deque[_Job]]" = OrderedDict()
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def terminals(self) -> int:
+        return len(self._keys)
+
+    def depth(self, key: Hashable) -> int:
+        jobs = self._keys.get(key)
+        return len(jobs) if jobs is not None else 0
+
+    def append(self, key: Hashable, job: _Job) -> None:
+        jobs = self._keys.get(key)
+        if jobs is None:
+            jobs = self._keys[key] = deque()
+        jobs.append(job)
+        self._len += 1
+
+    def popleft(self) -> _Job:
+        # первый терминал в порядке обхода отдает одну задачу и уходит в конец круга
+        key, jobs = next(iter(self._keys.items()))
+        job = jobs.popleft()
+        if jobs:
+            self._keys.move_to_end(key)
+        else:
+            del self._keys[key]
+        self._len -= 1
+        return job
+
+
+class RecognitionScheduler:
+    def __init__(
+        self,
+        workers: int,
+        queue_depth: int,
+        slow_queue_depth: int,
+        slow_slots: int,
+        retry_after: int = 1,
+        terminal_depth: int = 0,
+    ) -> None:
+        """
+        :param terminal_depth: максимум ожидающих задач одного терминала в полосе (0 — без лимита)
+        """
+        self.workers = max(1, workers)
+        # хотя бы один поток всегда остается свободным для FAST
+        self.slow_slots = max(1, min(slow_slots, self.workers - 1 or 1))
+        self.retry_after = retry_after
+        self._depth = {FAST: queue_depth, SLOW: slow_queue_depth}
+        self.terminal_depth = terminal_depth
+        self._queues: Dict[str, _FairQueue] = {FAST: _FairQueue(), SLOW: _FairQueue()}
+        self._cond = threading.Condition()
+        self._slow_running = 0
+        self._running = 0
+        self._threads: list[threading.Thread] = []
+        self._stopping = False
+        # счетчики для /stats
+        self._stats = {
+            lane: {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0, "wait_ms_total": 0.0}
+            for lane in (FAST, SLOW)
+        }
+
+    # ---------- жизненный цикл ----------
+    def start(self) -> None:
+        with self._cond:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"recognizer-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+        logger.info("Scheduler started: workers=%d, slow_slots=%d", self.workers, self.slow_slots)
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(timeout=5)
+        self._threads.clear()
+
+    # ---------- постановка задач ----------
+    def submit(self, fn: Callable, *args: Any, lane: str = FAST, key: Optional[Hashable] = None) -> Future:
+        """
+        Ставит задачу в очередь полосы. Результат Future — значение fn,
+        у Future дополнительно появляется атрибут queue_wait_ms.
+        :param key: терминал, от имени которого задача (None — общий «анонимный» терминал без лимита терминала)
+        :raises QueueFull: если очередь полосы или терминала заполнена
+        """
+        job = _Job(fn, args)
+        with self._cond:
+            queue = self._queues[lane]
+            if len(queue) >= self._depth[lane] or (
+                self.terminal_depth and key is not None and queue.depth(key) >= self.terminal_depth
+            ):
+                self._stats[lane]["rejected"] += 1
+                raise QueueFull(lane, self.retry_after)
+            queue.append(key, job)
+            self._stats[lane]["submitted"] += 1
+            self._cond.notify()
+        return job.future
+
+    async def run(self, fn: Callable, *args: Any, lane: str = FAST,
+                  key: Optional[Hashable] = None) -> Tuple[Any, float]:
+        """Асинхронная обертка над submit: возвращает (результат, ожидание в очереди, мс)."""
+        future = self.submit(fn, *args, lane=lane, key=key)
+        result = await asyncio.wrap_future(future)
+        return result, future.queue_wait_ms
+
+    # ---------- рабочие потоки ----------
+    def _next_job(self) -> Tuple[str, _Job] | None:
+        """Берет задачу с учетом приоритета FAST и лимита слотов SLOW (под self._cond)."""
+        while True:
+            if self._stopping:
+                return None
+            if self._queues[FAST]:
+                return FAST, self._queues[FAST].popleft()
+            if self._queues[SLOW] and self._slow_running < self.slow_slots:
+                self._slow_running += 1
+                return SLOW, self._queues[SLOW].popleft()
+            self._cond.wait()
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                picked = self._next_job()
+                if picked is None:
+                    return
+                lane, job = picked
+                self._running += 1
+            wait_ms = (time.perf_counter() - job.enqueued_at) * 1000
+            job.future.queue_wait_ms = wait_ms
+            ok = False
+            if job.future.set_running_or_notify_cancel():
+                try:
+                    job.future.set_result(job.context.run(job.fn, *job.args))
+                    ok = True
+                except BaseException as e:
+                    job.future.set_exception(e)
+            with self._cond:
+                self._running -= 1
+                if lane == SLOW:
+                    self._slow_running -= 1
+                    self._cond.notify_all()  # освободился слот SLOW
+                stats = self._stats[lane]
+                stats["completed" if ok else "failed"] += 1
+                stats["wait_ms_total"] += wait_ms
+
+    # ---------- статистика ----------
+    def queue_depth(self, lane: str) -> int:
+        return len(self._queues[lane])
+
+    def stats(self) -> dict:
+        with self._cond:
+            lanes = {}
+            for lane, s in self._stats.items():
+                done = s["completed"] + s["failed"]
+                lanes[lane] = {
+                    "queued": len(self._queues[lane]),
+                    "terminals_queued": self._queues[lane].terminals(),
+                    "max_queued": self._depth[lane],
+                    "submitted": s["submitted"],
+                    "rejected": s["rejected"],
+                    "completed": s["completed"],
+                    "failed": s["failed"],
+                    "avg_wait_ms": round(s["wait_ms_total"] / done, 2) if done else 0.0,
+                }
+            return {
+                "workers": self.workers,
+                "slow_slots": self.slow_slots,
+                "terminal_depth": self.terminal_depth,
+                "running": self._running,
+                "slow_running": self._slow_running,
+                "lanes": lanes,
+            }
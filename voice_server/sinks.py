@@ -0,0 +1,386 @@
+# voice_server/sinks.py
+"""
+Доставка распознанных команд в 1С.
+
+Раньше каждая команда заново инициализировала COM, создавала V83.COMConnector
+и подключалась к базе (около секунды на команду). Теперь отправка идет через
+приемник (sink): его потоки держат долгоживущие соединения, переподключаются
+при ошибке, собирают команды, пришедшие почти одновременно, в одну пачку
+и ведут статистику задержек. Кроме COM есть заменители для Linux и нагрузочных
+тестов: запись в файл JSON Lines и POST на локальный HTTP-приемник
+(python -m voice_server.sinks --serve 8090).
+"""
+from __future__ import annotations
+import argparse
+import http.client
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Deque, List, Tuple
+from urllib.parse import urlsplit
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+Command = dict  # {"intent": ..., "fields": {...}}
+
+
+class CommandSink:
+    """
+    Базовый приемник: очередь команд, N потоков доставки и сбор пачек.
+    Наследник реализует _connect / _deliver / _disconnect для одного потока.
+    """
+
+    name = "sink"
+
+    def __init__(self, workers: int = 1, max_batch: int = 16, batch_wait_ms: float = 20.0) -> None:
+        self.workers = max(1, workers)
+        self.max_batch = max(1, max_batch)
+        self.batch_wait = batch_wait_ms / 1000
+        self._queue: Deque[Tuple[Command, Future]] = deque()
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._closed = False
+        # счетчики для /stats
+        self._calls = 0
+        self._commands = 0
+        self._errors = 0
+        self._reconnects = 0
+        self._latency_ms: Deque[float] = deque(maxlen=1024)
+
+    # ---------- интерфейс для сервера ----------
+    def submit(self, intent: str, fields: dict) -> Future:
+        """Ставит команду в очередь; Future завершится после доставки (или с ошибкой)."""
+        future: Future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError(f"{self.name} sink is closed")
+            if not self._threads:
+                self._start()
+            self._queue.append(({"intent": intent, "fields": fields or {}}, future))
+            self._cond.notify()
+        return future
+
+    def send(self, intent: str, fields: dict, timeout: float | None = None) -> None:
+        """Синхронная отправка: ждет доставки пачки с этой командой."""
+        self.submit(intent, fields).result(timeout)
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=5)
+
+    def stats(self) -> dict:
+        with self._cond:
+            latency = sorted(self._latency_ms)
+            return {
+                "sink": self.name,
+                "queued": len(self._queue),
+                "calls": self._calls,
+                "commands": self._commands,
+                "errors": self._errors,
+                "reconnects": self._reconnects,
+                "batch_avg": round(self._commands / self._calls, 2) if self._calls else 0.0,
+                "latency_ms_avg": round(sum(latency) / len(latency), 2) if latency else 0.0,
+                "latency_ms_p95": round(latency[int(len(latency) * 0.95)], 2) if latency else 0.0,
+                "latency_ms_max": round(latency[-1], 2) if latency else 0.0,
+            }
+
+    # ---------- потоки доставки ----------
+    def _start(self) -> None:
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._loop, name=f"{self.name}-sink-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _collect(self) -> List[Tuple[Command, Future]]:
+        """Ждет первую команду и добирает пачку до max_batch или до истечения batch_wait."""
+        with self._cond:
+            while not self._queue and not self._closed:
+                self._cond.wait()
+            deadline = time.monotonic() + self.batch_wait
+            while len(self._queue) < self.max_batch and not self._closed:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+            batch = []
+            while self._queue and len(batch) < self.max_batch:
+                command, future = self._queue.popleft()
+                if future.set_running_or_notify_cancel():
+                    batch.append((command, future))
+            return batch
+
+    def _loop(self) -> None:
+        try:
+            self._thread_init()
+        except Exception as e:
+            # без COM (или другой среды потока) доставлять некуда — команды сразу получают ошибку
+            logger.error("%s sink: worker init failed: %s", self.name, e)
+            while True:
+                batch = self._collect()
+                if not batch and self._closed:
+                    return
+                for _, future in batch:
+                    future.set_exception(e)
+        conn = None
+        try:
+            while True:
+                batch = self._collect()
+                if not batch:
+                    if self._closed:
+                        return
+                    continue
+                conn = self._deliver_with_retry(conn, batch)
+        finally:
+            if conn is not None:
+                self._safe_disconnect(conn)
+            self._thread_close()
+
+    def _deliver_with_retry(self, conn: Any, batch: List[Tuple[Command, Future]]) -> Any:
+        """
+        Доставляет пачку; при ошибке переподключается и пробует еще раз — только
+        команды, которые _deliver еще не убрал из списка как записанные.
+        Futures записанных завершаются успехом даже при ошибке остальных.
+        """
+        commands = [command for command, _ in batch]
+        started = time.perf_counter()
+        error: Exception | None = None
+        for attempt in range(2):
+            try:
+                if conn is None:
+                    conn = self._connect()
+                    if attempt:
+                        with self._cond:
+                            self._reconnects += 1
+                self._deliver(conn, commands)
+                error = None
+                break
+            except Exception as e:
+                logger.warning("%s sink: delivery of %d command(s) failed (attempt %d): %s",
+                               self.name, len(commands), attempt + 1, e)
+                error = e
+                if conn is not None:
+                    self._safe_disconnect(conn)
+                    conn = None
+        elapsed = (time.perf_counter() - started) * 1000
+        with self._cond:
+            self._calls += 1
+            self._commands += len(batch)
+            self._latency_ms.append(elapsed)
+            if error is not None:
+                self._errors += 1
+        # _deliver убирает записанные команды из начала списка: в commands остается только недоставленный хвост
+        delivered = len(batch) if error is None else len(batch) - len(commands)
+        for index, (_, future) in enumerate(batch):
+            if index < delivered:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+        return conn
+
+    def _safe_disconnect(self, conn: Any) -> None:
+        try:
+            self._disconnect(conn)
+        except Exception:
+            logger.debug("%s sink: disconnect failed", self.name, exc_info=True)
+
+    # ---------- точки расширения ----------
+    def _thread_init(self) -> None:
+        """Подготовка потока доставки (например, CoInitialize)."""
+
+    def _thread_close(self) -> None:
+        """Освобождение ресурсов потока доставки."""
+
+    def _connect(self) -> Any:
+        raise NotImplementedError
+
+    def _deliver(self, conn: Any, commands: List[Command]) -> None:
+        """
+        Записывает команды. Доставляющий по одной может убирать записанные из
+        начала списка — тогда при ошибке повторяется и считается неудачным только остаток.
+        """
+        raise NotImplementedError
+
+    def _disconnect(self, conn: Any) -> None:
+        """По умолчанию соединение просто забывается."""
+
+
+class _ComConnection:
+    __slots__ = ("conn", "checked")
+
+    def __init__(self, conn: Any) -> None:
+        self.conn = conn
+        self.checked = time.monotonic()
+
+
+class ComSink(CommandSink):
+    """
+    Внешнее соединение 1С через V83.COMConnector.
+
+    COM-объекты привязаны к потоку, поэтому каждое соединение живет в своем
+    потоке доставки от CoInitialize до CoUninitialize. Простаивавшее соединение
+    перед использованием проверяется дешевым вызовом.
+    """
+
+    name = "com"
+
+    def __init__(self, infobase: str, workers: int = 1, max_batch: int = 16, batch_wait_ms: float = 20.0,
+                 batch_method: str | None = None, health_interval: float = 60.0) -> None:
+        super().__init__(workers, max_batch, batch_wait_ms)
+        self.infobase = infobase
+        self.batch_method = batch_method
+        self.health_interval = health_interval
+
+    def _thread_init(self) -> None:
+        # COM нужен только этому приемнику — импорт не мешает серверу работать без pywin32
+        import pythoncom
+        pythoncom.CoInitialize()
+
+    def _thread_close(self) -> None:
+        import pythoncom
+        pythoncom.CoUninitialize()
+
+    def _connect(self) -> _ComConnection:
+        from win32com.client import Dispatch
+
+        started = time.perf_counter()
+        connector = Dispatch("V83.COMConnector")
+        conn = connector.Connect(self.infobase)
+        logger.info("COM sink: connected to %s in %.0f ms", self.infobase, (time.perf_counter() - started) * 1000)
+        return _ComConnection(conn)
+
+    def _deliver(self, conn: _ComConnection, commands: List[Command]) -> None:
+        now = time.monotonic()
+        if now - conn.checked > self.health_interval:
+            # соединение могло умереть вместе с процессом 1С — проверяем до записи команд
+            conn.conn.CurrentDate()
+        module = conn.conn.COMConnection
+        if self.batch_method and len(commands) > 1:
+            payload = json.dumps(commands, ensure_ascii=False)
+            getattr(module, self.batch_method)(payload)
+        else:
+            while commands:
+                command = commands[0]
+                payload = json.dumps(command["fields"], ensure_ascii=False)
+                logger.debug("Передаваемые данные в 1С через COM: intent=%s, fields=%s", command["intent"], payload)
+                # Вызываем метод 1С для записи команды в регистр
+                module.WriteTheCommandToTheRegister(command["intent"], payload)
+                # записанные убираем из пачки: повтор после переподключения их не продублирует
+                commands.pop(0)
+        conn.checked = now
+
+
+class FileSink(CommandSink):
+    """Заменитель 1С: команды дописываются в файл JSON Lines (одна запись на пачку)."""
+
+    name = "file"
+
+    def __init__(self, path: str, max_batch: int = 16, batch_wait_ms: float = 20.0) -> None:
+        # один поток: строки пачек не перемешиваются
+        super().__init__(1, max_batch, batch_wait_ms)
+        self.path = path
+
+    def _connect(self) -> Any:
+        return open(self.path, "a", encoding="utf-8")
+
+    def _deliver(self, conn: Any, commands: List[Command]) -> None:
+        conn.write("".join(json.dumps(c, ensure_ascii=False) + "\n" for c in commands))
+        conn.flush()
+
+    def _disconnect(self, conn: Any) -> None:
+        conn.close()
+
+
+class HttpSink(CommandSink):
+    """Заменитель 1С: пачка уходит JSON-массивом POST-запросом по keep-alive соединению."""
+
+    name = "http"
+
+    def __init__(self, url: str, workers: int = 1, max_batch: int = 16, batch_wait_ms: float = 20.0,
+                 timeout: float = 10.0) -> None:
+        super().__init__(workers, max_batch, batch_wait_ms)
+        parts = urlsplit(url)
+        self._host, self._port = parts.hostname or "127.0.0.1", parts.port or 80
+        self._path = parts.path or "/"
+        self.timeout = timeout
+
+    def _connect(self) -> http.client.HTTPConnection:
+        return http.client.HTTPConnection(self._host, self._port, timeout=self.timeout)
+
+    def _deliver(self, conn: http.client.HTTPConnection, commands: List[Command]) -> None:
+        body = json.dumps(commands, ensure_ascii=False).encode("utf-8")
+        conn.request("POST", self._path, body, {"Content-Type": "application/json"})
+        response = conn.getresponse()
+        response.read()
+        if response.status >= 300:
+            raise RuntimeError(f"HTTP sink: {response.status} {response.reason}")
+
+    def _disconnect(self, conn: http.client.HTTPConnection) -> None:
+        conn.close()
+
+
+def create_sink() -> CommandSink:
+    """Приемник по настройкам (VOICE_SINK=com|file|http)."""
+    common = {"max_batch": settings.sink_batch_size, "batch_wait_ms": settings.sink_batch_wait_ms}
+    if settings.sink == "file":
+        return FileSink(settings.sink_file_path, **common)
+    if settings.sink == "http":
+        return HttpSink(settings.sink_http_url, workers=settings.onec_connections, **common)
+    return ComSink(settings.onec_infobase, workers=settings.onec_connections,
+                   batch_method=settings.onec_batch_method, health_interval=settings.onec_health_interval,
+                   **common)
+
+
+# ---------- локальный HTTP-приемник для нагрузочных тестов ----------
+def serve(port: int) -> None:
+    """Принимает пачки HttpSink и считает команды — как будто это 1С."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    received = {"commands": 0, "batches": 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, как у HttpSink
+
+        def do_POST(self) -> None:
+            commands = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            with lock:
+                received["commands"] += len(commands)
+                received["batches"] += 1
+            self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_GET(self) -> None:
+            with lock:
+                body = json.dumps(received).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    with ThreadingHTTPServer(("127.0.0.1", port), Handler) as server:
+        print(f"HTTP sink stand-in on http://127.0.0.1:{port}/commands (GET — счетчики)")
+        server.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Локальный приемник команд вместо 1С")
+    parser.add_argument("--serve", type=int, metavar="PORT", default=8090)
+    serve(parser.parse_args().serve)
+
+
+# точка входа
+if __name__ == "__main__":
+    main()
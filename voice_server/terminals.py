@@ -0,0 +1,90 @@
+# voice_server/terminals.py
+"""
+Терминалы и сессии 1С.
+
+Каждый ТСД представляется идентификатором терминала (заголовок X-Terminal-Id
+или параметр ?terminal=), а команды адресуются сессии 1С (X-Session-Id или
+?session=, по умолчанию — сессия с именем терминала). Терминал определяет
+очередность в пуле распознавания и статистику, сессия — кому /intent отдает
+команды. Статистика хранится для ограниченного числа последних терминалов,
+так что сотни ТСД не раздувают память.
+"""
+from __future__ import annotations
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Optional
+
+_ID_RE = re.compile(r"^[\w.:@-]{1,64}$")
+
+
+class InvalidTerminal(ValueError):
+    """Идентификатор терминала или сессии пустой, слишком длинный или с недопустимыми символами."""
+
+
+def check_id(value: Optional[str], what: str = "terminal") -> Optional[str]:
+    """Пустое значение — None (анонимный терминал), иначе проверенная строка."""
+    if value is None or value == "":
+        return None
+    if not _ID_RE.match(value):
+        raise InvalidTerminal(f"invalid {what} id {value!r}: 1-64 letters, digits or . : @ _ -")
+    return value
+
+
+class _Terminal:
+    __slots__ = ("requests", "errors", "latency_ms", "last_seen")
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.errors = 0
+        self.latency_ms: Deque[float] = deque(maxlen=256)
+        self.last_seen = 0.0
+
+
+class TerminalStats:
+    def __init__(self, max_terminals: int = 1024) -> None:
+        """
+        :param max_terminals: сколько терминалов помнить (давно молчащие вытесняются)
+        """
+        self.max_terminals = max(1, max_terminals)
+        self._terminals: "OrderedDict[str, _Terminal]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, terminal: Optional[str], latency_ms: float, ok: bool = True) -> None:
+        """Учитывает запрос распознавания терминала: время ответа и успех."""
+        key = terminal or ""
+        with self._lock:
+            entry = self._terminals.get(key)
+            if entry is None:
+                entry = self._terminals[key] = _Terminal()
+                while len(self._terminals) > self.max_terminals:
+                    self._terminals.popitem(last=False)
+            else:
+                self._terminals.move_to_end(key)
+            entry.requests += 1
+            if ok:
+                entry.latency_ms.append(latency_ms)
+            else:
+                entry.errors += 1
+            entry.last_seen = time.time()
+
+    def __len__(self) -> int:
+        return len(self._terminals)
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            snapshot = [(key, t.requests, t.errors, sorted(t.latency_ms), t.last_seen)
+                        for key, t in self._terminals.items()]
+        return {
+            key: {
+                "requests": requests,
+                "errors": errors,
+                "latency_ms_avg": round(sum(latency) / len(latency), 2) if latency else 0.0,
+                "latency_ms_p95": round(latency[int(len(latency) * 0.95)], 2) if latency else 0.0,
+                "latency_ms_max": round(latency[-1], 2) if latency else 0.0,
+                "idle_s": round(now - last_seen, 1),
+            }
+            for key, requests, errors, latency, last_seen in snapshot
+        }
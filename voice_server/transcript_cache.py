@@ -0,0 +1,192 @@
+# voice_server/transcript_cache.py
+"""
+Кэш распознавания и идемпотентные повторы /recognize.
+
+Агент повторяет загрузку по таймауту, и без кэша каждый повтор заново проходит
+Vosk и WhisperX. Ключ кэша — sha256 декодированного PCM вместе с версиями
+грамматики, моделей и порогов политики: тот же звук с тем же окружением дает
+тот же ответ, а правка grammar.json или смена модели ключ меняет. Записи
+вытесняются по LRU и TTL; при заданном пути кэш дублируется в SQLite и
+переживает перезапуск сервера.
+
+Заголовок Idempotency-Key решает вторую половину проблемы: повтор с тем же
+ключом получает сохраненный ответ и не ставит отправку в 1С второй раз.
+"""
+from __future__ import annotations
+import copy
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Optional, Tuple
+
+from .audio_io import AudioBuffer
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+_TRIM_EVERY = 256  # как часто (в записях) вычищать устаревшее из SQLite
+
+
+def environment_version(grammar: str, nomenclature: str = "none") -> str:
+    """Все, кроме звука, от чего зависит ответ: грамматика, номенклатура, модели и пороги политики."""
+    return "|".join((
+        grammar,
+        f"{nomenclature}/{settings.nomenclature_min_score}",
+        settings.vosk_model_path,
+        f"{settings.voicemodel}/{settings.device}",
+        f"{settings.vosk_accept_confidence}/{settings.vosk_reject_confidence}/{settings.low_confidence_action}",
+    ))
+
+
+class TranscriptCache:
+    def __init__(self, max_items: int, ttl_s: float, path: str | None = None) -> None:
+        """
+        :param max_items: сколько ответов хранить (0 — кэш выключен)
+        :param ttl_s: время жизни ответа, секунд
+        :param path: файл SQLite для сохранения между перезапусками (None — только память)
+        """
+        self.max_items = max(0, max_items)
+        self.ttl = ttl_s
+        self._items: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        self._writes = 0
+        # счетчики для /stats
+        self._hits = 0
+        self._misses = 0
+        if path and self.max_items:
+            self._open(path)
+
+    @staticmethod
+    def key(audio: AudioBuffer, environment: str) -> str:
+        digest = hashlib.sha256(audio.pcm)
+        digest.update(f"|{audio.rate}|{environment}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def _open(self, path: str) -> None:
+        db = sqlite3.connect(path, check_same_thread=False)
+        # кэш можно потерять без последствий — fsync на каждую запись не нужен
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=OFF")
+        db.execute("CREATE TABLE IF NOT EXISTS transcripts (key TEXT PRIMARY KEY, created REAL, result TEXT)")
+        rows = db.execute(
+            "SELECT key, created, result FROM transcripts WHERE created > ? ORDER BY created DESC LIMIT ?",
+            (time.time() - self.ttl, self.max_items),
+        ).fetchall()
+        for key, created, result in reversed(rows):
+            self._items[key] = (created, json.loads(result))
+        self._db = db
+        logger.info("Transcript cache: %d entries restored from %s", len(rows), path)
+
+    def get(self, key: str) -> Optional[dict]:
+        """Копия сохраненного ответа или None (нет, устарел или кэш выключен)."""
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self._items[key]
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._items.move_to_end(key)
+            self._hits += 1
+            return copy.deepcopy(entry[1])
+
+    def put(self, key: str, result: dict) -> None:
+        if not self.max_items:
+            return
+        created = time.time()
+        stored = copy.deepcopy(result)
+        with self._lock:
+            self._items[key] = (created, stored)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+            if self._db is not None:
+                self._persist(key, created, stored)
+
+    def _persist(self, key: str, created: float, result: dict) -> None:
+        try:
+            self._db.execute(
+                "INSERT OR REPLACE INTO transcripts VALUES (?, ?, ?)",
+                (key, created, json.dumps(result, ensure_ascii=False)),
+            )
+            self._writes += 1
+            if self._writes % _TRIM_EVERY == 0:
+                self._db.execute(
+                    "DELETE FROM transcripts WHERE created <= ? OR key NOT IN "
+                    "(SELECT key FROM transcripts ORDER BY created DESC LIMIT ?)",
+                    (created - self.ttl, self.max_items),
+                )
+            self._db.commit()
+        except sqlite3.Error:
+            # диск кэша — не повод ронять распознавание
+            logger.exception("Transcript cache: persist failed")
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "size": len(self._items),
+                "max_items": self.max_items,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": round(self._hits / lookups, 3) if lookups else 0.0,
+                "persistent": self._db is not None,
+            }
+
+
+# состояния ключа идемпотентности
+NEW = "new"          # первый запрос — его нужно выполнить и завершить complete()/abort()
+PENDING = "pending"  # такой же запрос еще выполняется — ждать его Future
+DONE = "done"        # ответ уже есть — вернуть его без отправки в 1С
+
+
+class IdempotencyKeys:
+    """Ответы на запросы с заголовком Idempotency-Key на время TTL."""
+
+    def __init__(self, ttl_s: float, max_items: int = 10000) -> None:
+        self.ttl = ttl_s
+        self.max_items = max_items
+        self._items: "OrderedDict[str, Tuple[float, Future]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._replays = 0
+
+    def begin(self, key: str) -> Tuple[str, Optional[Future]]:
+        now = time.monotonic()
+        with self._lock:
+            while self._items:
+                # самые старые ключи — в начале; просроченные выбрасываем
+                oldest, (started, _) = next(iter(self._items.items()))
+                if now - started <= self.ttl and len(self._items) < self.max_items:
+                    break
+                del self._items[oldest]
+            entry = self._items.get(key)
+            if entry is None:
+                self._items[key] = (now, Future())
+                return NEW, None
+            self._replays += 1
+            future = entry[1]
+            return (DONE if future.done() else PENDING), future
+
+    def complete(self, key: str, result: dict) -> None:
+        with self._lock:
+            entry = self._items.get(key)
+        if entry is not None and not entry[1].done():
+            entry[1].set_result(copy.deepcopy(result))
+
+    def abort(self, key: str, error: BaseException) -> None:
+        """Запрос не удался — ожидающие повторы получают ту же ошибку, следующий выполнится заново."""
+        with self._lock:
+            entry = self._items.pop(key, None)
+        if entry is not None and not entry[1].done():
+            entry[1].set_exception(error)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"keys": len(self._items), "replays": self._replays}
@@ -0,0 +1,118 @@
+# voice_server/whisper_batcher.py
+"""
+Микро-батчинг фолбэков на WhisperX.
+
+Одновременные обращения к WhisperX от разных терминалов собираются в пачку
+(до ``max_batch`` фраз или ``max_wait_ms`` миллисекунд ожидания) и проходят
+через модель одним батчированным вызовом в отдельном потоке. Результаты
+раздаются ожидающим запросам через Future.
+"""
+from __future__ import annotations
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Deque, List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+BatchFn = Callable[[List[np.ndarray]], List[str]]
+
+
+class WhisperBatcher:
+    def __init__(self, transcribe_batch: BatchFn, max_batch: int, max_wait_ms: float) -> None:
+        """
+        :param transcribe_batch: распознает список float32-буферов 16 kHz одним проходом
+        :param max_batch: максимальный размер пачки
+        :param max_wait_ms: сколько ждать добора пачки после первой фразы
+        """
+        self._transcribe_batch = transcribe_batch
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000
+        self._queue: Deque[Tuple[np.ndarray, Future]] = deque()
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+        # счетчики для /stats
+        self._batches = 0
+        self._items = 0
+        self._busy_s = 0.0
+
+    def _ensure_started(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="whisper-batcher", daemon=True)
+            self._thread.start()
+
+    def submit(self, audio: np.ndarray) -> Future:
+        """Ставит фразу в очередь пачки; Future вернет распознанный текст."""
+        future: Future = Future()
+        with self._cond:
+            self._ensure_started()
+            self._queue.append((audio, future))
+            self._cond.notify()
+        return future
+
+    def transcribe(self, audio: np.ndarray) -> str:
+        """Синхронная обертка: ждет, пока пачка с этой фразой будет распознана."""
+        return self.submit(audio).result()
+
+    def _collect(self) -> List[Tuple[np.ndarray, Future]]:
+        """Ждет первую фразу, затем добирает пачку до max_batch или до истечения max_wait."""
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            deadline = time.monotonic() + self.max_wait
+            while len(self._queue) < self.max_batch:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+            batch = []
+            while self._queue and len(batch) < self.max_batch:
+                audio, future = self._queue.popleft()
+                if future.set_running_or_notify_cancel():
+                    batch.append((audio, future))
+            return batch
+
+    def _loop(self) -> None:
+        while True:
+            batch = self._collect()
+            if not batch:
+                continue
+            started = time.perf_counter()
+            try:
+                texts = self._transcribe_batch([audio for audio, _ in batch])
+            except Exception as e:
+                logger.exception("WhisperX batch of %d failed", len(batch))
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            elapsed = time.perf_counter() - started
+            logger.debug("WhisperX batch: %d item(s) in %.0f ms", len(batch), elapsed * 1000)
+            if len(texts) != len(batch):
+                logger.error("WhisperX batch of %d returned %d text(s)", len(batch), len(texts))
+            for index, (_, future) in enumerate(batch):
+                if index < len(texts):
+                    future.set_result(texts[index])
+                else:
+                    # без ответа Future ждал бы вечно — запрос получит ошибку
+                    future.set_exception(RuntimeError(
+                        f"WhisperX returned {len(texts)} result(s) for a batch of {len(batch)}"))
+            with self._cond:
+                self._batches += 1
+                self._items += len(batch)
+                self._busy_s += elapsed
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "max_batch": self.max_batch,
+                "max_wait_ms": round(self.max_wait * 1000, 1),
+                "queued": len(self._queue),
+                "batches": self._batches,
+                "items": self._items,
+                "fill_ratio": round(self._items / (self._batches * self.max_batch), 3) if self._batches else 0.0,
+                "items_per_s": round(self._items / self._busy_s, 2) if self._busy_s else 0.0,
+            }